@@ -0,0 +1,184 @@
+""" Archival sink writing received messages into rolling hdf5 files.
+
+Each detector is appended to its own chunked, resizable dataset.
+Chunks of hdf5 messages are copied as-is (with write_direct_chunk),
+so compressed data is never decoded and re-encoded.
+
+Reduced messages (see reduce.py) keep their roi and bin as
+dataset attributes.  Since each message of quantized images has
+its own scale and offset, these are stored per image, in the
+{name}_scale and {name}_offset datasets.
+"""
+
+from collections.abc import Iterator
+from io import BytesIO
+from typing import Any, Dict, Optional, Tuple
+import logging
+_logger = logging.getLogger(__name__)
+
+import numpy as np
+import h5py # type: ignore[import-untyped]
+import stream
+
+from .models import Codec
+from .compression import registry, BytesLike
+from .messages import FRAME_MAGIC, SPARSE_MAGIC, read_frame, \
+                      read_sparse, densify, unseal
+
+def _name(attrs) -> str:
+    # dataset holding a message with these attributes
+    name = attrs.get('detector', 'data')
+    if attrs.get('kind', None) == 'mask':
+        name += '_mask'
+    return name
+
+class Archive:
+    """ Rolling hdf5 archive.
+
+    Files are named {prefix}.00000.h5, {prefix}.00001.h5, etc.
+    A new file is started once the current one holds max_bytes
+    of (compressed) image data.
+    """
+    def __init__(self, prefix : str, max_bytes : int) -> None:
+        assert max_bytes > 0
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.index = 0
+        self.nbytes = 0
+        self.fh : Optional[h5py.File] = None
+
+    def __enter__(self) -> "Archive":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    @property
+    def file(self) -> h5py.File:
+        if self.fh is not None and self.nbytes >= self.max_bytes:
+            self.close()
+            self.index += 1
+        if self.fh is None:
+            fname = f"{self.prefix}.{self.index:05d}.h5"
+            _logger.info("Archive: opening %s", fname)
+            self.fh = h5py.File(fname, 'w')
+            self.nbytes = 0
+        return self.fh
+
+    def _dataset(self, name : str,
+                 shape : Tuple[int, ...],
+                 dtype : np.dtype,
+                 codec : str,
+                 dcpl : Any = None,
+                 filter_opts : Dict[str, Any] = {}) -> h5py.Dataset:
+        fh = self.file
+        if name in fh:
+            return fh[name]
+        dset = fh.create_dataset(name,
+                                 shape = (0,) + shape,
+                                 maxshape = (None,) + shape,
+                                 dtype = dtype,
+                                 chunks = (1,) + shape,
+                                 dcpl = dcpl,
+                                 allow_unknown_filter = True,
+                                 **filter_opts)
+        dset.attrs['codec'] = codec
+        return dset
+
+    def _reduction(self, dst : h5py.Dataset, attrs : Any, n0 : int) -> None:
+        # record the reduction of the images appended to dst at n0
+        for key in ('roi', 'bin'):
+            if key in attrs:
+                dst.attrs[key] = attrs[key]
+        if 'scale' not in attrs:
+            return
+        fh = dst.file # (not self.file, which may roll over)
+        for key in ('scale', 'offset'):
+            name = f"{dst.name}_{key}"
+            if name not in fh:
+                fh.create_dataset(name, shape=(0,), maxshape=(None,),
+                                  dtype='f8', chunks=(1024,),
+                                  fillvalue=np.nan)
+            side = fh[name]
+            side.resize(len(dst), axis=0)
+            side[n0:] = attrs[key]
+
+    def write(self, msg : BytesLike) -> int:
+        """ Append the images in msg.
+
+        Returns the number of bytes written.
+        """
+        env, msg = unseal(msg)
+        if len(msg) == 0:
+            return 0
+        if msg[:len(FRAME_MAGIC)] == FRAME_MAGIC:
+            return self.write_frame(msg)
+        if msg[:len(SPARSE_MAGIC)] == SPARSE_MAGIC:
+            return self.write_sparse(msg)
+        with h5py.File(BytesIO(msg), 'r') as src:
+            return self.write_hdf5(src['data'])
+
+    def write_hdf5(self, src : h5py.Dataset) -> int:
+        name = _name(src.attrs)
+        codec = src.attrs.get('codec', 'unknown')
+        shape = src.shape[1:]
+        dst = self._dataset(name, shape, src.dtype, codec,
+                            dcpl = src.id.get_create_plist())
+        n0 = dst.shape[0]
+        dst.resize(n0 + len(src), axis=0)
+        self._reduction(dst, src.attrs, n0)
+
+        direct = src.chunks == (1,) + shape \
+                 and dst.shape[1:] == shape \
+                 and dst.dtype == src.dtype \
+                 and dst.attrs['codec'] == codec
+        if not direct: # decode and re-encode
+            dst[n0:] = src[()]
+            size = dst.dtype.itemsize * int(np.prod(src.shape))
+            self.nbytes += size
+            return size
+
+        zeros = (0,)*len(shape)
+        size = 0
+        for i in range(len(src)):
+            mask, chunk = src.id.read_direct_chunk((i,) + zeros)
+            dst.id.write_direct_chunk((n0+i,) + zeros, chunk, mask)
+            size += len(chunk)
+        self.nbytes += size
+        return size
+
+    def write_frame(self, msg : BytesLike) -> int:
+        data, header = read_frame(msg)
+        return self._append(data, header)
+
+    def write_sparse(self, msg : BytesLike) -> int:
+        # stored dense, like a frame
+        sp = read_sparse(msg)
+        return self._append(densify(sp), sp.attrs)
+
+    def _append(self, data : np.ndarray, header : Dict[str, Any]) -> int:
+        name = _name(header)
+        codec = Codec(header['codec'])
+        dst = self._dataset(name, data.shape[1:], data.dtype, codec.value,
+                            filter_opts = dict(registry[codec].filter()))
+        n0 = dst.shape[0]
+        dst.resize(n0 + len(data), axis=0)
+        dst[n0:] = data
+        self._reduction(dst, header, n0)
+        self.nbytes += data.nbytes
+        return data.nbytes
+
+@stream.stream
+def archive_writer(gen : Iterator[bytes],
+                   prefix : str,
+                   max_bytes : int = 4*1024**3
+                  ) -> Iterator[int]:
+    # transform messages into sizes archived
+    with Archive(prefix, max_bytes) as ar:
+        for msg in gen:
+            yield ar.write(msg)
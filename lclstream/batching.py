@@ -0,0 +1,119 @@
+""" Adaptive batching: choose the number of images per message
+from a target (compressed) message size and a latency limit,
+instead of a fixed count.
+
+The chopper measures the raw size of each image as it arrives,
+and converts it to an expected compressed size using the
+compression ratio observed on previous messages.  Large
+messages are also capped so that sending one takes no longer
+than max_latency at the observed send bandwidth.
+"""
+
+from collections import deque
+from collections.abc import Callable, Iterator
+from typing import Any, Deque, List, Optional
+import threading
+import time
+
+import numpy as np
+import stream
+
+class BatchSizer:
+    """ Feedback for adaptive_chop.
+
+    Call encoded(size) for each encoded message (in the
+    order batches were made) and sent(size, seconds) after
+    each send.
+
+    Params:
+        target_bytes: aim for messages of this (compressed) size
+        max_latency: seconds - limits both the time spent
+                     collecting a batch, and the time sending it
+        max_images: never batch more than this many images
+        smoothing: weight of each new observation in the
+                   running estimates (0 < smoothing <= 1)
+    """
+    def __init__(self, target_bytes : int,
+                 max_latency : float = 1.0,
+                 max_images : int = 1000,
+                 smoothing : float = 0.25) -> None:
+        assert 0 < smoothing <= 1
+        self.target_bytes = target_bytes
+        self.max_latency = max_latency
+        self.max_images = max_images
+        self.smoothing = smoothing
+        self.ratio = 1.0 # compressed / raw bytes
+        self.bandwidth : Optional[float] = None # bytes / second
+        self.raw : Deque[int] = deque() # raw bytes of batches not yet encoded
+        self.lock = threading.Lock()
+
+    def _update(self, old : float, new : float) -> float:
+        return old + self.smoothing*(new - old)
+
+    @property
+    def limit(self) -> float:
+        """ Current target for the compressed size of a message.
+        """
+        target = float(self.target_bytes)
+        if self.bandwidth is not None:
+            target = min(target, self.bandwidth*self.max_latency)
+        return target
+
+    def full(self, raw_bytes : int, images : int) -> bool:
+        """ Is a batch of images holding raw_bytes (uncompressed) complete?
+        """
+        return images >= self.max_images \
+                or raw_bytes*self.ratio >= self.limit
+
+    def batch(self, raw_bytes : int) -> None:
+        with self.lock:
+            self.raw.append(raw_bytes)
+
+    def encoded(self, size : int) -> None:
+        """ Observe the encoded size of the oldest batch.
+        """
+        with self.lock:
+            if len(self.raw) == 0: # (not made by adaptive_chop)
+                return
+            raw = self.raw.popleft()
+            if raw > 0:
+                self.ratio = self._update(self.ratio, size/raw)
+
+    def sent(self, size : int, seconds : float) -> None:
+        """ Observe the time taken to send a message.
+        """
+        if seconds <= 0:
+            return
+        with self.lock:
+            bw = size/seconds
+            if self.bandwidth is None:
+                self.bandwidth = bw
+            else:
+                self.bandwidth = self._update(self.bandwidth, bw)
+
+@stream.stream
+def adaptive_chop(gen : Iterator[Any], sizer : BatchSizer,
+                  clock : Callable[[], float] = time.monotonic
+                 ) -> Iterator[List[Any]]:
+    """ Group images into batches (like stream.chop),
+    ending each batch when sizer.full(), or once
+    sizer.max_latency has passed since its first image
+    (checked as each image arrives).
+    """
+    batch : List[Any] = []
+    raw = 0
+    t0 = 0.0
+    for img in gen:
+        if len(batch) == 0:
+            t0 = clock()
+        batch.append(img)
+        raw += np.asarray(img).nbytes
+        if sizer.full(raw, len(batch)) \
+                or clock() - t0 >= sizer.max_latency:
+            sizer.batch(raw)
+            yield batch
+            batch = []
+            raw = 0
+    if len(batch) > 0:
+        sizer.batch(raw)
+        yield batch
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+""" Loopback benchmark of the push/pull pipeline.
+
+Pushers (threads) and a puller run within one process,
+connected over inproc://, ipc:// or tcp://127.0.0.1.
+Every combination of the swept parameters is run,
+and one result row per combination is written
+to a JSON or CSV file, which can be diffed between versions.
+"""
+
+from collections.abc import Callable, Iterable, Iterator
+from functools import partial
+from itertools import cycle, islice, product
+from pathlib import Path
+from typing import Annotated, Any, Dict, List, Tuple
+import csv
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Images come from the stub psana backend.
+os.environ.setdefault("RAND_PSANA", "1")
+
+import numpy as np
+import stream
+import typer
+
+from .models import AccessMode, Codec, ImageRetrievalMode, MessageFormat
+from .messages import Hdf5FileWriter, FrameWriter, SparseWriter
+from .nng import pusher, puller
+from .psana_img_src import PsanaImgSrc
+from .psana_stub import layouts
+from .stats import Stats, timed
+
+writers = { MessageFormat.hdf5  : Hdf5FileWriter,
+            MessageFormat.frame : FrameWriter,
+            MessageFormat.sparse : SparseWriter, }
+
+Shape = Tuple[int, ...]
+
+def parse_list(spec : str, conv : Callable[[str], Any]) -> List[Any]:
+    return [conv(x.strip()) for x in spec.split(",") if x.strip()]
+
+def parse_shape(spec : str) -> Shape:
+    # e.g. "1024x1024", "8x512x1024" or "jungfrau4M"
+    if spec in layouts:
+        return layouts[spec].shape
+    return tuple(int(x) for x in spec.split("x"))
+
+def frame_pool(shape : Shape, n : int) -> List[np.ndarray]:
+    """ Read n stub images, reshaped (repeating or truncating
+    their pixels) to shape.
+
+    The benchmark cycles through this pool, so reading
+    costs (almost) nothing.
+    """
+    ps = PsanaImgSrc("bench", 0, AccessMode.idx, "stub", index_cache=False)
+    imgs = ps(ImageRetrievalMode.calib, events=slice(0, n))
+    return [np.resize(img, shape) for img in imgs]
+
+def address(transport : str, k : int, tmpdir : str, port : int) -> str:
+    # A new address for every run, so sockets are never reused.
+    if transport == "inproc":
+        return f"inproc://lclstream-bench-{k}"
+    if transport == "ipc":
+        return f"ipc://{tmpdir}/bench-{k}.ipc"
+    if transport == "tcp":
+        return f"tcp://127.0.0.1:{port+k}"
+    raise ValueError(f"Unknown transport: {transport}")
+
+def push_worker(addr : str, frames : List[np.ndarray], nimg : int,
+                img_per_file : int, writer : Callable[[List[Any]], bytes],
+                send_buffer_size : int, ready : threading.Event,
+                done : threading.Event, wall : Stats, cpu : Stats) -> None:
+    """ Send nimg images (cycling through frames) to addr,
+    recording wall-clock and CPU time per stage.
+
+    nng discards queued messages when a socket closes,
+    so the socket is held open until done is set
+    (once the puller has received everything).
+    """
+    if not ready.wait(30):
+        return
+    c0 = time.thread_time()
+    def encode(batch : List[np.ndarray]) -> bytes:
+        t0, t1 = time.perf_counter(), time.thread_time()
+        msg = writer(batch)
+        wall.record('encode', time.perf_counter() - t0)
+        cpu.record('encode', time.thread_time() - t1)
+        return msg
+    def sent(size : int, seconds : float) -> None:
+        wall.record('send', seconds)
+        wall.message(size)
+
+    images = islice(cycle(frames), nimg) \
+                >> timed(cpu, 'read', time.thread_time) \
+                >> timed(wall, 'read')
+    busy = 0.0
+    def linger(msgs : Iterable[bytes]) -> Iterator[bytes]:
+        nonlocal busy
+        yield from msgs
+        busy = time.thread_time() - c0
+        done.wait(10)
+
+    msgs = images >> stream.chop(img_per_file) >> stream.map(encode)
+    for size in linger(msgs) >> pusher(addr, 1, sent, send_buffer_size):
+        pass
+    cpu.record('send', busy - cpu.stages['read'].total
+                            - cpu.stages['encode'].total)
+
+def bench_one(addr : str, frames : List[np.ndarray], nimg : int,
+              img_per_file : int, writer : Callable[[List[Any]], bytes],
+              pushers : int, send_buffer_size : int) -> Dict[str, Any]:
+    """ Run pushers sending nimg images each to one puller.
+    """
+    stages = ('read', 'encode', 'send')
+    walls = [Stats(stages) for i in range(pushers)]
+    cpus = [Stats(stages) for i in range(pushers)]
+    ready = threading.Event()
+    done = threading.Event()
+    threads = [threading.Thread(target=push_worker,
+                                args=(addr, frames, nimg, img_per_file,
+                                      writer, send_buffer_size, ready, done,
+                                      walls[i], cpus[i]),
+                                name=f"pusher-{i}", daemon=True)
+               for i in range(pushers)]
+    for t in threads:
+        t.start()
+
+    nmsg = pushers * ((nimg+img_per_file-1) // img_per_file)
+    recv = Stats(('recv',))
+    c0 = time.thread_time()
+    t0 = time.perf_counter()
+    msgs = puller(addr, 0, ready.set) >> timed(recv, 'recv')
+    for msg in islice(msgs, nmsg):
+        recv.message(len(msg))
+    seconds = time.perf_counter() - t0
+    recv_cpu = time.thread_time() - c0
+    done.set()
+    for t in threads:
+        t.join()
+
+    def total(stats : List[Stats], stage : str) -> float:
+        return sum(st.stages[stage].total for st in stats)
+    sent = sum(st.count for st in walls)
+    return { 'messages': recv.count,
+             'lost': sent - recv.count,
+             'bytes': recv.size,
+             'seconds': seconds,
+             'mbps': recv.size / seconds / 1024**2,
+             'images_per_sec': pushers * nimg / seconds,
+             'read_seconds': total(walls, 'read'),
+             'encode_seconds': total(walls, 'encode'),
+             'send_seconds': total(walls, 'send'),
+             'read_cpu': total(cpus, 'read'),
+             'encode_cpu': total(cpus, 'encode'),
+             'send_cpu': total(cpus, 'send'),
+             'recv_cpu': recv_cpu,
+           }
+
+def write_results(rows : List[Dict[str, Any]], output : Path) -> None:
+    if output.suffix == ".csv":
+        with open(output, 'w', newline='') as f:
+            w = csv.DictWriter(f, fieldnames=list(rows[0]))
+            w.writeheader()
+            w.writerows(rows)
+    else:
+        with open(output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+def lclstream_bench(
+        transports: Annotated[
+            str,
+            typer.Option("--transports", help="Comma-separated transports (inproc, ipc, tcp)"),
+        ] = "inproc,ipc,tcp",
+        shapes: Annotated[
+            str,
+            typer.Option("--shapes", help="Comma-separated image shapes or detectors, e.g. 1024x1024,8x512x1024,epix10k2M"),
+        ] = "1024x1024",
+        img_per_file: Annotated[
+            str,
+            typer.Option("--img_per_file", "-n", help="Comma-separated numbers of images per message"),
+        ] = "10",
+        codecs: Annotated[
+            str,
+            typer.Option("--codecs", "-z", help="Comma-separated compression codecs"),
+        ] = "none,zfp",
+        pushers: Annotated[
+            str,
+            typer.Option("--pushers", help="Comma-separated numbers of pusher threads"),
+        ] = "1,2",
+        send_buffer_size: Annotated[
+            str,
+            typer.Option("--send_buffer_size", help="Comma-separated nng send buffer sizes (messages)"),
+        ] = "0",
+        format: Annotated[
+            MessageFormat,
+            typer.Option("--format", "-f", help="Message format"),
+        ] = MessageFormat.hdf5,
+        images: Annotated[
+            int,
+            typer.Option("--images", help="Number of images sent by each pusher"),
+        ] = 200,
+        pool: Annotated[
+            int,
+            typer.Option("--pool", help="Number of distinct images to cycle through"),
+        ] = 8,
+        port: Annotated[
+            int,
+            typer.Option("--port", help="First port used by tcp runs"),
+        ] = 5600,
+        output: Annotated[
+            Path,
+            typer.Option("--output", "-o", help="Results file (.json or .csv)"),
+        ] = Path("bench.json"),
+    ):
+    sweep = product(parse_list(transports, str),
+                    parse_list(shapes, parse_shape),
+                    parse_list(img_per_file, int),
+                    parse_list(codecs, Codec),
+                    parse_list(pushers, int),
+                    parse_list(send_buffer_size, int))
+    pools : Dict[Shape, List[np.ndarray]] = {}
+    rows : List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for k, (transport, shape, n, codec, npush, bufsz) in enumerate(sweep):
+            if shape not in pools:
+                pools[shape] = frame_pool(shape, pool)
+            writer = partial(writers[format], codec=codec)
+            addr = address(transport, k, tmpdir, port)
+            row : Dict[str, Any] = {
+                    'transport': transport,
+                    'shape': "x".join(map(str, shape)),
+                    'img_per_file': n,
+                    'format': format.value,
+                    'codec': codec.value,
+                    'pushers': npush,
+                    'send_buffer_size': bufsz }
+            row.update(bench_one(addr, pools[shape], images, n,
+                                 writer, npush, bufsz))
+            print(f"{transport} {row['shape']} n={n} {codec.value}"
+                  f" pushers={npush} buf={bufsz}:"
+                  f" {row['mbps']:.1f} MB/sec,"
+                  f" {row['images_per_sec']:.1f} images/sec", flush=True)
+            rows.append(row)
+    if len(rows) > 0:
+        write_results(rows, output)
+        print(f"Wrote {len(rows)} results to {output}")
+
+def run():
+    typer.run(lclstream_bench)
+
+if __name__ == "__main__":
+    run()
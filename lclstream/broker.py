@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+""" A stream cache: accepts messages pushed by any number of
+producers (psana_push) and serves them to any number
+of pulling consumers (psana_pull --dial).
+
+Messages are kept in memory up to a byte limit, then spilled
+to memory-mapped segment files, so producers never wait on
+slow consumers.  Messages are served in the order received.
+"""
+
+from collections import deque
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Annotated, Deque, Optional
+import mmap
+import struct
+import tempfile
+import threading
+import time
+import logging
+_logger = logging.getLogger(__name__)
+
+from pynng import Push0, Pull0, Timeout # type: ignore[import-untyped]
+from pynng.exceptions import NNGException # type: ignore[import-untyped]
+import typer
+
+from .nng import eos_sender, port_range
+from .stats import Stats
+
+_length = struct.Struct("<Q")
+
+class Segment:
+    """ A memory-mapped file holding a sequence of
+    length-prefixed messages, written once and read once.
+    """
+    def __init__(self, path : Path, size : int) -> None:
+        self.path = path
+        self.size = size
+        self.file = open(path, "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.wpos = 0
+        self.rpos = 0
+
+    def append(self, msg : bytes) -> bool:
+        """ Write msg, returning False if it does not fit.
+        """
+        end = self.wpos + _length.size + len(msg)
+        if end > self.size:
+            return False
+        _length.pack_into(self.map, self.wpos, len(msg))
+        self.map[self.wpos+_length.size : end] = msg
+        self.wpos = end
+        return True
+
+    @property
+    def empty(self) -> bool:
+        return self.rpos == self.wpos
+
+    def pop(self) -> bytes:
+        n, = _length.unpack_from(self.map, self.rpos)
+        start = self.rpos + _length.size
+        self.rpos = start + n
+        return self.map[start : self.rpos]
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+        self.path.unlink()
+
+class Spill:
+    """ FIFO of messages stored in segment files under path.
+
+    Segment files are deleted once read.
+    """
+    def __init__(self, path : Path, segment_bytes : int) -> None:
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.segments : Deque[Segment] = deque()
+        self.count = 0
+        self.bytes = 0
+        self.serial = 0
+
+    def append(self, msg : bytes) -> None:
+        if len(self.segments) == 0 or not self.segments[-1].append(msg):
+            if self.count == 0: # too large for the (reused) last segment
+                self.close()
+            size = max(self.segment_bytes, _length.size + len(msg))
+            seg = Segment(self.path / f"segment-{self.serial:06d}.dat", size)
+            self.serial += 1
+            seg.append(msg)
+            self.segments.append(seg)
+        self.count += 1
+        self.bytes += len(msg)
+
+    def next_size(self) -> int:
+        """ Size of the message pop() would return.
+        """
+        seg = self.segments[0]
+        return _length.unpack_from(seg.map, seg.rpos)[0]
+
+    def pop(self) -> bytes:
+        assert self.count > 0
+        seg = self.segments[0]
+        msg = seg.pop()
+        self.count -= 1
+        self.bytes -= len(msg)
+        if seg.empty:
+            if len(self.segments) > 1:
+                self.segments.popleft().close()
+            else: # reuse the last segment
+                seg.rpos = seg.wpos = 0
+        return msg
+
+    def close(self) -> None:
+        while len(self.segments) > 0:
+            self.segments.popleft().close()
+
+class MessageCache:
+    """ Thread-safe FIFO of messages, holding up to memory_bytes
+    in memory and spilling the rest to segment files.
+
+    Params:
+        memory_bytes: size limit of messages held in memory
+        spill_dir: directory for segment files
+        segment_bytes: size of each segment file
+        disk_bytes: size limit of spilled messages.
+                    Past this, the oldest messages are dropped.
+    """
+    def __init__(self, memory_bytes : int, spill_dir : Path,
+                 segment_bytes : int = 256*1024**2,
+                 disk_bytes : Optional[int] = None) -> None:
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        # memory holds the oldest messages, spill the newer ones
+        self.memory : Deque[bytes] = deque()
+        self.in_memory = 0
+        self.spill = Spill(spill_dir, segment_bytes)
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self.memory) + self.spill.count
+
+    def put(self, msg : bytes) -> None:
+        with self.cond:
+            if self.spill.count == 0 and \
+                    self.in_memory + len(msg) <= self.memory_bytes:
+                self.memory.append(msg)
+                self.in_memory += len(msg)
+            else:
+                self.spill.append(msg)
+                if self.disk_bytes is not None:
+                    while self.spill.bytes > self.disk_bytes:
+                        self._pop()
+                        self.dropped += 1
+            self.cond.notify()
+
+    def get(self, timeout : Optional[float] = None) -> Optional[bytes]:
+        """ Remove and return the oldest message,
+        or None if none arrive within timeout.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self) > 0, timeout):
+                return None
+            return self._pop()
+
+    def _pop(self) -> bytes:
+        if len(self.memory) == 0: # message too large for memory
+            return self.spill.pop()
+        msg = self.memory.popleft()
+        self.in_memory -= len(msg)
+        while self.spill.count > 0:
+            if self.in_memory + self.spill.next_size() > self.memory_bytes:
+                break
+            m = self.spill.pop()
+            self.memory.append(m)
+            self.in_memory += len(m)
+        return msg
+
+    def close(self) -> None:
+        with self.cond:
+            self.spill.close()
+
+class Broker:
+    """ Receive messages at the listen addresses into cache,
+    and serve them (load-balanced) to consumers pulling
+    from the serve address.
+
+    Producers ending their stream with an EOS message
+    (pusher(..., eos=name)) have their pipe closed,
+    so they know all their messages arrived.
+    EOS messages are not passed on.
+    """
+    def __init__(self, listen : Sequence[str], serve : str,
+                 cache : MessageCache) -> None:
+        self.listen = listen
+        self.serve = serve
+        self.cache = cache
+        self.received = Stats()
+        self.served = Stats()
+        self.stop = threading.Event()
+        self.ready = threading.Barrier(3)
+        self.threads = [
+                threading.Thread(target=self.receive, name="broker-recv",
+                                 daemon=True),
+                threading.Thread(target=self.send, name="broker-send",
+                                 daemon=True) ]
+
+    def start(self) -> None:
+        """ Start serving, returning once all addresses are listening.
+        """
+        for t in self.threads:
+            t.start()
+        self.ready.wait()
+
+    def close(self) -> None:
+        self.stop.set()
+        for t in self.threads:
+            t.join()
+
+    def __enter__(self) -> "Broker":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def receive(self) -> None:
+        with Pull0(recv_timeout=100) as pull:
+            try:
+                for addr in self.listen:
+                    pull.listen(addr)
+            except BaseException:
+                self.ready.abort() # start() raises BrokenBarrierError
+                raise
+            _logger.info("Broker: receiving at %s", ", ".join(self.listen))
+            self.ready.wait()
+            while not self.stop.is_set():
+                try:
+                    msg = pull.recv_msg()
+                except Timeout:
+                    continue
+                data = msg.bytes
+                sender = eos_sender(data)
+                if sender is not None:
+                    _logger.info("Broker: end of stream from %s", sender)
+                    if msg.pipe is not None:
+                        try:
+                            msg.pipe.close()
+                        except NNGException:
+                            pass
+                    continue
+                self.cache.put(data)
+                self.received.message(len(data))
+
+    def send(self) -> None:
+        try:
+            push = Push0(listen=self.serve, send_timeout=100)
+        except BaseException:
+            self.ready.abort()
+            raise
+        with push:
+            _logger.info("Broker: serving at %s", self.serve)
+            self.ready.wait()
+            msg = None
+            while not self.stop.is_set():
+                if msg is None:
+                    msg = self.cache.get(0.1)
+                    if msg is None:
+                        continue
+                try: # (blocks while no consumers are connected)
+                    push.send(msg)
+                except Timeout:
+                    continue
+                self.served.message(len(msg))
+                msg = None
+
+    def summary(self) -> str:
+        return f"received {self.received.count} messages," \
+               f" served {self.served.count}," \
+               f" cached {len(self.cache)}" \
+               f" ({self.cache.spill.count} spilled," \
+               f" {self.cache.dropped} dropped)"
+
+def lclstream_broker(
+        listen: Annotated[
+            str,
+            typer.Option("--listen", "-l", help="Address to receive pushed messages at. May be comma-separated, or a port range (tcp://host:5000-5015)."),
+        ],
+        serve: Annotated[
+            str,
+            typer.Option("--serve", "-s", help="Address consumers pull messages from (psana_pull --dial)."),
+        ],
+        memory_mb: Annotated[
+            int,
+            typer.Option("--memory_mb", help="Messages held in memory (MB) before spilling to disk."),
+        ] = 4096,
+        spill_dir: Annotated[
+            Optional[Path],
+            typer.Option("--spill_dir", help="Directory for spill files (default: a temporary directory)."),
+        ] = None,
+        segment_mb: Annotated[
+            int,
+            typer.Option("--segment_mb", help="Size of each spill file (MB)."),
+        ] = 256,
+        disk_gb: Annotated[
+            Optional[float],
+            typer.Option("--disk_gb", help="Limit on spilled messages (GB), past which the oldest messages are dropped."),
+        ] = None,
+        interval: Annotated[
+            float,
+            typer.Option("--interval", help="Seconds between status lines."),
+        ] = 10.0,
+    ):
+    disk_bytes = None if disk_gb is None else int(disk_gb*1024**3)
+    with tempfile.TemporaryDirectory(dir=spill_dir,
+                                     prefix="lclstream-spill-") as tmp:
+        cache = MessageCache(memory_mb*1024**2, Path(tmp),
+                             segment_mb*1024**2, disk_bytes)
+        try:
+            with Broker(port_range(listen), serve, cache) as broker:
+                print(f"Receiving at {listen}, serving at {serve}", flush=True)
+                while True:
+                    time.sleep(interval)
+                    print(f"Broker: {broker.summary()}", flush=True)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            cache.close()
+
+def run():
+    typer.run(lclstream_broker)
+
+if __name__ == "__main__":
+    run()
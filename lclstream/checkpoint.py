@@ -0,0 +1,146 @@
+""" Acknowledged transfers and their checkpoints.
+
+In acknowledged mode, psana_push seals every message in an
+envelope holding its sequence number (see messages.seal), and
+listens for acknowledgements (the 8-byte sequence numbers of
+processed messages) sent back by receivers.
+
+The checkpoint records how many of the rank's events,
+counting from the first, are covered by messages which have
+all been acknowledged.  A transfer can resume from there.
+"""
+
+from pathlib import Path
+from typing import Any, Dict, Set
+import struct
+import threading
+import time
+import logging
+_logger = logging.getLogger(__name__)
+
+from pynng import Pull0, Timeout # type: ignore[import-untyped]
+
+from .index_cache import load_json, save_json
+
+_ack = struct.Struct("<Q")
+
+def ack_message(seq : int) -> bytes:
+    return _ack.pack(seq)
+
+def read_ack(msg : bytes) -> int:
+    return _ack.unpack(msg)[0]
+
+def load_checkpoint(path : Path, key : Dict[str, Any]) -> int:
+    """ Return the number of events done in the checkpoint at path
+    (0 if there is none).
+
+    Raises ValueError if the checkpoint belongs to a different transfer.
+    """
+    ckpt = load_json(path)
+    if ckpt is None:
+        return 0
+    if ckpt.get('key') != key:
+        raise ValueError(f"Checkpoint {path} does not match this transfer.")
+    return int(ckpt['done'])
+
+class Checkpoint:
+    """ Track which messages have been acknowledged.
+
+    Params:
+        path: checkpoint file
+        key: identifies the transfer (saved with the checkpoint)
+        done: number of events already done (when resuming)
+        interval: minimum time (seconds) between checkpoint writes
+    """
+    def __init__(self, path : Path, key : Dict[str, Any],
+                 done : int = 0, interval : float = 1.0) -> None:
+        self.path = path
+        self.key = key
+        self.done = done
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.seq = 0  # next sequence number to assign
+        self.next = 0 # lowest unacknowledged sequence number
+        self.counts : Dict[int, int] = {} # events in unacknowledged messages
+        self.acked : Set[int] = set()
+        self.saved = time.monotonic()
+
+    def register(self, count : int) -> int:
+        """ Assign the next sequence number to a message
+        holding the next count events.
+        """
+        with self.cond:
+            seq = self.seq
+            self.seq += 1
+            self.counts[seq] = count
+            return seq
+
+    def ack(self, seq : int) -> None:
+        with self.cond:
+            if seq not in self.counts or seq in self.acked:
+                return # duplicate
+            self.acked.add(seq)
+            advanced = False
+            while self.next in self.acked:
+                self.acked.remove(self.next)
+                self.done += self.counts.pop(self.next)
+                self.next += 1
+                advanced = True
+            if advanced:
+                self.cond.notify_all()
+                if time.monotonic() - self.saved >= self.interval:
+                    self.save()
+
+    @property
+    def outstanding(self) -> int:
+        # number of messages not yet acknowledged
+        return self.seq - self.next
+
+    def save(self) -> None:
+        self.saved = time.monotonic()
+        save_json(self.path, {'key': self.key, 'done': self.done})
+
+    def wait(self, timeout : float) -> bool:
+        """ Wait for all messages to be acknowledged,
+        then save the checkpoint.
+
+        Returns False if some were not acknowledged within timeout.
+        """
+        with self.cond:
+            ok = self.cond.wait_for(lambda: self.outstanding == 0, timeout)
+            self.save()
+        return ok
+
+class AckListener:
+    """ Listen at addr for acknowledgements (in a background thread),
+    passing them to ckpt.
+    """
+    def __init__(self, addr : str, ckpt : Checkpoint) -> None:
+        self.ckpt = ckpt
+        self.stop = threading.Event()
+        self.pull = Pull0(listen=addr, recv_timeout=100)
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="acks")
+        self.thread.start()
+
+    def run(self) -> None:
+        while not self.stop.is_set():
+            try:
+                msg = self.pull.recv()
+            except Timeout:
+                continue
+            try:
+                self.ckpt.ack(read_ack(msg))
+            except struct.error:
+                _logger.warning("Ignoring invalid acknowledgement.")
+
+    def close(self) -> None:
+        self.stop.set()
+        self.thread.join()
+        self.pull.close()
+
+    def __enter__(self) -> "AckListener":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,121 @@
+""" Registry of compression codecs.
+
+Every codec provides hdf5 filter options (from hdf5plugin).
+A few codecs can also compress the payload of a binary frame.
+"""
+
+from collections.abc import Callable, Mapping, Sequence
+import time
+import zlib
+from typing import Any, Dict, NamedTuple, Tuple, Union
+
+import numpy as np
+import hdf5plugin # type: ignore[import-untyped]
+
+from .models import Codec, MessageFormat
+
+class CodecSpec(NamedTuple):
+    filter : Callable[[], Mapping[str, Any]] # hdf5 filter options
+    lossy  : bool
+    floats : bool # only accepts (32/64-bit) floats and ints
+
+_shuffle = hdf5plugin.Blosc.SHUFFLE
+_bitshuffle = hdf5plugin.Blosc.BITSHUFFLE
+
+registry : Dict[Codec, CodecSpec] = {
+    Codec.none: CodecSpec(dict, False, False),
+    Codec.gzip: CodecSpec(lambda: {'compression': 'gzip',
+                                   'compression_opts': 4},
+                          False, False),
+    Codec.zfp: CodecSpec(hdf5plugin.Zfp, True, True),
+    Codec.zfp_rate8: CodecSpec(lambda: hdf5plugin.Zfp(rate=8),
+                               True, True),
+    Codec.zfp_rate16: CodecSpec(lambda: hdf5plugin.Zfp(rate=16),
+                                True, True),
+    Codec.zfp_prec16: CodecSpec(lambda: hdf5plugin.Zfp(precision=16),
+                                True, True),
+    Codec.zfp_reversible: CodecSpec(lambda: hdf5plugin.Zfp(reversible=True),
+                                    False, True),
+    Codec.blosc_lz4: CodecSpec(
+                lambda: hdf5plugin.Blosc('lz4', 5, _shuffle),
+                False, False),
+    Codec.blosc_lz4_bitshuffle: CodecSpec(
+                lambda: hdf5plugin.Blosc('lz4', 5, _bitshuffle),
+                False, False),
+    Codec.blosc_zstd: CodecSpec(
+                lambda: hdf5plugin.Blosc('zstd', 5, _shuffle),
+                False, False),
+    Codec.blosc_zstd_bitshuffle: CodecSpec(
+                lambda: hdf5plugin.Blosc('zstd', 5, _bitshuffle),
+                False, False),
+    Codec.bitshuffle_lz4: CodecSpec(
+                lambda: hdf5plugin.Bitshuffle(cname='lz4'),
+                False, False),
+}
+
+BytesLike = Union[bytes, memoryview]
+
+# (compress, decompress) pairs usable for frame payloads
+frame_codecs : Dict[Codec, Tuple[Callable[[BytesLike], bytes],
+                                 Callable[[BytesLike], bytes]]] = {
+    Codec.gzip: (lambda buf: zlib.compress(buf, 4), zlib.decompress),
+}
+
+def codec_fits(format : MessageFormat, codec : Codec,
+               integers : bool = False) -> bool:
+    """ Can messages of this format be encoded with codec
+    (or Codec.auto, which selects among those that can)?
+
+    integers: the images are quantized (see reduce.py), so
+              codecs converting them to floats do not fit
+    """
+    if integers and codec in registry and registry[codec].floats:
+        return False
+    return format == MessageFormat.hdf5 or codec in frame_codecs \
+            or codec in (Codec.none, Codec.auto)
+
+_float_types = [np.dtype(t) for t in ('f4', 'f8', 'i4', 'i8')]
+
+def hdf5_dtype(codec : Codec, dtype : np.dtype) -> np.dtype:
+    """ Return the dtype an hdf5 dataset should use to store
+    dtype data with this codec.
+    """
+    dtype = np.dtype(dtype)
+    if codec not in registry:
+        raise ValueError(f"Codec {codec.value} must be resolved"
+                         " (see select_codec) before encoding.")
+    if registry[codec].floats and dtype not in _float_types:
+        return np.dtype('f4')
+    return dtype
+
+def select_codec(trial : Sequence[Any],
+                 writer : Callable[..., bytes],
+                 candidates : Sequence[Codec],
+                 link_mbps : float,
+                 workers : int = 1) -> Codec:
+    """ Choose the codec maximizing end-to-end throughput.
+
+    Each candidate encodes the trial batches with writer.
+    Encoding (spread over workers) and sending are pipelined,
+    so the slower of the two sets the rate.
+
+    Params:
+        trial: batches of images to encode
+        writer: writer(batch, codec=...) -> bytes
+        candidates: codecs to try
+        link_mbps: estimated link bandwidth (MB/sec)
+        workers: number of encoder processes
+    """
+    assert len(candidates) > 0
+    raw = sum(sum(img.nbytes for img in batch) for batch in trial)
+    best = candidates[0]
+    best_rate = 0.0
+    for codec in candidates:
+        t0 = time.perf_counter()
+        size = sum(len(writer(batch, codec=codec)) for batch in trial)
+        t_enc = (time.perf_counter() - t0) / max(workers, 1)
+        t_send = size / (link_mbps*1024**2)
+        rate = raw / max(t_enc, t_send, 1e-9)
+        if rate > best_rate:
+            best, best_rate = codec, rate
+    return best
@@ -0,0 +1,108 @@
+""" Persistent on-disk cache of per-run event times (and masks).
+
+Event times are stored as .npy files of (time, fiducial) records,
+which are memory-mapped when loaded.  The cache lives in
+$LCLSTREAM_CACHE (default ~/.cache/lclstream), and is shared
+by all processes (MPI ranks, server requests) on a filesystem.
+"""
+
+from collections.abc import Iterable
+from pathlib import Path
+from typing import Any, Dict, Optional
+import json
+import os
+import tempfile
+import logging
+_logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from .models import AccessMode
+
+time_dtype = np.dtype([('time', '<u8'), ('fiducial', '<u4')])
+
+def cache_dir() -> Path:
+    path = os.environ.get("LCLSTREAM_CACHE", None)
+    if path is None:
+        return Path.home() / ".cache" / "lclstream"
+    return Path(path)
+
+def index_path(exp : str, run : int, access_mode : AccessMode,
+               r : int = 0) -> Path:
+    """ Location of the event times of run r within
+    datasource exp={exp}:run={run}:{access_mode}.
+    """
+    return cache_dir() / f"{exp}-r{run:04d}-{access_mode.value}-{r}.npy"
+
+def mask_path(exp : str, run : int, detector_name : str) -> Path:
+    """ Location of the bad pixel mask of a detector in a run.
+    """
+    return cache_dir() / f"{exp}-r{run:04d}-{detector_name}-mask.npy"
+
+def checkpoint_path(exp : str, run : int, detector_name : str,
+                    mode : str, rank : int = 0) -> Path:
+    """ Location of the transfer checkpoint of an MPI rank.
+    """
+    return cache_dir() / f"{exp}-r{run:04d}-{detector_name}-{mode}-{rank}.ckpt.json"
+
+def to_records(times : Iterable[Any]) -> np.ndarray:
+    """ Convert a list of psana.EventTime into an array of records.
+    """
+    return np.fromiter(((t.time(), t.fiducial()) for t in times),
+                       dtype=time_dtype)
+
+def load_array(path : Path) -> Optional[np.ndarray]:
+    """ Memory-map a cached array (or return None if not cached).
+    """
+    try:
+        return np.load(path, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        if path.exists():
+            _logger.warning("Ignoring unreadable cache file %s - %s", path, e)
+        return None
+
+def load_times(path : Path) -> Optional[np.ndarray]:
+    """ Memory-map cached records (or return None if not cached).
+    """
+    recs = load_array(path)
+    if recs is None:
+        return None
+    if recs.dtype != time_dtype:
+        _logger.warning("Ignoring index %s with dtype %s", path, recs.dtype)
+        return None
+    return recs
+
+def save_array(path : Path, arr : np.ndarray) -> None:
+    """ Atomically store an array at path.
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, path)
+    except OSError as e:
+        _logger.warning("Unable to save cache file %s - %s", path, e)
+
+def load_json(path : Path) -> Optional[Dict[str, Any]]:
+    """ Load a cached JSON object (or return None if not cached).
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        if path.exists():
+            _logger.warning("Ignoring unreadable cache file %s - %s", path, e)
+        return None
+
+def save_json(path : Path, obj : Dict[str, Any]) -> None:
+    """ Atomically store a JSON object at path.
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        _logger.warning("Unable to save cache file %s - %s", path, e)
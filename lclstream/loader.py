@@ -0,0 +1,153 @@
+""" Consumer-side loader: turns a stream of messages
+into batches of images for training.
+
+    for batch in StreamLoader("tcp://0.0.0.0:5000", batch_size=64,
+                              workers=4, shuffle=1024):
+        train_step(torch.from_numpy(batch).pin_memory())
+
+Messages are decoded by a pool of worker processes,
+images are (optionally) shuffled and re-batched to batch_size,
+and up to prefetch batches are prepared ahead of the consumer.
+"""
+
+from collections.abc import Callable, Iterable, Iterator
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .messages import read_message
+from .reduce import dequantize
+from .nng import puller, fanin
+from .pool import imap, readahead
+
+def decode(msg : bytes, restore : bool = True
+          ) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """ Decode a message into (images, attrs).
+
+    Params:
+        restore: convert quantized images back to float32
+                 (see reduce.dequantize)
+    """
+    data, attrs = read_message(msg)
+    if restore:
+        data = dequantize(data, attrs)
+    return np.asarray(data), attrs
+
+def rebatch(arrays : Iterable[np.ndarray], batch_size : int,
+            shuffle : int = 0,
+            rng : Optional[np.random.Generator] = None,
+            drop_last : bool = False) -> Iterator[np.ndarray]:
+    """ Re-batch arrays of images (along their first axis)
+    into contiguous arrays of batch_size images.
+
+    Params:
+        shuffle: size of the shuffle buffer (in images).
+                 Each batch is drawn at random from the
+                 buffered images.  If 0, keep the input order.
+        rng: random generator used to shuffle
+        drop_last: do not yield a final, short batch
+    """
+    assert batch_size >= 1
+    if rng is None:
+        rng = np.random.default_rng()
+    buf : List[np.ndarray] = [] # individual images
+    capacity = max(shuffle, batch_size)
+
+    def take(n : int) -> np.ndarray:
+        if shuffle > 0:
+            idx = rng.choice(len(buf), n, replace=False)
+            # remove the chosen images, swapping in the last
+            imgs = [buf[i] for i in idx]
+            for i in sorted(idx, reverse=True):
+                buf[i] = buf[-1]
+                buf.pop()
+        else:
+            imgs = buf[:n]
+            del buf[:n]
+        out = np.empty((n,) + imgs[0].shape, dtype=imgs[0].dtype)
+        return np.stack(imgs, out=out)
+
+    for arr in arrays:
+        buf.extend(arr)
+        while len(buf) >= capacity:
+            yield take(batch_size)
+    while len(buf) >= batch_size:
+        yield take(batch_size)
+    if len(buf) > 0 and not drop_last:
+        yield take(len(buf))
+
+class StreamLoader:
+    """ Iterate over batches of images received from
+    psana_push (or any pusher of hdf5/frame messages).
+
+    Params:
+        addr: address to listen at (may hold comma-separated
+              addresses and port ranges, see nng.port_range),
+              or to dial if dial=True
+        batch_size: images per batch
+        workers: number of decoder processes (0 = decode inline)
+        shuffle: size of the shuffle buffer (images), 0 to keep order
+        prefetch: number of batches prepared ahead of the consumer
+        drop_last: do not yield a final, short batch
+        dial: dial addr (e.g. a broker) instead of listening
+        senders: number of senders to wait for (see nng.fanin)
+        seed: random seed for shuffling
+        ready: called once listening (see nng.fanin)
+        restore: convert quantized images (psana_push --quantize)
+                 back to float32, since the scale and offset
+                 may differ between messages
+
+    A bad pixel mask message (psana_push --ship_mask) is not
+    batched, but stored as the mask attribute.
+    """
+    def __init__(self, addr : str, batch_size : int,
+                 workers : int = 2,
+                 shuffle : int = 0,
+                 prefetch : int = 2,
+                 drop_last : bool = False,
+                 dial : bool = False,
+                 senders : Optional[int] = None,
+                 seed : Optional[int] = None,
+                 ready : Optional[Callable[[], None]] = None,
+                 restore : bool = True) -> None:
+        assert prefetch >= 0
+        self.addr = addr
+        self.batch_size = batch_size
+        self.workers = workers
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.drop_last = drop_last
+        self.dial = dial
+        self.senders = senders
+        self.ready = ready
+        self.restore = restore
+        self.rng = np.random.default_rng(seed)
+        self.mask : Optional[np.ndarray] = None
+        self.messages = 0
+        self.images = 0
+
+    def _images(self, decoded : Iterable[Tuple[np.ndarray, Dict[str, Any]]]
+               ) -> Iterator[np.ndarray]:
+        for data, attrs in decoded:
+            self.messages += 1
+            if attrs.get('kind') == 'mask':
+                self.mask = data[0]
+                continue
+            self.images += len(data)
+            yield data
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        if self.dial:
+            msgs = puller(self.addr, 1)
+        else:
+            msgs = fanin(self.addr, self.senders, ready=self.ready)
+        # (decoded order only matters when not shuffling)
+        decoded = imap(msgs, partial(decode, restore=self.restore),
+                       self.workers,
+                       ordered = self.shuffle == 0)
+        batches = rebatch(self._images(decoded), self.batch_size,
+                          self.shuffle, self.rng, self.drop_last)
+        if self.prefetch > 0:
+            return readahead(batches, self.prefetch)
+        return batches
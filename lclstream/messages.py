@@ -0,0 +1,313 @@
+""" Serialization of image batches into messages.
+
+Three message formats are supported:
+
+  * hdf5: an in-memory hdf5 file containing a 'data' dataset
+  * frame: a compact binary frame.  The frame layout is
+
+        b"LCLF" | header length (uint32, little-endian) | header | payload
+
+    where header is a utf-8 JSON object holding the batch
+    shape, dtype, codec and any extra attributes, padded with spaces
+    so that the payload starts on a 64-byte boundary.
+    The payload is the contiguous (C-order) batch buffer,
+    compressed with the codec (if not 'none').
+  * sparse: a frame (with magic b"LCLP") for photon-sparse data.
+    Frames with few pixels above a threshold keep only those
+    pixels; the others are stored dense.  The payload is
+
+        indices (uint32, padded to 8 bytes) | values | dense frames
+
+    where the header's 'counts' lists the number of stored
+    pixels of each frame (-1 for dense frames), in order.
+
+All formats record the codec used, so
+`read_message` detects the format and codec and returns the batch
+as a numpy array.
+
+In acknowledged mode, messages are sealed in an envelope,
+
+    b"LCLS" | sequence number (uint64) | first event (uint64) | event count (uint32) | message
+
+so that receivers can acknowledge them (see checkpoint.py).
+"""
+
+from io import BytesIO
+import json
+import struct
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import h5py # type: ignore[import-untyped]
+
+from .models import Codec
+from .compression import registry, frame_codecs, hdf5_dtype, BytesLike
+
+Tensor = np.ndarray # type alias
+Batch = Union[List[Tensor], Tensor]
+
+FRAME_MAGIC = b"LCLF"
+SPARSE_MAGIC = b"LCLP"
+HDF5_MAGIC = b"\x89HDF\r\n\x1a\n"
+SEAL_MAGIC = b"LCLS"
+FRAME_ALIGN = 64
+_prefix = struct.Struct("<4sI")
+_seal = struct.Struct("<4sQQI")
+
+def Hdf5FileWriter(ilist: Batch, codec : Codec = Codec.zfp,
+                   attrs : Optional[Dict[str, Any]] = None) -> bytes:
+    """ This creates an in-memory hdf5-format file.
+
+    Returns a serialized hdf5 (bytes)  containing several images.
+    Each image is stored as one chunk, compressed with codec.
+
+    Params:
+        ilist: list of image arrays, all the same shape
+        codec: compression codec
+        attrs: extra attributes to store on the dataset
+    """
+    if len(ilist) == 0:
+        return b'' # return h5py.File() with no dataset?
+    shape = ilist[0].shape
+    with BytesIO() as f:
+        with h5py.File(f, 'w') as fh:
+            dataset = fh.create_dataset(
+                'data',
+                shape = (len(ilist),) + shape,
+                dtype = hdf5_dtype(codec, ilist[0].dtype),
+                chunks = (1,) + shape,
+                **registry[codec].filter()
+            )
+            if attrs is not None:
+                dataset.attrs.update(attrs)
+            dataset.attrs['codec'] = codec.value
+            for idx, img in enumerate(ilist):
+                dataset[idx] = img
+
+        return f.getvalue()
+
+def FrameWriter(ilist: Batch, codec : Codec = Codec.none,
+                attrs : Optional[Dict[str, Any]] = None) -> bytes:
+    """ This creates a binary frame holding the batch.
+
+    Without compression, images are copied exactly once,
+    directly into the output message.
+
+    Params:
+        ilist: list of image arrays, all the same shape and dtype
+        codec: compression codec (none, or one of frame_codecs)
+        attrs: extra (JSON-serializable) header entries
+    """
+    if len(ilist) == 0:
+        return b''
+    if codec != Codec.none and codec not in frame_codecs:
+        raise ValueError(f"Codec {codec.value} is not available for frames.")
+    img0 = ilist[0]
+    header = dict(attrs or {})
+    header.update({
+        'shape': [len(ilist)] + list(img0.shape),
+        'dtype': img0.dtype.str,
+        'codec': codec.value,
+    })
+    buffers : List[Union[bytes, memoryview]] = [
+                np.ascontiguousarray(img).data.cast('B') for img in ilist]
+    if codec == Codec.none:
+        return b''.join([frame_header(header), *buffers])
+    compress = frame_codecs[codec][0]
+    return frame_header(header) + compress(b''.join(buffers))
+
+def frame_header(header : Dict[str, Any],
+                 magic : bytes = FRAME_MAGIC) -> bytes:
+    """ Serialize the header (including magic and length prefix).
+    """
+    hdr = json.dumps(header, separators=(',', ':')).encode()
+    pad = -(_prefix.size + len(hdr)) % FRAME_ALIGN
+    hdr += b' '*pad
+    return _prefix.pack(magic, len(hdr)) + hdr
+
+def read_frame_header(msg : BytesLike, magic : bytes = FRAME_MAGIC
+                     ) -> Tuple[Dict[str, Any], int]:
+    """ Return the header and the payload offset of a frame.
+    """
+    found, hlen = _prefix.unpack_from(msg)
+    if found != magic:
+        raise ValueError("Message is not a frame.")
+    off = _prefix.size + hlen
+    header = json.loads(bytes(msg[_prefix.size:off]))
+    return header, off
+
+def read_frame(msg : BytesLike) -> Tuple[Tensor, Dict[str, Any]]:
+    """ Decode a frame into an array and its header.
+
+    Uncompressed frames decode to a read-only view into msg.
+    """
+    header, off = read_frame_header(msg)
+    codec = Codec(header['codec'])
+    if codec != Codec.none:
+        decompress = frame_codecs[codec][1]
+        msg = decompress(memoryview(msg)[off:])
+        off = 0
+    shape = tuple(header['shape'])
+    dtype = np.dtype(header['dtype'])
+    count = int(np.prod(shape))
+    data = np.frombuffer(msg, dtype=dtype, count=count, offset=off)
+    return data.reshape(shape), header
+
+def SparseWriter(ilist: Batch, codec : Codec = Codec.none,
+                 attrs : Optional[Dict[str, Any]] = None,
+                 threshold : float = 0.0,
+                 max_occupancy : float = 0.1) -> bytes:
+    """ This creates a sparse frame holding the batch.
+
+    Params:
+        ilist: list of image arrays, all the same shape and dtype
+        codec: compression codec (none, or one of frame_codecs)
+        attrs: extra (JSON-serializable) header entries
+        threshold: keep pixels with values above threshold
+        max_occupancy: frames with a larger fraction of pixels
+                       above threshold are stored dense
+    """
+    if len(ilist) == 0:
+        return b''
+    if codec != Codec.none and codec not in frame_codecs:
+        raise ValueError(f"Codec {codec.value} is not available for frames.")
+    batch = ilist if isinstance(ilist, np.ndarray) else np.stack(ilist)
+    flat = batch.reshape(len(batch), -1)
+    above = flat > threshold
+    counts = np.count_nonzero(above, axis=1)
+    dense = counts > max_occupancy*flat.shape[1]
+    above[dense] = False
+    rows, cols = np.nonzero(above)
+    index = cols.astype(np.uint32)
+    index = np.concatenate([index, np.zeros(len(index) % 2, np.uint32)])
+
+    header = dict(attrs or {})
+    header.update({
+        'shape': list(batch.shape),
+        'dtype': batch.dtype.str,
+        'codec': codec.value,
+        'threshold': threshold,
+        'counts': np.where(dense, -1, counts).tolist(),
+    })
+    # (as uint8 views, since empty buffers cannot be cast)
+    buffers : List[Union[bytes, memoryview]] = [
+                np.ascontiguousarray(x).reshape(-1).view(np.uint8).data
+                for x in (index, flat[rows, cols], flat[dense])]
+    if codec == Codec.none:
+        return b''.join([frame_header(header, SPARSE_MAGIC), *buffers])
+    compress = frame_codecs[codec][0]
+    return frame_header(header, SPARSE_MAGIC) + compress(b''.join(buffers))
+
+class Sparse(NamedTuple):
+    """ A decoded sparse frame.  Frame i holds values[i]
+    at (flat) pixel indices[i] - or is dense[i] if that is not None.
+    """
+    shape : Tuple[int, ...] # batch shape
+    indices : List[Optional[Tensor]]
+    values : List[Optional[Tensor]]
+    dense : List[Optional[Tensor]]
+    attrs : Dict[str, Any]
+
+def read_sparse(msg : BytesLike) -> Sparse:
+    """ Decode a sparse frame (without densifying it).
+    """
+    header, off = read_frame_header(msg, SPARSE_MAGIC)
+    codec = Codec(header['codec'])
+    if codec != Codec.none:
+        decompress = frame_codecs[codec][1]
+        msg = decompress(memoryview(msg)[off:])
+        off = 0
+    shape = tuple(header['shape'])
+    dtype = np.dtype(header['dtype'])
+    counts = np.array(header['counts'], dtype=np.int64)
+    npix = int(np.prod(shape[1:]))
+    nsparse = int(counts[counts >= 0].sum())
+    ndense = int(np.count_nonzero(counts < 0))
+    index = np.frombuffer(msg, np.uint32, nsparse, off)
+    off += 4*(nsparse + nsparse % 2)
+    values = np.frombuffer(msg, dtype, nsparse, off)
+    off += dtype.itemsize*nsparse
+    dense = np.frombuffer(msg, dtype, ndense*npix, off).reshape(ndense, npix)
+
+    ends = np.cumsum(np.maximum(counts, 0))
+    out = Sparse(shape, [], [], [], header)
+    d = 0
+    for n, end in zip(counts, ends):
+        if n < 0:
+            out.indices.append(None)
+            out.values.append(None)
+            out.dense.append(dense[d].reshape(shape[1:]))
+            d += 1
+        else:
+            out.indices.append(index[end-n:end])
+            out.values.append(values[end-n:end])
+            out.dense.append(None)
+    return out
+
+def densify(sp : Sparse, fill : float = 0.0) -> Tensor:
+    """ Expand a Sparse batch into a (new) dense array,
+    with fill at the pixels not stored.
+    """
+    out = np.full(sp.shape, fill, dtype=sp.attrs['dtype'])
+    flat = out.reshape(len(out), -1)
+    for i, (idx, val, dense) in enumerate(zip(sp.indices, sp.values,
+                                              sp.dense)):
+        if dense is not None:
+            out[i] = dense
+        else:
+            flat[i, idx] = val
+    return out
+
+def read_hdf5(msg : BytesLike) -> Tuple[Tensor, Dict[str, Any]]:
+    """ Decode an in-memory hdf5 file into an array and its attributes.
+    """
+    with h5py.File(BytesIO(msg), 'r') as fh:
+        dataset = fh['data']
+        return dataset[()], dict(dataset.attrs)
+
+class Envelope(NamedTuple):
+    seq : int   # message sequence number
+    first : int # index of the first event in the message
+    events : int # number of events in the message
+
+def seal(msg : bytes, env : Envelope) -> bytes:
+    """ Prefix msg with its envelope.
+    """
+    return _seal.pack(SEAL_MAGIC, *env) + msg
+
+def unseal(msg : BytesLike) -> Tuple[Optional[Envelope], BytesLike]:
+    """ Split a message into its envelope (or None if not sealed)
+    and its contents (a view into msg).
+    """
+    if msg[:len(SEAL_MAGIC)] != SEAL_MAGIC:
+        return None, msg
+    magic, seq, first, events = _seal.unpack_from(msg)
+    return Envelope(seq, first, events), memoryview(msg)[_seal.size:]
+
+class Sealed:
+    """ Wrap a writer so that it encodes (envelope, batch)
+    pairs into sealed messages.
+
+    Picklable (so usable with pool_map) whenever writer is.
+    """
+    def __init__(self, writer : Callable[[Batch], bytes]) -> None:
+        self.writer = writer
+
+    def __call__(self, item : Tuple[Envelope, Batch]) -> bytes:
+        env, batch = item
+        return seal(self.writer(batch), env)
+
+def read_message(msg : BytesLike) -> Tuple[Tensor, Dict[str, Any]]:
+    """ Decode a message of any format (sealed or not).
+
+    Sparse frames are densified.
+    """
+    env, msg = unseal(msg)
+    if msg[:len(FRAME_MAGIC)] == FRAME_MAGIC:
+        return read_frame(msg)
+    if msg[:len(HDF5_MAGIC)] == HDF5_MAGIC:
+        return read_hdf5(msg)
+    if msg[:len(SPARSE_MAGIC)] == SPARSE_MAGIC:
+        sp = read_sparse(msg)
+        return densify(sp), sp.attrs
+    raise ValueError("Unrecognized message format.")
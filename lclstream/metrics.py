@@ -0,0 +1,150 @@
+""" Prometheus-style metrics for the server.
+
+Metrics are updated incrementally as transfers report progress,
+so rendering them (GET /metrics) is independent
+of the number of transfers ever run.
+"""
+
+from collections.abc import Sequence
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Histogram bucket upper bounds shared by psana_push and the server.
+size_buckets : List[float] = [float(4**k) for k in range(5, 16)] # 1 kB - 1 GB
+latency_buckets : List[float] = [1e-4 * 4**k for k in range(10)] # 0.1 ms - 26 s
+
+def bucket_counts(bounds : Sequence[float]) -> List[int]:
+    # Empty (non-cumulative) counts, including the +Inf bucket.
+    return [0]*(len(bounds)+1)
+
+def observe(counts : List[int], bounds : Sequence[float], x : float) -> None:
+    """ Add x to its (non-cumulative) bucket in counts.
+    """
+    counts[int(np.searchsorted(bounds, x))] += 1
+
+def _fmt_labels(labels : Labels, extra : str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    if len(parts) == 0:
+        return ""
+    return "{" + ",".join(parts) + "}"
+
+def _escape(v : str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _key(labels : Dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name : str, help : str) -> None:
+        self.name = name
+        self.help = help
+        self.values : Dict[Labels, float] = {}
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}",
+                f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        return self.header() + [
+                f"{self.name}{_fmt_labels(k)} {v}"
+                for k, v in self.values.items() ]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount : float = 1.0, **labels : str) -> None:
+        k = _key(labels)
+        self.values[k] = self.values.get(k, 0.0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value : float, **labels : str) -> None:
+        self.values[_key(labels)] = value
+
+    def remove(self, **labels : str) -> None:
+        self.values.pop(_key(labels), None)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name : str, help : str,
+                 bounds : Sequence[float]) -> None:
+        super().__init__(name, help)
+        self.bounds = list(bounds)
+        self.counts : Dict[Labels, np.ndarray] = {}
+
+    def add(self, counts : Sequence[int], total : float,
+            **labels : str) -> None:
+        """ Add a batch of observations, given their
+        (non-cumulative) bucket counts and their sum.
+        """
+        k = _key(labels)
+        if k not in self.counts:
+            self.counts[k] = np.zeros(len(self.bounds)+1, dtype=np.int64)
+            self.values[k] = 0.0
+        self.counts[k] += np.asarray(counts, dtype=np.int64)
+        self.values[k] += total
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for k, counts in self.counts.items():
+            cum = np.cumsum(counts)
+            les = [repr(b) for b in self.bounds] + ["+Inf"]
+            for le, c in zip(les, cum):
+                labels = _fmt_labels(k, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{labels} {c}")
+            lines.append(f"{self.name}_sum{_fmt_labels(k)} {self.values[k]}")
+            lines.append(f"{self.name}_count{_fmt_labels(k)} {cum[-1]}")
+        return lines
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics : List[Metric] = []
+
+    def add(self, m : Metric) -> Metric:
+        self.metrics.append(m)
+        return m
+
+    def render(self) -> str:
+        lines : List[str] = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+sent_bytes = Counter("lclstream_sent_bytes_total",
+                     "Bytes sent, by destination.")
+sent_messages = Counter("lclstream_sent_messages_total",
+                        "Messages sent, by destination.")
+sent_events = Counter("lclstream_sent_events_total",
+                      "Events read for sending, by destination.")
+encode_seconds = Counter("lclstream_encode_seconds_total",
+                         "Time spent encoding messages, by destination.")
+failures = Counter("lclstream_transfer_failures_total",
+                   "Failed transfers, by reason.")
+completed = Counter("lclstream_transfers_completed_total",
+                    "Transfers that completed successfully.")
+active = Gauge("lclstream_transfers_active",
+               "Transfers currently running.")
+queued = Gauge("lclstream_transfers_queued",
+               "Transfers waiting to start.")
+throughput = Gauge("lclstream_transfer_mbps",
+                   "Current throughput (MB/sec) of running transfers.")
+message_size = Histogram("lclstream_message_size_bytes",
+                         "Size of messages sent.", size_buckets)
+send_latency = Histogram("lclstream_send_latency_seconds",
+                         "Time taken to send each message.", latency_buckets)
+
+for m in [sent_bytes, sent_messages, sent_events, encode_seconds,
+          failures, completed, active, queued, throughput,
+          message_size, send_latency]:
+    registry.add(m)
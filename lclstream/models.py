@@ -1,5 +1,7 @@
 from enum import Enum
-from pydantic import BaseModel
+from typing import Optional, Union, List, Tuple
+
+from pydantic import BaseModel, field_validator, model_validator
 
 class ImageRetrievalMode(str, Enum):
     raw = "raw"
@@ -11,10 +13,135 @@ class AccessMode(str, Enum):
     idx = "idx"
     smd = "smd"
 
+class Partition(str, Enum):
+    block = "block"   # contiguous blocks of events per rank
+    stride = "stride" # events interleaved across ranks
+
+class MessageFormat(str, Enum):
+    hdf5 = "hdf5"
+    frame = "frame"
+    sparse = "sparse" # photon-sparse frames (see messages.SparseWriter)
+
+class Codec(str, Enum):
+    none = "none"
+    gzip = "gzip"
+    zfp = "zfp"
+    zfp_rate8 = "zfp_rate8"
+    zfp_rate16 = "zfp_rate16"
+    zfp_prec16 = "zfp_prec16"
+    zfp_reversible = "zfp_reversible"
+    blosc_lz4 = "blosc_lz4"
+    blosc_lz4_bitshuffle = "blosc_lz4_bitshuffle"
+    blosc_zstd = "blosc_zstd"
+    blosc_zstd_bitshuffle = "blosc_zstd_bitshuffle"
+    bitshuffle_lz4 = "bitshuffle_lz4"
+    auto = "auto"
+
+class Quantize(str, Enum):
+    uint8 = "uint8"
+    uint16 = "uint16"
+    int16 = "int16"
+
+def parse_events(spec : str) -> Union[slice, List[int]]:
+    """ Parse an event selection.
+
+    Accepts a slice, "start:stop[:step]" (any part may be empty),
+    or a comma-separated list of indices, "i,j,k".
+    """
+    if ":" in spec:
+        return _parse_slice(spec)
+    return [int(x) for x in spec.split(",") if x.strip()]
+
+def _parse_slice(spec : str) -> slice:
+    # "start:stop[:step]"
+    parts = [int(x) if x.strip() else None for x in spec.split(":")]
+    if len(parts) > 3:
+        raise ValueError(f"Invalid slice: {spec}")
+    return slice(*parts)
+
+def parse_roi(spec : str) -> Tuple[slice, ...]:
+    """ Parse a region of interest: comma-separated
+    slices "start:stop[:step]" of the trailing image axes
+    (applied to every panel), e.g. "0:256,128:384".
+    """
+    roi = []
+    for part in spec.split(","):
+        if ":" not in part:
+            raise ValueError(f"Invalid ROI slice: {part}")
+        roi.append(_parse_slice(part))
+    return tuple(roi)
+
+class Reduction(BaseModel):
+    roi          : Optional[str] = None # see parse_roi
+    bin          : int = 1 # sum NxN blocks of pixels
+    quantize     : Optional[Quantize] = None # integer type to store
+    scale        : Optional[float] = None # quantization step (None = fit each batch)
+    offset       : float = 0.0 # value of quantized 0 (if scale is set)
+
+    @field_validator('roi')
+    @classmethod
+    def _check_roi(cls, v : Optional[str]) -> Optional[str]:
+        if v is not None:
+            parse_roi(v)
+        return v
+
+    @property
+    def active(self) -> bool:
+        return self.roi is not None or self.bin > 1 \
+                or self.quantize is not None
+
 class DataRequest(BaseModel):
     exp          : str
     run          : int
     access_mode  : AccessMode
     detector_name: str
     mode         : ImageRetrievalMode #= ImageRetrievalMode.calib
-    addr         : str
+    addr         : Union[str, List[str]] # several addresses fan out
+    format       : MessageFormat = MessageFormat.hdf5
+    codec        : Optional[Codec] = None # default depends on format
+    events       : Optional[str] = None # see parse_events
+    priority     : int = 0 # higher priority transfers start first
+    ack_addr     : Optional[str] = None # acknowledged mode (see checkpoint.py)
+    resume       : bool = False # resume from the last checkpoint
+    target_mb    : Optional[float] = None # adaptive message size (see batching.py)
+    reduce       : Optional[Reduction] = None # applied before encoding (see reduce.py)
+    threshold    : Optional[float] = None # sparse format: keep pixels above this
+
+    @field_validator('events')
+    @classmethod
+    def _check_events(cls, v : Optional[str]) -> Optional[str]:
+        if v is not None:
+            parse_events(v)
+        return v
+
+    @model_validator(mode='after')
+    def _check_codec(self) -> "DataRequest":
+        from .compression import codec_fits # (imports this module)
+        if self.codec is None:
+            return self
+        if not codec_fits(self.format, self.codec):
+            raise ValueError(f"Codec {self.codec.value} is not available"
+                             f" for the {self.format.value} format.")
+        if self.reduce is not None and self.reduce.quantize is not None \
+                and not codec_fits(self.format, self.codec, integers=True):
+            raise ValueError(f"Codec {self.codec.value} would store"
+                             " quantized images as floats.")
+        return self
+
+    def destinations(self) -> List[str]:
+        # addr as a list (a str may hold comma-separated addresses)
+        if isinstance(self.addr, str):
+            return self.addr.split(",")
+        return list(self.addr)
+
+class TransferStats(BaseModel):
+    messages     : int = 0
+    bytes        : int = 0
+    events       : int = 0
+    elapsed      : float = 0.0 # seconds
+    mbps         : float = 0.0 # MB/sec
+    encode_seconds: float = 0.0 # total time spent encoding
+    send_seconds : float = 0.0 # total time spent in send
+    size_hist    : List[int] = [] # message sizes (see metrics.size_buckets)
+    send_hist    : List[int] = [] # send times (see metrics.latency_buckets)
+    final        : bool = False
@@ -1,20 +1,67 @@
-from collections.abc import Iterator
+from collections import deque
+from collections.abc import AsyncIterable, AsyncIterator, Iterator, \
+                            Iterable, Callable, Sequence
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple, Union
+import asyncio
+import re
+import threading
 import time
 import logging
 _logger = logging.getLogger(__name__)
 
 import stream
-from pynng import Push0, Pull0, Timeout, ConnectionRefused # type: ignore[import-untyped]
-
-clock0 = lambda: {'count': 0, 'size': 0, 'wait': 0, 'time': time.time()}
-def rate_clock(state, sz):
-    t = time.time()
-    return {
-        'count': state['count'] + 1,
-        'size': state['size'] + sz,
-        'wait': state['wait'] + t - state['time'],
-        'time': t
-    }
+from pynng import Push0, Pull0, Message, Timeout, TryAgain, ConnectionRefused # type: ignore[import-untyped]
+from pynng.exceptions import NNGException # type: ignore[import-untyped]
+
+from .pool import readahead
+
+def rank_addr(addr : str, rank : int) -> str:
+    """ Offset the port number of addr by rank.
+
+    e.g. rank_addr("tcp://10.0.0.1:5000", 3) == "tcp://10.0.0.1:5003"
+    """
+    base, port = addr.rsplit(":", 1)
+    return f"{base}:{int(port)+rank}"
+
+def port_range(addr : str) -> List[str]:
+    """ Expand comma-separated addresses and port ranges.
+
+    e.g. port_range("tcp://10.0.0.1:5000-5002")
+           == ["tcp://10.0.0.1:5000", "tcp://10.0.0.1:5001",
+               "tcp://10.0.0.1:5002"]
+    """
+    addrs : List[str] = []
+    for a in addr.split(","):
+        m = re.fullmatch(r"(.*):(\d+)-(\d+)", a)
+        if m is None:
+            addrs.append(a)
+        else:
+            base, lo, hi = m.group(1), int(m.group(2)), int(m.group(3))
+            addrs.extend(f"{base}:{port}" for port in range(lo, hi+1))
+    return addrs
+
+# A sender ends its stream with an end-of-stream (EOS) message,
+# holding its name, after which the receiver closes its pipe.
+# (Waiting for that close keeps the sender from closing its
+# socket, and dropping queued messages, too early.)
+EOS_MAGIC = b"LCLE"
+
+def eos_message(sender : str) -> bytes:
+    return EOS_MAGIC + sender.encode()
+
+def eos_sender(msg : bytes) -> Optional[str]:
+    """ Return the sender of an EOS message (or None for other messages).
+    """
+    if msg[:len(EOS_MAGIC)] != EOS_MAGIC:
+        return None
+    return bytes(msg[len(EOS_MAGIC):]).decode()
+
+def _end_stream(push : Push0, closed : threading.Event,
+                eos : str, timeout : float) -> None:
+    # send EOS and wait for the receiver to close the pipe
+    push.send(eos_message(eos))
+    if not closed.wait(timeout):
+        _logger.warning("Receiver did not close the stream from %s.", eos)
 
 send_opts : dict[str,int] = {
      #"send_buffer_size": 32 # send blocks if 32 messages queue up
@@ -22,15 +69,25 @@ send_opts : dict[str,int] = {
 recv_options = {"recv_timeout": 5000}
 
 @stream.stream
-def pusher(gen : Iterator[bytes], addr : str, ndial : int
+def pusher(gen : Iterator[bytes], addr : str, ndial : int,
+           observe : Optional[Callable[[int, float], None]] = None,
+           send_buffer_size : Optional[int] = None,
+           eos : Optional[str] = None,
+           eos_timeout : float = 30.0
           ) -> Iterator[int]:
     # transform messages sent into sizes sent
+    # observe(size, seconds) is called after each send
+    # eos: if set, end the stream with an EOS message from this sender
     assert ndial >= 0
     options = dict(send_opts)
+    if send_buffer_size is not None:
+        options["send_buffer_size"] = send_buffer_size
     if ndial == 0:
         options["listen"] = addr
     try:
         with Push0(**options) as push:
+            closed = threading.Event()
+            push.add_post_pipe_remove_cb(lambda pipe: closed.set())
             for dial in range(ndial):
                 push.dial(addr, block=True)
             if ndial > 0:
@@ -40,13 +97,180 @@ def pusher(gen : Iterator[bytes], addr : str, ndial : int
                 _logger.info("Listening on %s.", addr)
 
             for msg in gen:
-                push.send(msg)
+                if observe is None:
+                    push.send(msg)
+                else:
+                    t0 = time.perf_counter()
+                    push.send(msg)
+                    observe(len(msg), time.perf_counter() - t0)
                 yield len(msg)
+            if eos is not None:
+                _end_stream(push, closed, eos, eos_timeout)
     except ConnectionRefused as e:
         _logger.error("Unable to connect to %s - %s", addr, e)
 
+class Destination:
+    """ One receiver of a fanout: a Push0 socket sending,
+    from its own thread, the messages in its queue.
+
+    A message stays in the queue until sent, so that if the
+    receiver is lost (a send times out or fails),
+    its queued messages can be handed to other destinations.
+    The dial does not block, so a receiver has until the
+    first send times out to start listening.
+    """
+    def __init__(self, addr : str, fan : "Fanout") -> None:
+        self.addr = addr
+        self.fan = fan
+        self.queue : Deque[bytes] = deque()
+        self.alive = True
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name=f"fanout {addr}")
+
+    def _send(self, push : Push0, msg : bytes) -> None:
+        t0 = time.perf_counter()
+        push.send(msg)
+        dt = time.perf_counter() - t0
+        if self.fan.observe is not None:
+            with self.fan.cond:
+                self.fan.observe(len(msg), dt)
+
+    def run(self) -> None:
+        fan = self.fan
+        options = dict(send_opts)
+        options["send_timeout"] = fan.send_timeout
+        try:
+            with Push0(**options) as push:
+                closed = threading.Event()
+                push.add_post_pipe_remove_cb(lambda pipe: closed.set())
+                push.dial(self.addr, block=False)
+                _logger.info("Dialing %s - starting stream.", self.addr)
+                for msg in fan.prefix:
+                    self._send(push, msg)
+                while True:
+                    with fan.cond:
+                        while len(self.queue) == 0 and not fan.done:
+                            fan.cond.wait()
+                        finished = fan.done
+                        if not finished:
+                            msg = self.queue[0]
+                    if finished:
+                        if fan.eos is not None:
+                            _end_stream(push, closed, fan.eos, fan.eos_timeout)
+                        return
+                    self._send(push, msg)
+                    with fan.cond:
+                        self.queue.popleft()
+                        fan.cond.notify_all()
+        except Exception as e: # (Timeout, or any other NNGException)
+            _logger.error("Dropping destination %s - %s", self.addr, e)
+        with fan.cond:
+            self.alive = False
+            fan.pending.extend(self.queue)
+            self.queue.clear()
+            fan.cond.notify_all()
+
+class Fanout:
+    """ Distribute messages over several destinations.
+
+    Each message goes to the live destination with the shortest
+    queue, and queues hold at most `depth` messages, so a slow
+    receiver gets fewer messages instead of stalling the others.
+    When all queues are full, put() blocks.
+
+    Params:
+        addrs: destination addresses (dialed)
+        depth: maximum number of messages queued per destination
+        send_timeout: time (ms) after which a blocked send
+                      drops its destination
+        observe: called as observe(size, seconds) after each send
+        eos: if set, end each stream with an EOS message from this sender
+        prefix: messages sent to every destination, before any other
+    """
+    def __init__(self, addrs : Sequence[str], depth : int = 4,
+                 send_timeout : int = 30000,
+                 observe : Optional[Callable[[int, float], None]] = None,
+                 eos : Optional[str] = None,
+                 eos_timeout : float = 30.0,
+                 prefix : Sequence[bytes] = ()
+                ) -> None:
+        assert depth >= 1
+        self.depth = depth
+        self.prefix = prefix
+        self.eos = eos
+        self.eos_timeout = eos_timeout
+        self.send_timeout = send_timeout
+        self.observe = observe
+        self.cond = threading.Condition()
+        self.done = False # set when threads should exit
+        self.pending : Deque[bytes] = deque() # not yet assigned
+        self.dests = [Destination(addr, self) for addr in addrs]
+        for d in self.dests:
+            d.thread.start()
+
+    def _assign(self) -> None:
+        # Move pending messages into destination queues.
+        # Called with self.cond held.
+        while len(self.pending) > 0:
+            live = [d for d in self.dests if d.alive]
+            if len(live) == 0:
+                raise ConnectionError("All fanout destinations failed.")
+            d = min(live, key=lambda d: len(d.queue))
+            if len(d.queue) < self.depth:
+                d.queue.append(self.pending.popleft())
+                self.cond.notify_all()
+            else:
+                self.cond.wait()
+
+    def put(self, msg : bytes) -> None:
+        with self.cond:
+            self.pending.append(msg)
+            self._assign()
+
+    def close(self) -> None:
+        """ Wait for all queued messages to be sent.
+        """
+        with self.cond:
+            try:
+                while True:
+                    self._assign()
+                    if not any(d.alive and len(d.queue) > 0
+                               for d in self.dests):
+                        break
+                    self.cond.wait()
+            finally:
+                self.done = True
+                self.cond.notify_all()
+        for d in self.dests:
+            d.thread.join()
+
+@stream.stream
+def fanout_pusher(gen : Iterable[bytes], addrs : Sequence[str],
+                  observe : Optional[Callable[[int, float], None]] = None,
+                  depth : int = 4,
+                  send_timeout : int = 30000,
+                  eos : Optional[str] = None,
+                  prefix : Sequence[bytes] = ()
+                 ) -> Iterator[int]:
+    # transform messages queued into sizes queued
+    # (see Fanout for the parameters)
+    fan = Fanout(addrs, depth, send_timeout, observe, eos, prefix=prefix)
+    try:
+        for msg in gen:
+            fan.put(msg)
+            yield len(msg)
+    except BaseException:
+        with fan.cond: # abandon queued messages
+            fan.eos = None
+            fan.done = True
+            fan.cond.notify_all()
+        raise
+    fan.close()
+
 @stream.source
-def puller(addr : str, ndial : int) -> Iterator[bytes]:
+def puller(addr : str, ndial : int,
+           ready : Optional[Callable[[], None]] = None) -> Iterator[bytes]:
+    # ready() is called once the socket is listening (or connected)
     assert ndial >= 0
 
     done = 0
@@ -74,15 +298,242 @@ def puller(addr : str, ndial : int) -> Iterator[bytes]:
             else:
                 _logger.info("Connected to %s x %d - starting recv.",
                               addr, ndial)
+            if ready is not None:
+                ready()
 
             while started == 0 or (done != started):
                 try:
-                    msg = pull.recv()
-                    yield msg
+                    msg = pull.recv_msg()
                 except Timeout:
                     if started:
                         _logger.debug("Pull: slow input")
+                    continue
+                data = msg.bytes
+                sender = eos_sender(data)
+                if sender is None:
+                    yield data
+                else:
+                    _logger.info("Pull: end of stream from %s", sender)
+                    _close_pipe(msg)
+
+    except ConnectionRefused as e:
+        _logger.error("Unable to connect to %s - %s", addr, e)
+
+def _close_pipe(msg : Message) -> None:
+    # close the pipe msg arrived on (if it is still open)
+    if msg.pipe is None:
+        return
+    try:
+        msg.pipe.close()
+    except NNGException:
+        pass
+
+def _fanin(addrs : Sequence[str], senders : Optional[int],
+           ready : Optional[Callable[[], None]]) -> Iterator[bytes]:
+    started = 0
+    done = 0
+    def show_open(pipe):
+        nonlocal started
+        started += 1
+    def show_close(pipe):
+        nonlocal done
+        done += 1
+
+    finished : Set[str] = set()
+    def complete() -> bool:
+        if senders is not None:
+            return len(finished) >= senders
+        return started > 0 and done == started
+
+    with Pull0(**recv_options) as pull:
+        pull.add_post_pipe_connect_cb(show_open)
+        pull.add_post_pipe_remove_cb(show_close)
+        for addr in addrs:
+            pull.listen(addr)
+        _logger.info("Fan-in: listening on %s", ", ".join(addrs))
+        if ready is not None:
+            ready()
 
+        draining = False # take the messages already queued, then stop
+        while True:
+            if not draining and complete():
+                draining = True
+            try:
+                msg = pull.recv_msg(block = not draining)
+            except Timeout:
+                continue
+            except TryAgain:
+                break
+            data = msg.bytes
+            sender = eos_sender(data)
+            if sender is None:
+                yield data
+                continue
+            finished.add(sender)
+            _close_pipe(msg)
+            _logger.info("Fan-in: end of stream from %s (%d finished)",
+                         sender, len(finished))
+
+@stream.source
+def fanin(addrs : Union[str, Sequence[str]],
+          senders : Optional[int] = None,
+          depth : int = 0,
+          ready : Optional[Callable[[], None]] = None) -> Iterator[bytes]:
+    """ Receive messages from many senders, listening at
+    one or more addresses.
+
+    Params:
+        addrs: addresses to listen at (a str may hold
+               comma-separated addresses and port ranges,
+               see port_range)
+        senders: number of senders - stop after an EOS
+                 message from each.  If None, stop once
+                 all connected senders have disconnected.
+        depth: if > 0, receive from a background thread,
+               queueing up to depth messages for the consumer
+        ready: called once listening
+    """
+    if isinstance(addrs, str):
+        addrs = port_range(addrs)
+    msgs = _fanin(addrs, senders, ready)
+    if depth > 0:
+        yield from readahead(msgs, depth)
+    else:
+        yield from msgs
+
+async def _aiter(gen : Union[Iterable[bytes], AsyncIterable[bytes]]
+                ) -> AsyncIterator[bytes]:
+    if isinstance(gen, AsyncIterable):
+        async for x in gen:
+            yield x
+    else:
+        for x in gen:
+            yield x
+
+async def apusher(gen : Union[Iterable[bytes], AsyncIterable[bytes]],
+                  addr : str, ndial : int = 1,
+                  inflight : int = 4,
+                  observe : Optional[Callable[[int, float], None]] = None,
+                  eos : Optional[str] = None,
+                  eos_timeout : float = 30.0
+                 ) -> AsyncIterator[int]:
+    """ Async version of pusher, keeping up to inflight
+    sends outstanding.  Yields the size of each message
+    once its send completes (in order).
+
+    Params:
+        gen: messages to send (an iterable or async iterable)
+        observe: called as observe(size, seconds) after each send
+        eos: if set, end the stream with an EOS message from this sender
+    """
+    assert ndial >= 0
+    assert inflight >= 1
+    options : Dict[str, Any] = dict(send_opts)
+    if ndial == 0:
+        options["listen"] = addr
+    pending : Deque[Tuple[int, float, asyncio.Future]] = deque()
+    async def complete() -> int:
+        size, t0, fut = pending.popleft()
+        await fut
+        if observe is not None:
+            observe(size, time.perf_counter() - t0)
+        return size
+
+    loop = asyncio.get_running_loop()
+    closed = asyncio.Event()
+    try:
+        with Push0(**options) as push:
+            push.add_post_pipe_remove_cb(
+                    lambda pipe: loop.call_soon_threadsafe(closed.set))
+            for dial in range(ndial):
+                push.dial(addr, block=True)
+            try:
+                async for msg in _aiter(gen):
+                    pending.append((len(msg), time.perf_counter(),
+                                    asyncio.ensure_future(push.asend(msg))))
+                    if len(pending) >= inflight:
+                        yield await complete()
+                while len(pending) > 0:
+                    yield await complete()
+                if eos is not None:
+                    await push.asend(eos_message(eos))
+                    try:
+                        await asyncio.wait_for(closed.wait(), eos_timeout)
+                    except asyncio.TimeoutError:
+                        _logger.warning("Receiver did not close the stream from %s.", eos)
+            finally:
+                for size, t0, fut in pending:
+                    fut.cancel()
+    except ConnectionRefused as e:
+        _logger.error("Unable to connect to %s - %s", addr, e)
+
+async def apuller(addr : str, ndial : int = 0,
+                  inflight : int = 4,
+                  drain : float = 0.1) -> AsyncIterator[bytes]:
+    """ Async version of puller, keeping up to inflight
+    receives outstanding.
+
+    Like puller, stops once all connected senders have closed
+    (after waiting `drain` seconds for messages still queued).
+    """
+    assert ndial >= 0
+    assert inflight >= 1
+    loop = asyncio.get_running_loop()
+    closed = asyncio.Event()
+    started = 0
+    done = 0
+    # pipe callbacks run on nng threads
+    def show_open(pipe):
+        nonlocal started
+        _logger.info("Pull: pipe opened")
+        started += 1
+    def show_close(pipe):
+        nonlocal done
+        _logger.info("Pull: pipe closed")
+        done += 1
+        if done == started:
+            loop.call_soon_threadsafe(closed.set)
+
+    options = {}
+    if ndial == 0:
+        options["listen"] = addr
+    try:
+        with Pull0(**options) as pull:
+            pull.add_post_pipe_connect_cb(show_open)
+            pull.add_post_pipe_remove_cb(show_close)
+            for dial in range(ndial):
+                pull.dial(addr, block=True)
+            pending : Deque[asyncio.Future] = deque(
+                    asyncio.ensure_future(pull.arecv_msg())
+                    for i in range(inflight))
+            try:
+                while True:
+                    head = pending[0]
+                    if not closed.is_set():
+                        wait = asyncio.ensure_future(closed.wait())
+                        await asyncio.wait([head, wait],
+                                           return_when=asyncio.FIRST_COMPLETED)
+                        wait.cancel()
+                    if not head.done(): # all senders closed
+                        await asyncio.wait([head], timeout=drain)
+                        if not head.done():
+                            if done == started:
+                                break
+                            closed.clear() # a new sender connected
+                            continue
+                    pending.popleft()
+                    pending.append(asyncio.ensure_future(pull.arecv_msg()))
+                    msg = head.result()
+                    data = msg.bytes
+                    sender = eos_sender(data)
+                    if sender is None:
+                        yield data
+                    else:
+                        _logger.info("Pull: end of stream from %s", sender)
+                        _close_pipe(msg)
+            finally:
+                for fut in pending:
+                    fut.cancel()
     except ConnectionRefused as e:
         _logger.error("Unable to connect to %s - %s", addr, e)
 
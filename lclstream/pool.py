@@ -0,0 +1,139 @@
+from collections import deque
+from collections.abc import Iterable, Iterator, Callable
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, \
+                               ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Optional, Set, Deque, Tuple
+import multiprocessing
+import queue
+import threading
+import time
+
+import stream
+
+_spawn = multiprocessing.get_context("spawn")
+
+def imap(gen : Iterable[Any],
+         fn : Callable[[Any], Any],
+         workers : int,
+         ordered : bool = True,
+         depth : Optional[int] = None,
+         threads : bool = False,
+         initializer : Optional[Callable[..., None]] = None,
+         initargs : Tuple[Any, ...] = ()
+        ) -> Iterator[Any]:
+    """ Apply fn to every item of gen using a pool of workers.
+
+    Params:
+        fn: function to apply (must be picklable unless threads=True)
+        workers: number of worker processes (or threads).
+                 If workers < 1, fn is applied inline (no pool).
+        ordered: yield results in input order
+                 (otherwise yield them as soon as they complete)
+        depth: maximum number of items in-flight (default 2*workers)
+        threads: use a thread pool instead of a process pool
+        initializer: called as initializer(*initargs) in each worker
+    """
+    if workers < 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, gen)
+        return
+    if depth is None:
+        depth = 2*workers
+    assert depth >= 1
+
+    pool : Executor
+    if threads:
+        pool = ThreadPoolExecutor(workers, initializer=initializer,
+                                  initargs=initargs)
+    else:
+        # Workers are spawned, since forking a process running
+        # nng threads (or holding nng sockets) is not safe.
+        pool = ProcessPoolExecutor(workers, mp_context=_spawn,
+                                   initializer=initializer,
+                                   initargs=initargs)
+
+    with pool:
+        if ordered:
+            fifo : Deque[Future] = deque()
+            for item in gen:
+                fifo.append(pool.submit(fn, item))
+                if len(fifo) >= depth:
+                    yield fifo.popleft().result()
+            while len(fifo) > 0:
+                yield fifo.popleft().result()
+        else:
+            pending : Set[Future] = set()
+            for item in gen:
+                pending.add(pool.submit(fn, item))
+                if len(pending) >= depth:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        yield fut.result()
+            for fut in _as_done(pending):
+                yield fut.result()
+
+# stream stage: messages >> pool_map(fn, workers)
+pool_map = stream.stream(imap)
+
+def _as_done(pending : Set[Future]) -> Iterator[Future]:
+    while len(pending) > 0:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        yield from done
+
+class Timed:
+    """ Wrap fn so that it returns (fn(x), seconds taken).
+
+    Picklable (so usable with pool_map) whenever fn is.
+    """
+    def __init__(self, fn : Callable[[Any], Any]) -> None:
+        self.fn = fn
+
+    def __call__(self, x : Any) -> Tuple[Any, float]:
+        t0 = time.perf_counter()
+        ans = self.fn(x)
+        return ans, time.perf_counter() - t0
+
+class _Raise:
+    def __init__(self, err : BaseException) -> None:
+        self.err = err
+
+def readahead(gen : Iterable[Any], depth : int) -> Iterator[Any]:
+    """ Iterate over gen from a background thread,
+    keeping up to depth items ready ahead of the consumer.
+    """
+    assert depth >= 1
+    buf : queue.Queue = queue.Queue(depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buf.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fill() -> None:
+        try:
+            for item in gen:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_Raise(e))
+        put(end)
+
+    thread = threading.Thread(target=fill, name="readahead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buf.get()
+            if item is end:
+                break
+            if isinstance(item, _Raise):
+                raise item.err
+            yield item
+    finally:
+        stop.set()
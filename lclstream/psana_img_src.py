@@ -1,12 +1,27 @@
-from collections.abc import Iterable
-from typing import Union, Optional, Tuple
+from collections.abc import Iterable, Iterator, Sequence, Callable
+from itertools import islice
+from typing import Any, Dict, Union, Optional, Tuple
 
 import numpy as np
 
-from .psana_stub import DataSource, MPIDataSource, Detector
-from .models import AccessMode, ImageRetrievalMode
+from .psana_stub import DataSource, MPIDataSource, Detector, EventTime
+from .models import AccessMode, ImageRetrievalMode, Partition
+from .pool import imap, readahead
+from .index_cache import index_path, mask_path, load_times, \
+                          load_array, save_array, to_records
 
 EventImage = np.ndarray
+# events may be selected by a slice or an array of indices
+Selection = Union[slice, Sequence[int], np.ndarray]
+
+def shard(n : int, rank : int, procs : int,
+          partition : Partition = Partition.block) -> range:
+    """ Return the indices (out of n) assigned to rank.
+    """
+    assert 0 <= rank < procs
+    if partition == Partition.stride:
+        return range(rank, n, procs)
+    return range(n*rank//procs, n*(rank+1)//procs)
 
 class PsanaImgSrc:
     """
@@ -14,15 +29,19 @@ class PsanaImgSrc:
     management system psana in LCLS (idx access mode)
     """
 
-    def __init__(self, exp, run, access_mode : AccessMode, detector_name) -> None:
+    def __init__(self, exp, run, access_mode : AccessMode, detector_name,
+                 index_cache : bool = True) -> None:
         # Boilerplate code to access an image
         # Set up data source
+        self.args = (exp, run, access_mode, detector_name)
         self.access_mode = access_mode
         self.datasource_id = f"exp={exp}:run={run}:{access_mode.value}"
+        self.index_cache = index_cache
         self._runs : Optional[list] = None
         # list of psana.Run
-        self.run_times : dict[int,list] = {}
-        # list of psana.EventTime
+        self._mask : Optional[np.ndarray] = None
+        self.run_times : dict[int,np.ndarray] = {}
+        # array of (time, fiducial) records (see index_cache)
 
         if self.access_mode == AccessMode.idx:
             self.datasource = DataSource(self.datasource_id )
@@ -35,31 +54,70 @@ class PsanaImgSrc:
                                  self.datasource.env())
 
         # Set image reading mode
-        self.read = { ImageRetrievalMode.raw   : self.detector.raw,
+        self.read : Dict[ImageRetrievalMode, Callable[..., Any]] = {
+                      ImageRetrievalMode.raw   : self.detector.raw,
                       ImageRetrievalMode.calib : self.detector.calib,
                       ImageRetrievalMode.image : self.detector.image,
                       ImageRetrievalMode.mask  : self.detector.mask, }
 
     def __call__(self,
                  mode : ImageRetrievalMode,
-                 id_panel : Optional[int] = None) -> Iterable[EventImage]:
-        # Only these modes are supported...
-        assert mode in (ImageRetrievalMode.raw,
-                        ImageRetrievalMode.calib,
-                        ImageRetrievalMode.image), \
-                f"Mode {mode.value} is not allowed!!!  Only 'raw', 'calib' and 'image' are supported."
+                 id_panel : Optional[int] = None,
+                 rank : int = 0,
+                 procs : int = 1,
+                 partition : Partition = Partition.block,
+                 events : Optional[Selection] = None,
+                 prefetch : int = 0,
+                 readers : int = 1,
+                 processes : bool = False,
+                 start : int = 0
+                ) -> Iterable[EventImage]:
+        """ Iterate over images.
 
-        read = self.read[mode]
-        if id_panel is not None:
-            read = lambda evt: self.read[mode](evt)[id_panel]
+        In idx mode, only the selected events (default all)
+        assigned to rank (out of procs) are read.
+        In smd mode, MPIDataSource distributes events
+        among MPI ranks itself, and events cannot be selected.
+
+        If prefetch > 0, up to prefetch images are read ahead
+        of the consumer by background threads.  In idx mode,
+        events are read by `readers` threads (or processes,
+        each opening its own datasource, if processes=True).
+
+        The first `start` events of this rank are skipped
+        (without reading their images), e.g. to resume a transfer.
+        """
+        read = self.reader(mode, id_panel)
 
         # MPIDataSource (but not DataSource) provides small_data
         #smldata = self.datasource.small_data('my.h5')
+        g : Iterator[Any]
         if self.access_mode == AccessMode.idx:
             #g = self.runs[0].events()
-            g = map(self.event, range(len(self)))
+            idx = self.select(events)
+            part = shard(len(idx), rank, procs, partition)
+            idx = idx[part.start:part.stop:part.step][start:]
+            if prefetch > 0:
+                if processes:
+                    yield from imap(idx, _read_index, readers,
+                                    depth = prefetch,
+                                    initializer = _open_reader,
+                                    initargs = (self.args, mode, id_panel))
+                else:
+                    run = self.runs[0]
+                    yield from imap(self.times(0)[idx],
+                                    lambda t: read(_event(run, t)),
+                                    readers, depth=prefetch, threads=True)
+                return
+            run = self.runs[0]
+            g = (_event(run, t) for t in self.times(0)[idx])
         else:
-            g = self.datasource.events()
+            if events is not None:
+                raise ValueError("Selecting events requires idx access mode.")
+            g = islice(self.datasource.events(), start, None)
+            if prefetch > 0:
+                yield from readahead(map(read, g), prefetch)
+                return
 
         for evt in g:
             # assembling a multi-panel image:
@@ -68,6 +126,28 @@ class PsanaImgSrc:
             #smldata.append( cspad_mean = f(data) )
             yield data
 
+    def reader(self, mode : ImageRetrievalMode,
+               id_panel : Optional[int] = None
+              ) -> Callable[[Any], EventImage]:
+        """ Return the function reading an image from an event.
+
+        The mask mode reads calib images.  The bad pixel mask
+        (see bad_pixel_mask) should be applied to them in batches.
+        """
+        # Only these modes are supported...
+        assert mode in (ImageRetrievalMode.raw,
+                        ImageRetrievalMode.calib,
+                        ImageRetrievalMode.image,
+                        ImageRetrievalMode.mask), \
+                f"Mode {mode.value} is not allowed!!!  Only 'raw', 'calib', 'image' and 'mask' are supported."
+        if mode == ImageRetrievalMode.mask:
+            mode = ImageRetrievalMode.calib
+
+        read = self.read[mode]
+        if id_panel is not None:
+            read = lambda evt: self.read[mode](evt)[id_panel]
+        return read
+
     @property
     def runs(self) -> list:
         assert self.access_mode == AccessMode.idx
@@ -75,31 +155,110 @@ class PsanaImgSrc:
             self._runs = list(self.datasource.runs())
         return self._runs
 
-    def event(self, idx : Union[int,Tuple[int,int]]):
-        # TODO: allow slicing when, e.g. idx = slice(start,stop)
+    def times(self, r : int = 0) -> np.ndarray:
+        """ Return the (cached) array of event times in run r.
+
+        Times are loaded from the on-disk index cache
+        when available, and stored there otherwise.
+        """
+        if r in self.run_times:
+            return self.run_times[r]
+
+        recs = None
+        if self.index_cache:
+            path = index_path(*self.args[:3], r)
+            recs = load_times(path)
+        if recs is None:
+            recs = to_records(self.runs[r].times())
+            if self.index_cache:
+                save_array(path, recs)
+        self.run_times[r] = recs
+        return recs
+
+    def select(self, events : Optional[Selection] = None,
+               r : int = 0) -> np.ndarray:
+        """ Return the array of event indices in run r
+        selected by events (default all).
+        """
+        n = len(self.times(r))
+        if events is None:
+            return np.arange(n)
+        if isinstance(events, slice):
+            return np.arange(n)[events]
+        idx = np.asarray(events, dtype=int)
+        if np.any((idx < -n) | (idx >= n)):
+            raise IndexError(f"Event index out of range (run has {n} events).")
+        return idx % n if n > 0 else idx
+
+    def event(self, idx : Union[int, Selection,
+                                Tuple[int, Union[int, Selection]]]):
+        """ Look up an event by index, or a list of events
+        by a slice or an array of indices.
+
+        The index may be prefixed by the run number
+        (within this datasource), e.g. event((0, slice(10, 20))).
+        """
         if isinstance(idx, tuple):
             r, i = idx
         else:
             r = 0
             i = idx
-        if r not in self.run_times:
-            self.run_times[r] = self.runs[r].times()
+        run = self.runs[r]
+        if isinstance(i, (int, np.integer)):
+            return _event(run, self.times(r)[i])
+        return [_event(run, t) for t in self.times(r)[self.select(i, r)]]
 
-        t = self.run_times[r][i]
-        return self.runs[r].event(t)
-    
     def __len__(self):
         assert self.access_mode == AccessMode.idx
-        if 0 not in self.run_times:
-            self.run_times[0] = self.runs[0].times()
-        return len(self.run_times[0])
-
-    def create_bad_pixel_mask(self):
-        return self.read["mask"](self.run_current, calib       = True,
-                                                   status      = True,
-                                                   edges       = True,
-                                                   central     = True,
-                                                   unbond      = True,
-                                                   unbondnbrs  = True,
-                                                   unbondnbrs8 = False).astype(np.uint16)
+        return len(self.times(0))
+
+    def create_bad_pixel_mask(self) -> np.ndarray:
+        run = self.args[1]
+        return self.read[ImageRetrievalMode.mask](
+                                      run,  calib       = True,
+                                            status      = True,
+                                            edges       = True,
+                                            central     = True,
+                                            unbond      = True,
+                                            unbondnbrs  = True,
+                                            unbondnbrs8 = False).astype(np.uint16)
+
+    def bad_pixel_mask(self, id_panel : Optional[int] = None) -> np.ndarray:
+        """ Return the bad pixel mask of this run (1 = good, 0 = bad).
+
+        The mask is computed once, then cached in memory
+        and in the on-disk cache.
+        """
+        if self._mask is None:
+            mask = None
+            if self.index_cache:
+                path = mask_path(self.args[0], self.args[1], self.args[3])
+                mask = load_array(path)
+            if mask is None:
+                mask = self.create_bad_pixel_mask()
+                if self.index_cache:
+                    save_array(path, mask)
+            self._mask = mask
+        if id_panel is not None:
+            return self._mask[id_panel]
+        return self._mask
+
+
+def _event(run, rec : np.void):
+    # look up the event for a (time, fiducial) record
+    return run.event(EventTime(int(rec['time']), int(rec['fiducial'])))
+
+# State of prefetch worker processes (see PsanaImgSrc.__call__).
+_reader : Optional[Tuple[PsanaImgSrc, Callable[[Any], EventImage]]] = None
+
+def _open_reader(args : Tuple[Any, ...],
+                 mode : ImageRetrievalMode,
+                 id_panel : Optional[int]) -> None:
+    global _reader
+    ps = PsanaImgSrc(*args)
+    _reader = (ps, ps.reader(mode, id_panel))
 
+def _read_index(i : int) -> EventImage:
+    assert _reader is not None
+    ps, read = _reader
+    return read(ps.event(int(i)))
@@ -1,48 +1,102 @@
 #!/usr/bin/env python3
 
-import time
-from typing import Annotated, Iterable, Optional
+from collections import deque
+from typing import Annotated, Deque, Iterable, Optional
 #from asyncio import run as aiorun
 
 import stream
-from pynng import Pull0, Timeout # type: ignore[import-untyped]
+from pynng import Push0 # type: ignore[import-untyped]
 import typer
 
-from .nng import puller, rate_clock, clock0
+from .nng import puller, fanin
+from .messages import read_message, unseal, Envelope
+from .checkpoint import ack_message
+from .archive import archive_writer
+from .stats import Stats, timed
 
 
 def psana_pull(
         listen: Annotated[
             Optional[str],
-            typer.Option("--listen", "-l", help="Address to listen at (URL format)."),
+            typer.Option("--listen", "-l", help="Address to listen at (URL format). May be comma-separated, or a port range (tcp://host:5000-5015)."),
+        ] = None,
+        senders: Annotated[
+            Optional[int],
+            typer.Option("--senders", help="Number of senders (using --eos) - stop after each has ended its stream."),
         ] = None,
         dial: Annotated[
             Optional[str],
             typer.Option("--dial", "-d", help="Address to dial (URL format)."),
         ] = None,
+        decode: Annotated[
+            bool,
+            typer.Option("--decode", help="Decode messages and report the decoded size."),
+        ] = False,
+        archive: Annotated[
+            Optional[str],
+            typer.Option("--archive", help="Append received images to rolling hdf5 files with this name prefix."),
+        ] = None,
+        max_file_mb: Annotated[
+            int,
+            typer.Option("--max_file_mb", help="Size limit (MB) of each archive file."),
+        ] = 4096,
+        ack: Annotated[
+            Optional[str],
+            typer.Option("--ack", help="Acknowledge sealed messages (once processed) to this address (dialed)."),
+        ] = None,
+        stats_json: Annotated[
+            Optional[str],
+            typer.Option("--stats_json", help="Write per-stage timing statistics to this JSON file at exit."),
+        ] = None,
     ):
 
     assert (dial is not None) or (listen is not None), "Need an address."
-    ndial = 0
     if listen is None:
-        ndial = 1 # need to dial
-        addr = dial
+        messages = puller(dial, 1)
     else:
-        addr = listen
-
-    # TODO: send to file_writer or something instead of len
-    clock = stream.fold(rate_clock, clock0())
-    stats = puller(addr, ndial) >> stream.map(len) >> clock
-    # TODO: update tqdm progress meter
-    for items in stats >> stream.item[1::10]:
-        #print(items)
-        print(f"At {items['count']}, {items['wait']} seconds: {items['size']/items['wait']/1024**2} MB/sec.")
+        messages = fanin(listen, senders)
+
+    stats = Stats(('recv', 'process'))
+    def count(size : int) -> int:
+        stats.message(size)
+        return size
+
+    if archive is not None:
+        measure = archive_writer(archive, max_file_mb*1024**2)
+    elif decode:
+        measure = stream.map(lambda msg: read_message(msg)[0].nbytes)
+    else:
+        measure = stream.map(len)
+    # envelopes of messages being processed
+    envs : Deque[Optional[Envelope]] = deque()
+    def opened(msg : bytes) -> bytes:
+        envs.append(unseal(msg)[0])
+        return msg
+    def acked(size : int) -> int:
+        env = envs.popleft()
+        if env is not None and acks is not None:
+            acks.send(ack_message(env.seq))
+        return size
+
+    sizes = messages >> timed(stats, 'recv') \
+                     >> stream.map(opened) \
+                     >> measure >> timed(stats, 'process') \
+                     >> stream.map(acked) >> stream.map(count)
+    acks = None
+    if ack is not None:
+        acks = Push0()
+        acks.dial(ack, block=False) # the sender may not be listening yet
     try:
-        final = stats >> stream.last(-1)
-    except IndexError:
-        final = items
-    # {'count': 0, 'size': 0, 'wait': 0, 'time': time.time()}
-    print(f"Received {final['count']} messages in {final['wait']} seconds: {final['size']/final['wait']/1024**2} MB/sec.")
+        # TODO: update tqdm progress meter
+        for i, size in enumerate(sizes):
+            if i % 10 == 1:
+                print(f"At {stats.summary()}")
+    finally:
+        if acks is not None:
+            acks.close()
+    print(f"Received {stats.summary()}")
+    if stats_json is not None:
+        stats.dump(stats_json)
 
 def run():
     typer.run(psana_pull)
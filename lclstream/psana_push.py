@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
-from io import BytesIO
-from typing import Annotated, List
-from collections.abc import Iterable, Iterator
+from typing import Annotated, List, Optional, Tuple
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import AbstractContextManager, nullcontext
+from functools import partial
+from itertools import chain, islice
+from pathlib import Path
+import socket
 
 import stream
 
@@ -10,47 +14,66 @@ from pynng import Push0 # type: ignore[import-untyped]
 from pynng.exceptions import ConnectionRefused # type: ignore[import-untyped]
 
 import numpy as np
-import h5py # type: ignore[import-untyped]
-import hdf5plugin # type: ignore[import-untyped]
+from pydantic import ValidationError
 import typer
 
-from .models import ImageRetrievalMode, AccessMode
+from .models import ImageRetrievalMode, AccessMode, MessageFormat, Codec, Partition, Quantize, Reduction, parse_events, TransferStats
+from .messages import Hdf5FileWriter, FrameWriter, SparseWriter, Envelope, Sealed, seal
+from .compression import registry, frame_codecs, select_codec, codec_fits
 from .psana_img_src import PsanaImgSrc
-from .nng import pusher, rate_clock, clock0
+from .nng import pusher, fanout_pusher, rank_addr
+from .shm import shm_pusher
+from .pool import pool_map, Timed
+from .metrics import bucket_counts, observe, size_buckets, latency_buckets
+from .reduce import apply_mask, reduce_batch, reduce_mask, Reduced
+from .stats import Stats, timed
+from .batching import BatchSizer, adaptive_chop
+from .checkpoint import Checkpoint, AckListener, load_checkpoint
+from .index_cache import checkpoint_path
 
-"""
-try:
-    from mpi4py import MPI
-    rank  = MPI.COMM_WORLD.Get_rank()
-    procs = MPI.COMM_WORLD.Get_size()
-except:
-    rank = 0
-    procs = 1
-"""
+def mpi_rank() -> Tuple[int, int]:
+    """ Return (rank, procs) from MPI_COMM_WORLD,
+    or (0, 1) when mpi4py is not available.
+    """
+    try:
+        from mpi4py import MPI # type: ignore[import-not-found, import-untyped]
+    except ImportError:
+        return 0, 1
+    return MPI.COMM_WORLD.Get_rank(), MPI.COMM_WORLD.Get_size()
 
-Tensor = np.ndarray # type alias
+writers = { MessageFormat.hdf5  : Hdf5FileWriter,
+            MessageFormat.frame : FrameWriter,
+            MessageFormat.sparse : SparseWriter, }
 
-def Hdf5FileWriter(ilist: List[Tensor]) -> bytes:
-    """ This creates an in-memory hdf5-format file.
+def auto_candidates(format : MessageFormat,
+                    integers : bool = False) -> List[Codec]:
+    # Only lossless codecs are considered by --codec auto
+    # (and, for quantized images, only those keeping integers).
+    if format != MessageFormat.hdf5:
+        return [Codec.none] + list(frame_codecs)
+    return [c for c, spec in registry.items() if not spec.lossy
+                and not (integers and spec.floats)]
 
-    Returns a serialized hdf5 (bytes)  containing several images.
+def wait_acks(messages : Iterable[bytes], ckpt : Checkpoint,
+              timeout : float) -> Iterator[bytes]:
+    # Hold the socket open (after the last message) until all
+    # messages are acknowledged, since nng drops queued
+    # messages when a socket closes.
+    yield from messages
+    if not ckpt.wait(timeout):
+        print(f"Timed out with {ckpt.outstanding} messages unacknowledged")
 
-    Params:
-        ilist: list of image arrays, all the same shape
-    """
-    if len(ilist) == 0:
-        return b'' # return h5py.File() with no dataset?
-    with BytesIO() as f:
-        with h5py.File(f, 'w') as fh:
-            dataset = fh.create_dataset(
-                'data',
-                shape = (len(ilist),) + ilist[0].shape,
-                **hdf5plugin.Zfp()
-            )
-            for idx, img in enumerate(ilist):
-                dataset[idx] = img
-
-        return f.read()
+def progress(stats : Stats, totals : TransferStats,
+             final : bool = False) -> TransferStats:
+    # combine pipeline stats with totals
+    return totals.model_copy(update = dict(
+                         messages = stats.count,
+                         bytes = stats.size,
+                         elapsed = stats.elapsed,
+                         mbps = stats.mbps,
+                         encode_seconds = stats.stages['encode'].total,
+                         send_seconds = stats.stages['send'].total,
+                         final = final), deep = True)
 
 def psana_push(
         experiment: Annotated[
@@ -71,7 +94,7 @@ def psana_push(
         ],    
         addr: Annotated[
             str,
-            typer.Option("--addr", "-a", help="Destination address (URL format)."),
+            typer.Option("--addr", "-a", help="Destination address (URL format), or comma-separated addresses to fan out to."),
         ],
         access_mode: Annotated[
             AccessMode,
@@ -81,22 +104,303 @@ def psana_push(
             int,
             typer.Option("--img_per_file", "-n", help="Number of images per file"),
         ] = 20,
+        encoders: Annotated[
+            int,
+            typer.Option("--encoders", "-j", help="Number of encoder processes (0 = encode inline)"),
+        ] = 0,
+        unordered: Annotated[
+            bool,
+            typer.Option("--unordered", help="Send messages in the order they finish encoding"),
+        ] = False,
+        format: Annotated[
+            MessageFormat,
+            typer.Option("--format", "-f", help="Message format"),
+        ] = MessageFormat.hdf5,
+        codec: Annotated[
+            Optional[Codec],
+            typer.Option("--codec", "-z", help="Compression codec (default: zfp for hdf5, or blosc_lz4 with --quantize; none for frame)"),
+        ] = None,
+        link_mbps: Annotated[
+            float,
+            typer.Option("--link_mbps", help="Estimated link bandwidth (MB/sec) used by --codec auto"),
+        ] = 1000.0,
+        partition: Annotated[
+            Partition,
+            typer.Option("--partition", help="How idx-mode events are split among MPI ranks"),
+        ] = Partition.block,
+        port_per_rank: Annotated[
+            bool,
+            typer.Option("--port_per_rank", help="Send to port (addr port + MPI rank)"),
+        ] = False,
+        events: Annotated[
+            Optional[str],
+            typer.Option("--events", help="Event selection (idx mode), as start:stop:step or i,j,k"),
+        ] = None,
+        prefetch: Annotated[
+            int,
+            typer.Option("--prefetch", help="Number of images to read ahead (0 = read synchronously)"),
+        ] = 0,
+        readers: Annotated[
+            int,
+            typer.Option("--readers", help="Number of reader threads used by --prefetch (idx mode)"),
+        ] = 1,
+        reader_procs: Annotated[
+            bool,
+            typer.Option("--reader_procs", help="Use reader processes instead of threads (idx mode)"),
+        ] = False,
+        ship_mask: Annotated[
+            bool,
+            typer.Option("--ship_mask", help="Send the bad pixel mask once, as the first message to each destination"),
+        ] = False,
+        progress_json: Annotated[
+            bool,
+            typer.Option("--progress_json", help="Print progress as JSON lines (TransferStats)"),
+        ] = False,
+        fanout_depth: Annotated[
+            int,
+            typer.Option("--fanout_depth", help="Messages queued per destination when fanning out"),
+        ] = 4,
+        stats_json: Annotated[
+            Optional[str],
+            typer.Option("--stats_json", help="Write per-stage timing statistics to this JSON file at exit"),
+        ] = None,
+        ack_addr: Annotated[
+            Optional[str],
+            typer.Option("--ack_addr", help="Listen for acknowledgements at this address, and checkpoint acknowledged events"),
+        ] = None,
+        ack_timeout: Annotated[
+            float,
+            typer.Option("--ack_timeout", help="Seconds to wait for the last acknowledgements"),
+        ] = 60.0,
+        checkpoint: Annotated[
+            Optional[str],
+            typer.Option("--checkpoint", help="Checkpoint file (default: in $LCLSTREAM_CACHE)"),
+        ] = None,
+        resume: Annotated[
+            bool,
+            typer.Option("--resume", help="Skip the events done in the checkpoint"),
+        ] = False,
+        eos: Annotated[
+            bool,
+            typer.Option("--eos", help="End the stream with an end-of-stream message, and wait for the receiver to close it"),
+        ] = False,
+        shm: Annotated[
+            bool,
+            typer.Option("--shm", help="Send unencoded batches through shared memory to one consumer on this node (addr is ipc://, see lclstream.shm)"),
+        ] = False,
+        shm_slots: Annotated[
+            int,
+            typer.Option("--shm_slots", help="Number of shared memory slots (batches in flight) for --shm"),
+        ] = 8,
+        target_mb: Annotated[
+            Optional[float],
+            typer.Option("--target_mb", help="Adapt the images per message to reach this (compressed) message size in MB, instead of using --img_per_file (with --shm, --img_per_file is the limit)"),
+        ] = None,
+        max_latency: Annotated[
+            float,
+            typer.Option("--max_latency", help="With --target_mb, limit the seconds spent collecting or sending one message"),
+        ] = 1.0,
+        roi: Annotated[
+            Optional[str],
+            typer.Option("--roi", help="Send only this region of every panel, as slices of the trailing axes, e.g. 0:256,128:384"),
+        ] = None,
+        bin: Annotated[
+            int,
+            typer.Option("--bin", help="Sum NxN blocks of pixels"),
+        ] = 1,
+        quantize: Annotated[
+            Optional[Quantize],
+            typer.Option("--quantize", help="Quantize to this integer type (the scale and offset are stored with each message)"),
+        ] = None,
+        scale: Annotated[
+            Optional[float],
+            typer.Option("--scale", help="Quantization step (default: fit the range of each batch)"),
+        ] = None,
+        offset: Annotated[
+            float,
+            typer.Option("--offset", help="Value of quantized 0, when --scale is given"),
+        ] = 0.0,
+        threshold: Annotated[
+            float,
+            typer.Option("--threshold", help="Sparse format: keep only pixels above this value"),
+        ] = 0.0,
+        max_occupancy: Annotated[
+            float,
+            typer.Option("--max_occupancy", help="Sparse format: store frames with more than this fraction of pixels kept dense"),
+        ] = 0.1,
     ):
+    rank, procs = mpi_rank()
+    addrs = addr.split(",")
+    if port_per_rank:
+        addrs = [rank_addr(a, rank) for a in addrs]
+    if shm and (len(addrs) > 1 or ack_addr is not None or ship_mask):
+        raise typer.BadParameter("--shm sends to a single consumer, without --ack_addr or --ship_mask.")
+    try:
+        red = Reduction(roi=roi, bin=bin, quantize=quantize,
+                        scale=scale, offset=offset)
+    except ValidationError as e:
+        raise typer.BadParameter(str(e))
+    if shm and quantize is not None:
+        raise typer.BadParameter("--shm does not record the scale and offset needed by --quantize.")
+    if quantize is None and (scale is not None or offset != 0.0):
+        raise typer.BadParameter("--scale and --offset require --quantize.")
+
+    integers = quantize is not None
+    if codec is None:
+        codec = Codec.none
+        if format == MessageFormat.hdf5: # (zfp would store floats)
+            codec = Codec.blosc_lz4 if integers else Codec.zfp
+    if not codec_fits(format, codec):
+        raise typer.BadParameter(f"Codec {codec.value} is not available for the {format.value} format.")
+    if not codec_fits(format, codec, integers):
+        raise typer.BadParameter(f"Codec {codec.value} would store the --quantize images as floats.")
+    try:
+        selection = None if events is None else parse_events(events)
+    except ValueError as e:
+        raise typer.BadParameter(f"--events: {e}")
     ps = PsanaImgSrc(experiment, run, access_mode, detector)
+    write = writers[format]
+    if format == MessageFormat.sparse:
+        write = partial(SparseWriter, threshold=threshold,
+                        max_occupancy=max_occupancy)
 
-    messages = ps(mode) >> stream.chop(img_per_file) >> stream.map(Hdf5FileWriter) # iterator over hdf5 bytes
+    start = 0
+    ckpt : Optional[Checkpoint] = None
+    if ack_addr is not None or resume:
+        if checkpoint is None:
+            checkpoint = str(checkpoint_path(experiment, run, detector,
+                                             mode.value, rank))
+        key = { 'exp': experiment, 'run': run,
+                'access_mode': access_mode.value, 'detector': detector,
+                'mode': mode.value, 'events': events,
+                'partition': partition.value, 'rank': rank, 'procs': procs }
+        if resume:
+            start = load_checkpoint(Path(checkpoint), key)
+            print(f"Resuming after {start} events")
+        if ack_addr is not None:
+            ckpt = Checkpoint(Path(checkpoint), key, start)
+            if port_per_rank:
+                ack_addr = rank_addr(ack_addr, rank)
 
-    stats = messages >> pusher(addr, 1) \
-          >> stream.fold(rate_clock, clock0())
-    # TODO: update tqdm progress meter
-    for items in stats >> stream.item[1::32]:
-        print(f"At {items['count']} messages in {items['wait']} seconds: {items['size']/items['wait']/1024**2} MB/sec.")
-    try:
-        final = stats >> stream.last(-1)
-    except IndexError:
-        final = items
-    # {'count': 0, 'size': 0, 'wait': 0, 'time': time.time()}
-    print(f"Sent {final['count']} messages in {final['wait']} seconds: {final['size']/final['wait']/1024**2} MB/sec.")
+    images = ps(mode, rank=rank, procs=procs, partition=partition,
+                events=selection, prefetch=prefetch,
+                readers=readers, processes=reader_procs, start=start)
+    stats = Stats(('read', 'encode', 'send'))
+    totals = TransferStats(size_hist = bucket_counts(size_buckets),
+                           send_hist = bucket_counts(latency_buckets))
+    def count(images):
+        for img in images:
+            totals.events += 1
+            yield img
+    sizer = None
+    if target_mb is not None:
+        sizer = BatchSizer(int(target_mb*1024**2), max_latency)
+        if shm: # (slots are sized for --img_per_file images)
+            sizer.max_images = img_per_file
+    def encoded(ans : Tuple[bytes, float]) -> bytes:
+        msg, seconds = ans
+        stats.record('encode', seconds)
+        if sizer is not None:
+            sizer.encoded(len(msg))
+        return msg
+    def sent(size : int, seconds : float) -> None:
+        if sizer is not None:
+            sizer.sent(size, seconds)
+        stats.record('send', seconds)
+        stats.message(size)
+        observe(totals.size_hist, size_buckets, size)
+        observe(totals.send_hist, latency_buckets, seconds)
+    def shm_sent(size : int, seconds : float) -> None:
+        if sizer is not None: # (batches are sent unencoded)
+            sizer.encoded(size)
+        sent(size, seconds)
+
+    chop = stream.chop(img_per_file) if sizer is None \
+                else adaptive_chop(sizer)
+    batches = count(images) >> timed(stats, 'read') >> chop
+    if mode == ImageRetrievalMode.mask or ship_mask:
+        mask = ps.bad_pixel_mask()
+    if mode == ImageRetrievalMode.mask:
+        batches = batches >> stream.map(partial(apply_mask, mask))
+    batches = iter(batches)
+    if codec == Codec.auto and not shm:
+        trial = list(islice(batches, 2))
+        reduced = [reduce_batch(b, red)[0] for b in trial] \
+                        if red.active else trial
+        codec = select_codec(reduced, write,
+                             auto_candidates(format, integers),
+                             link_mbps, encoders)
+        print(f"Selected codec {codec.value}")
+        batches = chain(trial, batches)
+
+    writer : Callable[..., bytes]
+    if red.active:
+        writer = Reduced(partial(write, codec=codec), red,
+                         {'detector': detector})
+    else:
+        writer = partial(write, codec=codec,
+                         attrs={'detector': detector})
+    if ckpt is not None:
+        def envelopes(batches):
+            first = start
+            for batch in batches:
+                env = Envelope(ckpt.register(len(batch)), first, len(batch))
+                first += len(batch)
+                yield env, batch
+        batches = envelopes(batches)
+        writer = Sealed(writer)
+    prefix : List[bytes] = [] # sent to every destination first
+    messages = batches >> pool_map(Timed(writer), encoders, ordered=not unordered) \
+                       >> stream.map(encoded) # iterator over message bytes
+    if ship_mask:
+        if red.active:
+            mask = reduce_mask(mask, red)
+        mask_msg = writers[format](mask[None], codec=Codec.gzip,
+                                   attrs={'detector': detector,
+                                          'kind': 'mask'})
+        if ckpt is not None: # registered before any batch
+            mask_msg = seal(mask_msg, Envelope(ckpt.register(0), start, 0))
+        prefix = [mask_msg] # (every destination needs the mask)
+        if len(addrs) == 1:
+            messages = chain(prefix, messages)
+    if ckpt is not None:
+        messages = wait_acks(messages, ckpt, ack_timeout)
+
+    def report(final : bool = False) -> None:
+        if progress_json:
+            print(progress(stats, totals, final).model_dump_json(), flush=True)
+        elif final:
+            print(f"Sent {stats.summary()}")
+        else:
+            print(f"At {stats.summary()}")
+
+    sender = f"{socket.gethostname()}-{rank}" if eos else None
+    if shm:
+        if red.active:
+            batches = batches >> stream.map(lambda b: reduce_batch(b, red)[0])
+        sizes = batches >> shm_pusher(addrs[0], shm_slots, observe=shm_sent,
+                                      max_images=img_per_file)
+    elif len(addrs) > 1:
+        sizes = messages >> fanout_pusher(addrs, sent, fanout_depth,
+                                          eos=sender, prefix=prefix)
+    else:
+        sizes = messages >> pusher(addrs[0], 1, sent, eos=sender)
+    acks : AbstractContextManager = nullcontext()
+    if ckpt is not None and ack_addr is not None: # (both, or neither)
+        acks = AckListener(ack_addr, ckpt)
+    with acks:
+        try:
+            for i, size in enumerate(sizes):
+                if i % 32 == 1:
+                    report()
+        finally:
+            if ckpt is not None:
+                ckpt.save()
+    report(final=True)
+    if stats_json is not None:
+        stats.dump(stats_json)
+    if ckpt is not None and ckpt.outstanding > 0:
+        raise typer.Exit(code=1)
 
     return 0
 
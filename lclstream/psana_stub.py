@@ -1,4 +1,21 @@
-from typing import List, Iterator
+""" Synthetic stand-in for psana, used when RAND_PSANA=1.
+
+Detectors named in `layouts` produce frames with that
+detector's panel geometry (uint16 raw, float32 calib,
+and a 2D assembled image).  Other detectors produce
+single 1024x1024 float32 frames.
+
+Smooth random frames are expensive to generate, so each
+detector pre-generates a pool of them ($LCLSTREAM_STUB_POOL,
+default 8) and every event returns a cheaply perturbed
+copy of one pool frame.  Setting $LCLSTREAM_STUB_RATE
+limits events to that many per second.
+"""
+
+from typing import Any, Dict, List, Iterator, NamedTuple, Optional, Tuple
+import os
+import time
+
 import numpy as np
 
 class StubEvent:
@@ -32,13 +49,6 @@ class StubEvent:
         Z *= self.scale_x[:,None] * self.scale_y[None,:]
         return np.fft.irfft2(Z, s=(self.m, self.n)).astype(self.dtype)
 
-def test_event():
-    for m in [32, 35]:
-        for n in [32, 127]:
-            e = StubEvent(m, n)
-            img = e.read()
-            assert img.shape == (m, n)
-
 # symmetrize [0, 1, ..., n//2| n//2+1, ..., n-1]
 # even n: [0, 1, 2, *3| 4, 5]
 # odd n:  [0, 1, *2| 3, 4]
@@ -54,36 +64,177 @@ def symm(x):
     else:
         x[mid+1:] = x[mid:0:-1].conj()
 
+T0 = 1500000000 # time (seconds) of the first stub event
+NEVENT = 200
+
+class Layout(NamedTuple):
+    panels : Tuple[int, int, int] # (panels, rows, columns)
+    grid : Tuple[int, int] # arrangement of panels in the assembled image
+    gap : int = 0 # pixels between panels in the assembled image
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        # raw / calib shape (single panels are 2D)
+        if self.panels[0] == 1:
+            return self.panels[1:]
+        return self.panels
+
+layouts : Dict[str, Layout] = {
+    'jungfrau4M': Layout((8, 512, 1024), (4, 2), 8),
+    'epix10k2M':  Layout((16, 352, 384), (4, 4), 8),
+}
+default_layout = Layout((1, 1024, 1024), (1, 1))
+
+def assemble(layout : Layout, frame : np.ndarray) -> np.ndarray:
+    """ Tile the panels of frame into a 2D image.
+    """
+    n, m, k = layout.panels
+    rows, cols = layout.grid
+    g = layout.gap
+    img = np.zeros((rows*(m+g)-g, cols*(k+g)-g), dtype=frame.dtype)
+    for p, panel in enumerate(frame.reshape(n, m, k)):
+        i, j = divmod(p, cols)
+        img[i*(m+g):i*(m+g)+m, j*(k+g):j*(k+g)+k] = panel
+    return img
+
+class FramePool:
+    """ Pre-generated frames for one detector layout.
+    """
+    def __init__(self, layout : Layout, size : int) -> None:
+        assert size > 0
+        self.layout = layout
+        n, m, k = layout.panels
+        gen = StubEvent(m, k, 'float32')
+        base = [gen.read() for i in range(size)]
+        # frame j, panel p is base[(j+p) % size]
+        self.calib = [np.stack([base[(j+p) % size] for p in range(n)])
+                        .reshape(layout.shape)
+                      for j in range(size)]
+        self._raw : Optional[List[np.ndarray]] = None
+        self._image : Optional[List[np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self.calib)
+
+    @property
+    def raw(self) -> List[np.ndarray]:
+        # ADU = pedestal + gain*calib
+        if self._raw is None:
+            self._raw = [np.clip(1000 + 100*f, 0, 2**14-1).astype(np.uint16)
+                         for f in self.calib]
+        return self._raw
+
+    @property
+    def image(self) -> List[np.ndarray]:
+        if self._image is None:
+            self._image = [assemble(self.layout, f) for f in self.calib]
+        return self._image
+
+_pools : Dict[str, FramePool] = {}
+
+def frame_pool(name : str) -> FramePool:
+    """ Return the (shared) pool of frames for detector name.
+    """
+    if name not in _pools:
+        size = int(os.environ.get("LCLSTREAM_STUB_POOL", "8"))
+        _pools[name] = FramePool(layouts.get(name, default_layout), size)
+    return _pools[name]
+
+def perturb(frame : np.ndarray, index : int) -> np.ndarray:
+    # A new array, differing from frame by a per-event
+    # gain (float) or offset (integer).
+    if frame.dtype.kind == 'f':
+        gain = 1.0 + 0.01*((index*7919) % 101 - 50)/50
+        return np.multiply(frame, frame.dtype.type(gain))
+    return frame + frame.dtype.type(index % 4)
+
+class Throttle:
+    """ Limit calls to wait() to rate per second (0 = unlimited).
+    """
+    def __init__(self, rate : float) -> None:
+        self.rate = rate
+        self.next = time.perf_counter()
+
+    def wait(self) -> None:
+        if self.rate <= 0:
+            return
+        now = time.perf_counter()
+        if self.next > now:
+            time.sleep(self.next - now)
+        else: # running behind - do not catch up with a burst
+            self.next = now
+        self.next += 1.0/self.rate
+
+class StubEventTime:
+    def __init__(self, time : int, fiducial : int) -> None:
+        self._time = time
+        self._fiducial = fiducial
+    def time(self) -> int:
+        return self._time
+    def fiducial(self) -> int:
+        return self._fiducial
+
+class StubFrame:
+    """ A stub event, identified by its index in the run.
+    """
+    def __init__(self, index : int) -> None:
+        self.index = index
+
 class StubRun:
-    def times(self) -> List[int]:
-        return np.arange(2000//10).astype(int).tolist()
-    def event(self, time : int) -> StubEvent:
-        return StubEvent(1024, 1024, 'float32')
+    def __init__(self, throttle : Throttle) -> None:
+        self.throttle = throttle
+    def times(self) -> List[StubEventTime]:
+        return [StubEventTime((T0+i)<<32, 3*i)
+                for i in range(NEVENT)]
+    def event(self, t : StubEventTime) -> StubFrame:
+        self.throttle.wait()
+        return StubFrame((t.time() >> 32) - T0)
 
 class StubDataSource:
     def __init__(self, source_id : str) -> None:
         self.source_id = source_id
+        rate = float(os.environ.get("LCLSTREAM_STUB_RATE", "0"))
+        self.throttle = Throttle(rate)
 
     def runs(self) -> Iterator[StubRun]:
-        yield StubRun()
+        yield StubRun(self.throttle)
+
+    def events(self) -> Iterator[StubFrame]:
+        for i in range(NEVENT):
+            self.throttle.wait()
+            yield StubFrame(i)
+
+    def env(self) -> Any: # (an opaque psana Env)
+        return None
 
 class StubDetector:
-    def __init__(self, name : str) -> None:
+    def __init__(self, name : str, env = None) -> None:
         self.name = name
+        self.layout = layouts.get(name, default_layout)
+
+    def _read(self, frames : List[np.ndarray],
+              event : StubFrame) -> np.ndarray:
+        return perturb(frames[event.index % len(frames)], event.index)
 
     def raw(self, event):
-        return event.read()
+        if self.layout is default_layout:
+            return self.calib(event) # as before: float32 frames
+        return self._read(frame_pool(self.name).raw, event)
     def calib(self, event):
-        return event.read()
+        return self._read(frame_pool(self.name).calib, event)
     def image(self, event):
-        return event.read()
+        return self._read(frame_pool(self.name).image, event)
     def mask(self, run, **kws):
-        raise NotImplementedError()
+        mask = np.ones(self.layout.shape, dtype=bool)
+        if kws.get('edges', False):
+            mask[..., [0,-1], :] = False
+            mask[..., :, [0,-1]] = False
+        return mask
 
-import os
 if os.environ.get("RAND_PSANA", "0") == "1":
     DataSource = StubDataSource
     Detector = StubDetector
     MPIDataSource = StubDataSource
+    EventTime = StubEventTime
 else:
-    from psana import DataSource, Detector, MPIDataSource # type: ignore[no-redef]
+    from psana import DataSource, Detector, MPIDataSource, EventTime # type: ignore[no-redef]
@@ -0,0 +1,127 @@
+""" Vectorized operations applied to whole batches of images.
+"""
+
+from collections.abc import Callable
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .models import Reduction, parse_roi
+
+Tensor = np.ndarray # type alias
+Batch = Union[List[Tensor], Tensor]
+
+def apply_mask(mask : Tensor, batch : Batch) -> Tensor:
+    """ Zero out the bad pixels (mask == 0) of every image in batch.
+
+    Returns a new array of shape (len(batch),) + mask.shape.
+    """
+    out = np.array(batch) if isinstance(batch, np.ndarray) \
+                          else np.stack(batch) # (copies)
+    np.multiply(out, mask, out=out, casting='unsafe')
+    return out
+
+def block_sum(x : Tensor, axis : Tuple[int, ...]) -> Tensor:
+    """ Sum over axis, accumulating 8 and 16-bit integers
+    in 32 bits (rather than numpy's default of 64).
+    """
+    dtype = None
+    if x.dtype.kind in 'ui' and x.dtype.itemsize <= 2:
+        dtype = np.dtype(f"{x.dtype.kind}4")
+    return np.sum(x, axis=axis, dtype=dtype)
+
+def crop_bin(batch : Batch, roi : Optional[Tuple[slice, ...]] = None,
+             n : int = 1, op : Callable[..., Tensor] = block_sum) -> Tensor:
+    """ Crop the trailing axes of every image to roi, then
+    combine NxN blocks of pixels (over the last two axes) with op.
+
+    Rows and columns left over past a multiple of n are dropped.
+    """
+    out = np.asarray(batch) if isinstance(batch, np.ndarray) \
+                            else np.stack(batch)
+    if roi is not None:
+        out = out[(Ellipsis,) + roi]
+    if n > 1:
+        h, w = out.shape[-2] // n, out.shape[-1] // n
+        out = out[..., :h*n, :w*n]
+        out = op(out.reshape(out.shape[:-2] + (h, n, w, n)), axis=(-3, -1))
+    return out
+
+def quantize(x : Tensor, dtype : np.dtype,
+             scale : Optional[float] = None,
+             offset : float = 0.0) -> Tuple[Tensor, float, float]:
+    """ Quantize x to the integer dtype, so that
+    x ~ q*scale + offset.
+
+    If scale is None, scale and offset are chosen so that
+    the range of x spans the range of dtype.
+
+    Returns (q, scale, offset).
+    """
+    info = np.iinfo(dtype)
+    if scale is None:
+        lo, hi = float(x.min()), float(x.max())
+        scale = (hi - lo) / (float(info.max) - float(info.min))
+        if scale <= 0:
+            scale = 1.0
+        offset = lo - float(info.min)*scale
+    q = np.subtract(x, offset, dtype=np.float32)
+    q /= scale
+    np.rint(q, out=q)
+    np.clip(q, info.min, info.max, out=q)
+    return q.astype(dtype), scale, offset
+
+def dequantize(data : Tensor, attrs : Dict[str, Any]) -> Tensor:
+    """ Undo quantize, using the scale and offset
+    recorded in a message's attrs (if any).
+    """
+    if 'scale' not in attrs:
+        return data
+    out = data.astype(np.float32)
+    out *= attrs['scale']
+    out += attrs['offset']
+    return out
+
+def reduce_batch(batch : Batch, red : Reduction
+                ) -> Tuple[Tensor, Dict[str, Any]]:
+    """ Apply red to a batch of images.
+
+    Returns the reduced batch, and attributes to
+    store with it (describing the reduction).
+    """
+    roi = None if red.roi is None else parse_roi(red.roi)
+    out = crop_bin(batch, roi, red.bin)
+    attrs : Dict[str, Any] = {}
+    if red.roi is not None:
+        attrs['roi'] = red.roi
+    if red.bin > 1:
+        attrs['bin'] = red.bin
+    if red.quantize is not None:
+        out, scale, offset = quantize(out, np.dtype(red.quantize.value),
+                                      red.scale, red.offset)
+        attrs['scale'] = scale
+        attrs['offset'] = offset
+    return out, attrs
+
+def reduce_mask(mask : Tensor, red : Reduction) -> Tensor:
+    """ Crop and bin a bad pixel mask like the images
+    (a binned pixel is good only if all its pixels are).
+    """
+    roi = None if red.roi is None else parse_roi(red.roi)
+    return crop_bin(mask[None], roi, red.bin, np.min)[0]
+
+class Reduced:
+    """ Wrap writer(batch, attrs=...) -> bytes, reducing each
+    batch (and recording the reduction in its attrs) first.
+
+    Picklable (so usable with pool_map) whenever writer is.
+    """
+    def __init__(self, writer : Callable[..., bytes], red : Reduction,
+                 attrs : Optional[Dict[str, Any]] = None) -> None:
+        self.writer = writer
+        self.red = red
+        self.attrs = dict(attrs or {})
+
+    def __call__(self, batch : Batch) -> bytes:
+        out, attrs = reduce_batch(batch, self.red)
+        return self.writer(out, attrs={**self.attrs, **attrs})
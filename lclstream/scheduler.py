@@ -0,0 +1,101 @@
+""" Bounded-concurrency scheduler for transfers.
+
+Transfers wait in a priority queue until both a global slot
+and a slot for their destination are free.
+"""
+
+from collections import Counter
+from typing import List, Tuple
+import heapq
+import os
+import logging
+_logger = logging.getLogger(__name__)
+
+from .transfer import Transfer
+from . import metrics
+
+class Scheduler:
+    """ Run at most max_active transfers at once,
+    and at most max_per_dest to any one destination.
+
+    Higher priority transfers start first; equal priorities
+    start in submission order.
+    """
+    def __init__(self, max_active : int, max_per_dest : int) -> None:
+        assert max_active > 0 and max_per_dest > 0
+        self.max_active = max_active
+        self.max_per_dest = max_per_dest
+        self.queue : List[Tuple[int, int, Transfer]] = []
+        self.active : List[Transfer] = []
+        self.per_dest : Counter[str] = Counter()
+        self.seq = 0
+
+    @classmethod
+    def from_env(cls) -> "Scheduler":
+        return cls(int(os.environ.get("LCLSTREAM_MAX_TRANSFERS", "4")),
+                   int(os.environ.get("LCLSTREAM_MAX_PER_DEST", "2")))
+
+    def submit(self, trs : Transfer) -> None:
+        """ Queue trs and start it as soon as possible.
+
+        Must be called from within a running event loop.
+        """
+        trs.state = "queued"
+        heapq.heappush(self.queue, (-trs.request.priority, self.seq, trs))
+        self.seq += 1
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        """ Start queued transfers while there are free slots.
+        """
+        waiting : List[Tuple[int, int, Transfer]] = []
+        while len(self.queue) > 0 and len(self.active) < self.max_active:
+            item = heapq.heappop(self.queue)
+            trs = item[2]
+            if self.per_dest[trs.destination] >= self.max_per_dest:
+                waiting.append(item)
+                continue
+            self._start(trs)
+        for item in waiting:
+            heapq.heappush(self.queue, item)
+        self.update_metrics()
+
+    def update_metrics(self) -> None:
+        metrics.active.set(len(self.active))
+        metrics.queued.set(len(self.queue))
+
+    def _start(self, trs : Transfer) -> None:
+        self.active.append(trs)
+        self.per_dest[trs.destination] += 1
+        trs.start()
+        trs.coro.add_done_callback( # type: ignore[union-attr]
+                lambda task: self._finished(trs))
+
+    def _finished(self, trs : Transfer) -> None:
+        self.active.remove(trs)
+        self.per_dest[trs.destination] -= 1
+        if self.per_dest[trs.destination] == 0:
+            del self.per_dest[trs.destination]
+        self.dispatch()
+
+    def cancel(self, trs : Transfer) -> bool:
+        for i, item in enumerate(self.queue):
+            if item[2] is trs:
+                self.queue.pop(i)
+                heapq.heapify(self.queue)
+                trs.state = "canceled"
+                self.update_metrics()
+                return True
+        return trs.cancel()
+
+    def cancel_all(self) -> None:
+        for item in self.queue:
+            item[2].state = "canceled"
+        self.queue.clear()
+        self.update_metrics()
+        for trs in list(self.active):
+            trs.cancel()
+
+    @property
+    def queued(self) -> int:
+        return len(self.queue)
@@ -7,17 +7,23 @@
 #
 
 from typing import Dict, List
-import asyncio
 import signal
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 
 from .transfer import Transfer
-from .models import DataRequest
+from .scheduler import Scheduler
+from .models import DataRequest, TransferStats
+from . import metrics
+
+# Limits are read from $LCLSTREAM_MAX_TRANSFERS
+# and $LCLSTREAM_MAX_PER_DEST.
+scheduler = Scheduler.from_env()
 
 # Cleanup function
 def cleanup():
-    pass
+    scheduler.cancel_all()
 
 # Additional signal handling for manual interruption
 def handle_exit(sig, frame):
@@ -37,6 +43,11 @@ def shutdown_event():
 async def list_experiments() -> List[str]:
     return []
 
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    # Prometheus text exposition format
+    return metrics.registry.render()
+
 transfer_id = 0
 transfers : Dict[int, Transfer] = {}
 
@@ -50,7 +61,7 @@ async def cancel_transfer(n : int) -> bool:
         trs = transfers.pop(n)
     except KeyError:
         return False
-    return trs.cancel()
+    return scheduler.cancel(trs)
 
 @app.get('/transfers/{n}')
 async def get_transfer(n : int) -> str:
@@ -61,12 +72,19 @@ async def get_transfer(n : int) -> str:
     # TODO: periodically await and clear these transfers out
     return trs.state
 
+@app.get('/transfers/{n}/stats')
+async def get_transfer_stats(n : int) -> TransferStats:
+    try:
+        trs = transfers[n]
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Transfer not found")
+    return trs.stats
+
 @app.post('/transfers/new')
 async def new_transfer(request: DataRequest) -> int:
     global transfer_id
     trs = Transfer(request)
-    ok = trs.start() # TODO catch some errors immediately
-    #if not ok:
+    scheduler.submit(trs)
 
     n = transfer_id
     transfer_id += 1
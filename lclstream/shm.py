@@ -0,0 +1,227 @@
+""" Shared-memory transport for producers and consumers on one node.
+
+Batches (numpy arrays) are copied into a ring of fixed-size slots,
+in a memory-mapped file under /dev/shm.  Only small slot
+descriptors travel over an nng Pair0 socket (usually ipc://),
+and the consumer sends back each slot index once it is done
+with it.  Consumers read numpy views straight from the ring.
+
+The stream ends with an EOS message (see nng.eos_message),
+after which the consumer closes its pipe.
+"""
+
+from collections import deque
+from collections.abc import Iterable, Iterator, Sequence
+from typing import Callable, Deque, Dict, Optional, Tuple, Union
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import logging
+_logger = logging.getLogger(__name__)
+
+import numpy as np
+import stream
+from pynng import Pair0, Timeout, TryAgain # type: ignore[import-untyped]
+from pynng.exceptions import NNGException # type: ignore[import-untyped]
+
+from .nng import eos_message, eos_sender
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+ALIGN = 64 # slot size granularity (bytes)
+
+DESC_MAGIC = b"LCLD"
+_desc = struct.Struct("<4sIQB") # magic, slot, offset, ndim
+_release = struct.Struct("<I") # slot
+
+Batch = Union[np.ndarray, Sequence[np.ndarray]]
+
+def descriptor(path : str, slot : int, offset : int, dtype : np.dtype,
+               shape : Tuple[int, ...]) -> bytes:
+    """ Describe an array of dtype and shape, stored in slot
+    (starting at offset) of the ring at path.
+    """
+    return _desc.pack(DESC_MAGIC, slot, offset, len(shape)) \
+            + struct.pack(f"<{len(shape)}Q", *shape) \
+            + f"{dtype.str}\0{path}".encode()
+
+def read_descriptor(msg : bytes
+                   ) -> Tuple[str, int, int, np.dtype, Tuple[int, ...]]:
+    """ Return the (path, slot, offset, dtype, shape) of a descriptor.
+    """
+    magic, slot, offset, ndim = _desc.unpack_from(msg)
+    if magic != DESC_MAGIC:
+        raise ValueError("Message is not a slot descriptor.")
+    shape = struct.unpack_from(f"<{ndim}Q", msg, _desc.size)
+    dtype, path = bytes(msg[_desc.size + 8*ndim:]).decode().split("\0", 1)
+    return path, slot, offset, np.dtype(dtype), shape
+
+def _shape(batch : Batch) -> Tuple[np.dtype, Tuple[int, ...]]:
+    if isinstance(batch, np.ndarray):
+        return batch.dtype, batch.shape
+    return batch[0].dtype, (len(batch),) + batch[0].shape
+
+class SlotRing:
+    """ nslots slots of slot_bytes each, in a new file under dir.
+    """
+    def __init__(self, nslots : int, slot_bytes : int,
+                 dir : str = SHM_DIR) -> None:
+        self.nslots = nslots
+        self.slot_bytes = -(-slot_bytes // ALIGN) * ALIGN
+        fd, path = tempfile.mkstemp(prefix="lclstream-", suffix=".ring", dir=dir)
+        self.path = path
+        with os.fdopen(fd, "w+b") as f:
+            f.truncate(nslots*self.slot_bytes)
+            self.map = mmap.mmap(f.fileno(), nslots*self.slot_bytes)
+
+    def view(self, slot : int, dtype : np.dtype,
+             shape : Tuple[int, ...]) -> np.ndarray:
+        count = int(np.prod(shape))
+        return np.frombuffer(self.map, dtype, count,
+                             slot*self.slot_bytes).reshape(shape)
+
+    def put(self, slot : int, batch : Batch) -> Tuple[np.dtype, Tuple[int, ...]]:
+        """ Copy batch into slot, returning its (dtype, shape).
+        """
+        dtype, shape = _shape(batch)
+        if int(np.prod(shape)) * dtype.itemsize > self.slot_bytes:
+            raise ValueError(f"Batch of shape {shape} does not fit"
+                             f" in a {self.slot_bytes} byte slot.")
+        out = self.view(slot, dtype, shape)
+        if isinstance(batch, np.ndarray):
+            out[...] = batch
+        else:
+            np.stack(batch, out=out)
+        return dtype, shape
+
+    def close(self) -> None:
+        # Consumers' mappings remain valid after the unlink.
+        try:
+            self.map.close()
+        except BufferError: # views are still alive
+            pass
+        os.unlink(self.path)
+
+@stream.stream
+def shm_pusher(gen : Iterable[Batch], addr : str,
+               nslots : int = 8,
+               slot_bytes : Optional[int] = None,
+               max_images : int = 0,
+               ndial : int = 0,
+               observe : Optional[Callable[[int, float], None]] = None,
+               eos_timeout : float = 30.0) -> Iterator[int]:
+    """ Send batches to a consumer (shm_puller) on this node
+    through a ring of shared-memory slots.
+    Yields the size of each batch sent.
+
+    Params:
+        gen: arrays, or sequences of equal-shaped arrays (stacked)
+        addr: address for slot descriptors (e.g. ipc:///tmp/x.ipc)
+        nslots: number of slots in the ring
+        slot_bytes: size of each slot (default: fit the first batch,
+                    or max_images of its images if that is more)
+        max_images: the largest number of images in a batch
+        ndial: dial addr ndial times (if 0, listen at addr)
+        observe: called as observe(size, seconds) after each send
+    """
+    assert nslots >= 1
+    free : Deque[int] = deque(range(nslots))
+    ring : Optional[SlotRing] = None
+    closed = threading.Event()
+
+    def collect(block : bool) -> None:
+        # receive released slot indices
+        while True:
+            try:
+                msg = pair.recv(block=block)
+            except Timeout:
+                if closed.is_set():
+                    raise ConnectionError("Consumer disconnected.")
+                continue
+            except TryAgain:
+                return
+            free.append(_release.unpack(msg)[0])
+            block = False
+
+    try:
+        with Pair0(recv_timeout=1000) as pair:
+            pair.add_post_pipe_remove_cb(lambda pipe: closed.set())
+            if ndial == 0:
+                pair.listen(addr)
+            for dial in range(ndial):
+                pair.dial(addr, block=True)
+            for batch in gen:
+                if ring is None:
+                    dtype, shape = _shape(batch)
+                    size = int(np.prod(shape[1:])) * dtype.itemsize \
+                            * max(shape[0], max_images)
+                    ring = SlotRing(nslots, slot_bytes or size)
+                t0 = time.perf_counter()
+                collect(block = len(free) == 0)
+                slot = free.popleft()
+                dtype, shape = ring.put(slot, batch)
+                pair.send(descriptor(ring.path, slot, slot*ring.slot_bytes,
+                                     dtype, shape))
+                size = int(np.prod(shape)) * dtype.itemsize
+                if observe is not None:
+                    observe(size, time.perf_counter() - t0)
+                yield size
+
+            pair.send(eos_message("shm"))
+            t0 = time.time()
+            # (keep receiving, so nng notices the pipe closing)
+            while not closed.wait(0.05):
+                collect(block=False)
+                if time.time() - t0 > eos_timeout:
+                    _logger.warning("Consumer did not close the stream.")
+                    break
+    finally:
+        if ring is not None:
+            ring.close()
+
+def shm_puller(addr : str, ndial : int = 1,
+               hold : int = 1) -> Iterator[np.ndarray]:
+    """ Receive batches sent by shm_pusher, as read-only
+    views into shared memory.
+
+    A view is only valid until hold more batches are
+    requested (copy it to keep it longer).
+
+    Params:
+        addr: address for slot descriptors
+        ndial: dial addr ndial times (if 0, listen at addr)
+        hold: number of views the consumer may hold at once
+    """
+    assert hold >= 1
+    maps : Dict[str, mmap.mmap] = {}
+    held : Deque[int] = deque()
+    with Pair0(recv_timeout=1000) as pair:
+        if ndial == 0:
+            pair.listen(addr)
+        for dial in range(ndial):
+            pair.dial(addr, block=False) # the producer may not be listening yet
+        while True:
+            while len(held) >= hold:
+                pair.send(_release.pack(held.popleft()))
+            try:
+                msg = pair.recv_msg()
+            except Timeout:
+                continue
+            data = msg.bytes
+            if eos_sender(data) is not None:
+                if msg.pipe is not None:
+                    try:
+                        msg.pipe.close()
+                    except NNGException:
+                        pass
+                return
+            path, slot, offset, dtype, shape = read_descriptor(data)
+            if path not in maps:
+                with open(path, "rb") as f:
+                    maps[path] = mmap.mmap(f.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+            held.append(slot)
+            yield np.frombuffer(maps[path], dtype, int(np.prod(shape)),
+                                offset).reshape(shape)
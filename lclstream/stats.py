@@ -0,0 +1,150 @@
+""" Pipeline statistics: per-stage timing and message histograms.
+
+Durations and sizes are counted in preallocated log-scale
+histograms (4 buckets per factor of 2, so percentiles are
+accurate to about 20%), making each observation O(1).
+"""
+
+from collections.abc import Callable, Iterator, Sequence
+from typing import Any, Dict
+import json
+import math
+import time
+
+import numpy as np
+import stream
+
+SUB = 4 # buckets per factor of 2
+TIME_MIN = 2.0**-20 # ~1 microsecond
+SIZE_MIN = 1.0 # byte
+NBUCKET = 48*SUB # covers 2**48 x minimum value
+
+class LogHistogram:
+    """ Histogram with logarithmically spaced buckets.
+    """
+    def __init__(self, vmin : float) -> None:
+        self.vmin = vmin
+        self.counts = np.zeros(NBUCKET, dtype=np.int64)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, x : float) -> None:
+        self.total += x
+        if x > self.max:
+            self.max = x
+        if x <= self.vmin:
+            i = 0
+        else:
+            i = min(int(SUB*math.log2(x/self.vmin)), NBUCKET-1)
+        self.counts[i] += 1
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def percentile(self, q : float) -> float:
+        """ Return the (upper bucket edge of the) q-th percentile.
+        """
+        n = self.count
+        if n == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), q/100.0*n))
+        return min(self.vmin * 2.0**((i+1)/SUB), self.max)
+
+    def summary(self) -> Dict[str, float]:
+        n = self.count
+        return { 'count': n,
+                 'total': self.total,
+                 'mean': self.total/n if n else 0.0,
+                 'p50': self.percentile(50),
+                 'p90': self.percentile(90),
+                 'p99': self.percentile(99),
+                 'max': self.max }
+
+class Stats:
+    """ Accumulates message counts and sizes,
+    and the time spent in each pipeline stage.
+    """
+    def __init__(self, stages : Sequence[str] = ()) -> None:
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.count = 0
+        self.size = 0
+        self.sizes = LogHistogram(SIZE_MIN)
+        self.latency = LogHistogram(TIME_MIN) # time between messages
+        self.stages : Dict[str, LogHistogram] = {}
+        for s in stages:
+            self.stages[s] = LogHistogram(TIME_MIN)
+        self.inner = 0.0 # time recorded by (nested) timed stages
+
+    def message(self, size : int) -> None:
+        """ Count one message of the given size.
+        """
+        t = time.perf_counter()
+        self.count += 1
+        self.size += size
+        self.sizes.add(size)
+        self.latency.add(t - self.last)
+        self.last = t
+
+    def record(self, stage : str, seconds : float) -> None:
+        """ Add time spent in a stage.
+        """
+        if stage not in self.stages:
+            self.stages[stage] = LogHistogram(TIME_MIN)
+        self.stages[stage].add(seconds)
+
+    @property
+    def elapsed(self) -> float:
+        return self.last - self.start
+
+    @property
+    def mbps(self) -> float:
+        return self.size / max(self.elapsed, 1e-9) / 1024**2
+
+    def summary(self) -> str:
+        """ One-line summary for periodic printing.
+        """
+        stages = ", ".join(f"{s} {h.total:.3g} s"
+                           for s, h in self.stages.items())
+        return f"{self.count} messages in {self.elapsed:.3f} seconds: " \
+               f"{self.mbps:.3f} MB/sec ({stages})"
+
+    def report(self) -> Dict[str, Any]:
+        return { 'count': self.count,
+                 'size': self.size,
+                 'elapsed': self.elapsed,
+                 'mbps': self.mbps,
+                 'message_size': self.sizes.summary(),
+                 'latency': self.latency.summary(),
+                 'stages': { s: h.summary() for s, h in self.stages.items() } }
+
+    def dump(self, fname : str) -> None:
+        """ Write the report to fname as JSON.
+        """
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+@stream.stream
+def timed(gen : Iterator[Any], stats : Stats, stage : str,
+          clock : Callable[[], float] = time.perf_counter) -> Iterator[Any]:
+    """ Record the time spent waiting on gen as stage.
+
+    Time recorded by timed stages nested inside gen
+    is subtracted, so each stage gets only its own time.
+
+    Params:
+        clock: time source (e.g. time.thread_time to count CPU time)
+    """
+    it = iter(gen)
+    while True:
+        inner0 = stats.inner
+        t0 = clock()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        dt = clock() - t0
+        stats.record(stage, dt - (stats.inner - inner0))
+        stats.inner = inner0 + dt
+        yield item
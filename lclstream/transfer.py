@@ -1,15 +1,18 @@
-from subprocess import Popen
-from typing import Optional, List,Dict, Any, Awaitable, Tuple
-import time
+from collections.abc import Callable
+from typing import Optional, List, Awaitable
 import asyncio
+import logging
+_logger = logging.getLogger(__name__)
 
-from pynng import Push0 # type: ignore[import-untyped]
+from pydantic import ValidationError
 
-from .models import DataRequest, AccessMode, ImageRetrievalMode
+from .models import DataRequest, AccessMode, TransferStats
+from . import metrics
 
-TransferStats = Tuple[int,float,float,float]
+class PushError(RuntimeError):
+    pass
 
-def send_experiment(req : DataRequest) -> TransferStats:
+def push_command(req : DataRequest) -> List[str]:
 
     mpi_pool_size = 1  # Hardcoding the mpi pool size for now
 
@@ -26,43 +29,137 @@ def send_experiment(req : DataRequest) -> TransferStats:
                    "-r", str(req.run),
                    "-d", req.detector_name,
                    "-m", req.mode.value,
-                   "-a", req.addr,
-                   "-c", req.access_mode.value]
-    proc = Popen(cmd)
-    proc.wait()
-    return 1, 1.0, 1.0, 1.0
-
-async def send_experiment_async(req : DataRequest) -> TransferStats:
-    loop = asyncio.get_running_loop()
-    # TODO: separate the executor into its own
-    # module or use threads...
-    return await loop.run_in_executor(None, send_experiment, req)
+                   "-a", ",".join(req.destinations()),
+                   "-c", req.access_mode.value,
+                   "-f", req.format.value,
+                   "--progress_json"]
+    if req.codec is not None:
+        cmd += ["-z", req.codec.value]
+    if req.events is not None:
+        cmd += ["--events", req.events]
+    if req.ack_addr is not None:
+        cmd += ["--ack_addr", req.ack_addr]
+    if req.resume:
+        cmd.append("--resume")
+    if req.target_mb is not None:
+        cmd += ["--target_mb", str(req.target_mb)]
+    if req.threshold is not None:
+        cmd += ["--threshold", str(req.threshold)]
+    if req.reduce is not None:
+        red = req.reduce
+        if red.roi is not None:
+            cmd += ["--roi", red.roi]
+        if red.bin > 1:
+            cmd += ["--bin", str(red.bin)]
+        if red.quantize is not None:
+            cmd += ["--quantize", red.quantize.value]
+        if red.scale is not None:
+            cmd += ["--scale", str(red.scale), "--offset", str(red.offset)]
+    return cmd
+
+async def read_progress(stdout : asyncio.StreamReader,
+                        update : Callable[[TransferStats], None]) -> None:
+    # Parse TransferStats JSON lines printed by psana_push --progress_json
+    async for line in stdout:
+        if not line.startswith(b'{'):
+            _logger.debug("psana_push: %s", line.decode(errors='replace').rstrip())
+            continue
+        try:
+            update(TransferStats.model_validate_json(line))
+        except ValidationError as e:
+            _logger.warning("Invalid progress report - %s", e)
+
+async def send_experiment(req : DataRequest,
+                          update : Callable[[TransferStats], None] = lambda st: None
+                         ) -> TransferStats:
+    final = TransferStats()
+    def set_stats(st : TransferStats) -> None:
+        nonlocal final
+        final = st
+        update(st)
+
+    proc = await asyncio.create_subprocess_exec(*push_command(req),
+                                    stdout=asyncio.subprocess.PIPE)
+    try:
+        assert proc.stdout is not None
+        await read_progress(proc.stdout, set_stats)
+        ret = await proc.wait()
+    except asyncio.CancelledError:
+        _logger.info("Terminating canceled transfer (pid %d)", proc.pid)
+        proc.terminate()
+        await proc.wait()
+        raise
+    if ret != 0:
+        raise PushError(f"psana_push exited with status {ret}")
+    return final
 
 class Transfer:
     req   : DataRequest
     state : str
-    coro  : Optional[Awaitable[TransferStats]]
+    stats : TransferStats
+    coro  : Optional[Awaitable[None]]
 
     def __init__(self, request : DataRequest):
         self.request = request
         self.state = "initial"
         self.coro = None
+        self.stats = TransferStats()
+        self.name = f"{request.exp}:{request.run}:{id(self):x}"
+
+    @property
+    def destination(self) -> str:
+        return ",".join(self.request.destinations())
 
     async def run(self):
         self.state = "active"
         req = self.request
-        self.value = await send_experiment_async(req)
+        try:
+            self.value = await send_experiment(req, self.update)
+        except asyncio.CancelledError:
+            self.state = "canceled"
+            raise
+        except Exception as e:
+            _logger.error("Transfer failed - %s", e)
+            self.state = "failed"
+            reason = "exit_status" if isinstance(e, PushError) \
+                                   else type(e).__name__
+            metrics.failures.inc(reason=reason)
+            return # (nothing awaits the task - the state tells)
+        finally:
+            metrics.throughput.remove(transfer=self.name)
         self.state = "completed"
+        metrics.completed.inc()
+
+    def update(self, stats : TransferStats) -> None:
+        # accumulate the change since the last report into metrics
+        prev = self.stats
+        dest = self.destination
+        metrics.sent_bytes.inc(stats.bytes - prev.bytes, dest=dest)
+        metrics.sent_messages.inc(stats.messages - prev.messages, dest=dest)
+        metrics.sent_events.inc(stats.events - prev.events, dest=dest)
+        metrics.encode_seconds.inc(stats.encode_seconds - prev.encode_seconds,
+                                   dest=dest)
+        if len(stats.size_hist) == len(metrics.size_buckets)+1:
+            metrics.message_size.add(_delta(stats.size_hist, prev.size_hist),
+                                     stats.bytes - prev.bytes, dest=dest)
+        if len(stats.send_hist) == len(metrics.latency_buckets)+1:
+            metrics.send_latency.add(_delta(stats.send_hist, prev.send_hist),
+                                     stats.send_seconds - prev.send_seconds,
+                                     dest=dest)
+        if not stats.final:
+            metrics.throughput.set(stats.mbps, transfer=self.name, dest=dest)
+        self.stats = stats
 
     def start(self) -> bool:
         self.coro = asyncio.create_task(self.run(), name="transfer")
         return True
 
     def cancel(self) -> bool:
-        if self.coro is None or self.state == "completed":
+        if self.coro is None or self.coro.done(): # type: ignore[attr-defined]
             return False
         self.coro.cancel() # type: ignore[attr-defined]
         self.coro = None
+        self.state = "canceled" # (run() may never have started)
         return True
     
     async def __call__(self) -> str:
@@ -77,3 +174,8 @@ class Transfer:
             return "failed"
         return self.state
 
+
+def _delta(new : List[int], old : List[int]) -> List[int]:
+    if len(old) != len(new):
+        return new
+    return [a-b for a, b in zip(new, old)]
@@ -0,0 +1,64 @@
+from functools import partial
+
+import numpy as np
+import h5py # type: ignore[import-untyped]
+
+from lclstream.models import Codec, Quantize, Reduction
+from lclstream.messages import Hdf5FileWriter, FrameWriter, SparseWriter
+from lclstream.reduce import Reduced
+from lclstream.archive import Archive
+
+def test_archive(tmp_path):
+    prefix = str(tmp_path / "run")
+    imgs = np.random.random((6, 16, 16)).astype(np.float32)
+    with Archive(prefix, 1) as ar: # roll over after every message
+        for i in range(3):
+            batch = imgs[2*i:2*i+2]
+            msg = Hdf5FileWriter(batch, codec=Codec.blosc_lz4,
+                                 attrs={'detector': 'jungfrau'})
+            assert ar.write(msg) > 0
+        ar.write(FrameWriter(imgs[:2]))
+
+    with h5py.File(f"{prefix}.00000.h5", 'r') as f:
+        assert np.array_equal(f['jungfrau'][()], imgs[:2])
+        assert f['jungfrau'].attrs['codec'] == 'blosc_lz4'
+    with h5py.File(f"{prefix}.00002.h5", 'r') as f:
+        assert np.array_equal(f['jungfrau'][()], imgs[4:])
+    with h5py.File(f"{prefix}.00003.h5", 'r') as f:
+        assert np.array_equal(f['data'][()], imgs[:2])
+
+def test_archive_quantized(tmp_path):
+    # each message has its own scale, so they are archived per image
+    prefix = str(tmp_path / "run")
+    red = Reduction(bin=2, quantize=Quantize.uint8)
+    batches = [np.full((2, 4, 4), v, dtype=np.float32) for v in (1, 2, 100)]
+    batches[1][1] = 300 # (one message spans 2..300)
+    with Archive(prefix, 1024**2) as ar:
+        for writer, batch in zip([Hdf5FileWriter, FrameWriter, FrameWriter],
+                                 batches):
+            ar.write(Reduced(partial(writer, codec=Codec.gzip), red)(batch))
+
+    with h5py.File(f"{prefix}.00000.h5", 'r') as f:
+        data = f['data']
+        assert data.dtype == np.uint8 and data.shape == (6, 2, 2)
+        assert data.attrs['bin'] == 2
+        scale = f['data_scale'][()]
+        offset = f['data_offset'][()]
+        assert scale.shape == offset.shape == (6,)
+        restored = data[()]*scale[:,None,None] + offset[:,None,None]
+    expect = np.concatenate(batches).reshape(6, 2, 2, 2, 2).sum(axis=(2, 4))
+    assert np.allclose(restored, expect, rtol=0.01)
+
+def test_archive_sparse(tmp_path):
+    prefix = str(tmp_path / "run")
+    imgs = np.zeros((3, 16, 16), dtype=np.float32)
+    imgs[0, 2, 3] = 5.0
+    imgs[1] = 1.0 # stored dense
+    with Archive(prefix, 1024**2) as ar:
+        for codec in [Codec.none, Codec.gzip]:
+            msg = SparseWriter(imgs, codec=codec, threshold=0.5,
+                               attrs={'detector': 'epix'})
+            assert ar.write(msg) == imgs.nbytes
+
+    with h5py.File(f"{prefix}.00000.h5", 'r') as f:
+        assert np.array_equal(f['epix'][()], np.concatenate([imgs, imgs]))
@@ -0,0 +1,41 @@
+import numpy as np
+
+from lclstream.batching import BatchSizer, adaptive_chop
+
+def test_adaptive_chop():
+    imgs = [np.zeros(1000, dtype=np.uint8) for i in range(100)]
+    sizer = BatchSizer(10000, max_latency=100.0)
+    # before any feedback, messages are assumed incompressible
+    batches = iter(imgs) >> adaptive_chop(sizer)
+    first = next(batches)
+    assert len(first) == 10
+
+    # 4x compression => 4x more images per message
+    sizer.encoded(2500)
+    assert sizer.ratio == 1.0 - 0.25*(1.0 - 0.25)
+    sizer.ratio = 0.25
+    assert len(next(batches)) == 40
+
+    # a slow link limits the message size
+    sizer.sent(1000, 1.0) # 1 kB/s
+    sizer.max_latency = 2.0
+    assert sizer.limit == 2000.0
+    assert len(next(batches)) == 8
+
+    rest = list(batches)
+    assert sum(len(b) for b in rest) == 100 - 10 - 40 - 8
+    assert len(sizer.raw) == 1 + 1 + len(rest) # batches not yet encoded
+
+def test_latency():
+    t = [0.0]
+    def clock():
+        t[0] += 1.0
+        return t[0]
+    sizer = BatchSizer(10**9, max_latency=3.0)
+    batches = list(range(10) >> adaptive_chop(sizer, clock=clock))
+    # every reading advances the clock one second
+    assert [len(b) for b in batches] == [3, 3, 3, 1]
+
+    sizer = BatchSizer(10**9, max_latency=100.0, max_images=4)
+    batches = list(range(10) >> adaptive_chop(sizer))
+    assert [len(b) for b in batches] == [4, 4, 2]
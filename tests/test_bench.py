@@ -0,0 +1,21 @@
+import json
+
+from lclstream.bench import lclstream_bench, parse_shape
+
+def test_parse_shape():
+    assert parse_shape("1024x1024") == (1024, 1024)
+    assert parse_shape("8x512x1024") == (8, 512, 1024)
+    assert parse_shape("epix10k2M") == (16, 352, 384)
+
+def test_bench(tmp_path):
+    out = tmp_path / "bench.json"
+    lclstream_bench(transports="inproc,ipc", shapes="64x64",
+                    img_per_file="4", codecs="none", pushers="1,2",
+                    send_buffer_size="0", images=10, pool=2, output=out)
+    with open(out) as f:
+        rows = json.load(f)
+    assert len(rows) == 4
+    for row in rows:
+        assert row['messages'] == row['pushers']*3
+        assert row['lost'] == 0
+        assert row['mbps'] > 0
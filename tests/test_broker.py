@@ -0,0 +1,54 @@
+from lclstream.broker import MessageCache, Broker
+from lclstream.nng import pusher, puller
+
+def test_cache(tmp_path):
+    cache = MessageCache(100, tmp_path, segment_bytes=64)
+    msgs = [bytes([i])*(10+i) for i in range(20)]
+    for m in msgs:
+        cache.put(m)
+    assert len(cache) == 20
+    assert cache.in_memory <= 100
+    assert cache.spill.count > 0
+    assert len(list(tmp_path.iterdir())) > 1
+
+    got = [cache.get(0) for i in range(20)]
+    assert got == msgs # in order, from memory then disk
+    assert cache.get(0.01) is None
+    assert len(list(tmp_path.iterdir())) == 1 # reused
+
+    # a message larger than memory
+    cache.put(b"x"*1000)
+    assert cache.get(0) == b"x"*1000
+    cache.close()
+    assert len(list(tmp_path.iterdir())) == 0
+
+def test_cache_drop(tmp_path):
+    cache = MessageCache(20, tmp_path, segment_bytes=64, disk_bytes=50)
+    for i in range(10):
+        cache.put(bytes([i])*10)
+    assert cache.dropped > 0
+    assert len(cache) == 10 - cache.dropped
+    # the newest messages remain
+    assert cache.get(0) == bytes([cache.dropped])*10
+    cache.close()
+
+def test_broker(tmp_path):
+    cache = MessageCache(1000, tmp_path, segment_bytes=4096)
+    msgs = [b"%04d" % i * 25 for i in range(40)]
+    with Broker(["inproc://broker-in"], "inproc://broker-out", cache) as broker:
+        # producers finish before any consumer connects
+        for size in iter(msgs) >> pusher("inproc://broker-in", 1,
+                                         eos="producer", eos_timeout=5):
+            pass
+        assert broker.received.count == 40
+        assert cache.spill.count > 0
+
+        got = []
+        for msg in puller("inproc://broker-out", 1):
+            got.append(msg)
+            if len(got) == len(msgs):
+                break
+        assert got == msgs
+    # (counted once send returns - checked after the threads join)
+    assert broker.served.count == 40
+    cache.close()
@@ -0,0 +1,45 @@
+import pytest
+from pynng import Push0
+
+from lclstream.checkpoint import Checkpoint, AckListener, load_checkpoint, \
+                                 ack_message, read_ack
+
+KEY = {'exp': 'xpptut15', 'run': 1, 'rank': 0}
+
+def test_checkpoint(tmp_path):
+    path = tmp_path / "ckpt.json"
+    assert load_checkpoint(path, KEY) == 0
+
+    ckpt = Checkpoint(path, KEY, done=10, interval=0)
+    seqs = [ckpt.register(n) for n in [0, 5, 5, 3]]
+    assert seqs == [0, 1, 2, 3]
+
+    ckpt.ack(2) # out of order
+    assert ckpt.done == 10
+    ckpt.ack(0)
+    ckpt.ack(1)
+    ckpt.ack(1) # duplicate
+    assert ckpt.done == 20
+    assert ckpt.outstanding == 1
+    assert load_checkpoint(path, KEY) == 20
+
+    assert not ckpt.wait(0.01)
+    ckpt.ack(3)
+    assert ckpt.wait(0.01)
+    assert load_checkpoint(path, KEY) == 23
+
+    with pytest.raises(ValueError):
+        load_checkpoint(path, dict(KEY, rank=1))
+
+def test_ack_listener(tmp_path):
+    addr = "inproc://acks"
+    ckpt = Checkpoint(tmp_path / "ckpt.json", KEY)
+    for i in range(4):
+        ckpt.register(2)
+    with AckListener(addr, ckpt):
+        with Push0(dial=addr) as push:
+            for seq in [1, 0, 3, 2]:
+                push.send(ack_message(seq))
+            assert ckpt.wait(5)
+    assert ckpt.done == 8
+    assert read_ack(ack_message(123)) == 123
@@ -0,0 +1,54 @@
+import threading
+
+import numpy as np
+
+from lclstream.loader import StreamLoader, rebatch
+from lclstream.messages import Hdf5FileWriter, FrameWriter
+from lclstream.models import Codec
+from lclstream.nng import pusher
+
+def test_rebatch():
+    arrays = [np.arange(k*100, k*100+n*6).reshape(n, 2, 3)
+              for k, n in enumerate([3, 5, 1, 4])] # 13 images
+    images = np.concatenate(arrays)
+
+    batches = list(rebatch(arrays, 4))
+    assert [len(b) for b in batches] == [4, 4, 4, 1]
+    assert np.array_equal(np.concatenate(batches), images)
+    assert all(b.flags.c_contiguous for b in batches)
+    assert len(list(rebatch(arrays, 4, drop_last=True))) == 3
+
+    rng = np.random.default_rng(1)
+    batches = list(rebatch(arrays, 4, shuffle=8, rng=rng))
+    assert [len(b) for b in batches] == [4, 4, 4, 1]
+    out = np.concatenate(batches)
+    assert not np.array_equal(out, images)
+    # a permutation of the images
+    assert sorted(out[:,0,0]) == sorted(images[:,0,0])
+
+def test_loader():
+    addr = "inproc://loader"
+    rng = np.random.default_rng(2)
+    images = rng.random((30, 6, 5), dtype=np.float32)
+    mask = np.ones((1, 6, 5), dtype=np.uint8)
+    msgs = [Hdf5FileWriter(mask, codec=Codec.gzip, attrs={'kind': 'mask'})] \
+         + [FrameWriter(images[i:i+7]) for i in range(0, 28, 7)] \
+         + [Hdf5FileWriter(images[28:], codec=Codec.none)]
+    ready = threading.Event()
+
+    def push():
+        ready.wait(10)
+        for size in iter(msgs) >> pusher(addr, 1, eos="test"):
+            pass
+    t = threading.Thread(target=push)
+    t.start()
+
+    loader = StreamLoader(addr, batch_size=8, workers=0, senders=1,
+                          ready=ready.set)
+    batches = list(loader)
+    t.join(5)
+    assert [len(b) for b in batches] == [8, 8, 8, 6]
+    assert np.array_equal(np.concatenate(batches), images)
+    assert loader.messages == 6
+    assert loader.images == 30
+    assert np.array_equal(loader.mask, mask[0])
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from lclstream.models import Codec
+from lclstream.messages import Hdf5FileWriter, FrameWriter, read_message, \
+                               Envelope, Sealed, seal, unseal, \
+                               SparseWriter, read_sparse, densify
+from lclstream.compression import registry, frame_codecs, select_codec
+
+def test_frame():
+    ilist = [np.random.random((5, 7)).astype(np.float32) for i in range(3)]
+    msg = FrameWriter(ilist)
+    data, header = read_message(msg)
+    assert data.shape == (3, 5, 7)
+    assert data.dtype == np.float32
+    assert header['codec'] == 'none'
+    assert np.array_equal(data, np.stack(ilist))
+
+    raw = np.arange(2*3*4, dtype=np.uint16).reshape(2, 3, 4)
+    data, header = read_message(FrameWriter(raw))
+    assert np.array_equal(data, raw)
+
+def test_sparse():
+    rng = np.random.default_rng(5)
+    batch = np.zeros((4, 2, 16, 16), dtype=np.float32)
+    # photons in frames 0, 1 and 3 - frame 2 is busy
+    for i, n in [(0, 5), (1, 1), (3, 0)]:
+        idx = rng.choice(batch[i].size, n, replace=False)
+        batch[i].flat[idx] = rng.random(n) + 1.0
+    batch[2] = rng.random((2, 16, 16)) + 1.0
+
+    for codec in [Codec.none, Codec.gzip]:
+        msg = SparseWriter(list(batch), codec=codec, attrs={'run': 3},
+                           threshold=0.5, max_occupancy=0.1)
+        sp = read_sparse(msg)
+        assert sp.attrs['counts'] == [5, 1, -1, 0]
+        assert sp.attrs['run'] == 3
+        assert sp.dense[2] is not None and sp.indices[2] is None
+        assert len(sp.values[0]) == 5
+        assert np.array_equal(densify(sp), batch)
+
+        data, attrs = read_message(seal(msg, Envelope(1, 0, 4)))
+        assert np.array_equal(data, batch)
+
+    # pixels at or below threshold are dropped
+    noisy = batch + 0.25
+    data, attrs = read_message(SparseWriter(noisy, threshold=0.5))
+    assert np.array_equal(data[[0, 1, 3]], np.where(noisy > 0.5, noisy, 0)[[0, 1, 3]])
+    assert np.array_equal(data[2], noisy[2])
+    # much smaller than dense
+    assert len(SparseWriter(batch[[0, 1, 3]], threshold=0.5)) < 0.05*batch.nbytes
+
+def test_hdf5():
+    ilist = [np.random.random((16, 16)).astype(np.float32) for i in range(2)]
+    msg = Hdf5FileWriter(ilist)
+    data, attrs = read_message(msg)
+    assert data.shape == (2, 16, 16)
+    assert np.allclose(data, np.stack(ilist), atol=1e-3)
+
+def test_seal():
+    raw = np.arange(2*3*4, dtype=np.uint16).reshape(2, 3, 4)
+    msg = FrameWriter(raw)
+    assert unseal(msg) == (None, msg)
+
+    env = Envelope(7, 100, 2)
+    sealed = seal(msg, env)
+    env2, body = unseal(sealed)
+    assert env2 == env
+    assert bytes(body) == msg
+    data, header = read_message(sealed)
+    assert np.array_equal(data, raw)
+
+    assert Sealed(FrameWriter)((env, raw)) == sealed
+
+def test_codecs():
+    raw = np.random.poisson(3.0, (4, 32, 32)).astype(np.uint16)
+    for codec in registry:
+        data, attrs = read_message(Hdf5FileWriter(raw, codec=codec))
+        assert attrs['codec'] == codec.value
+        if not registry[codec].lossy:
+            assert np.array_equal(data, raw)
+
+    for codec in [Codec.none] + list(frame_codecs):
+        data, header = read_message(FrameWriter(raw, codec=codec))
+        assert header['codec'] == codec.value
+        assert np.array_equal(data, raw)
+
+    with pytest.raises(ValueError):
+        FrameWriter(raw, codec=Codec.zfp)
+    # auto is chosen by select_codec, not a codec of its own
+    for writer in [Hdf5FileWriter, FrameWriter]:
+        with pytest.raises(ValueError):
+            writer(raw, codec=Codec.auto)
+
+def test_select_codec():
+    trial = [np.zeros((4, 32, 32), dtype=np.float32)]
+    codec = select_codec(trial, Hdf5FileWriter,
+                         [Codec.none, Codec.blosc_lz4], 1.0)
+    assert codec == Codec.blosc_lz4
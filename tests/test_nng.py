@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import time
+
+from pynng import Pull0, Timeout
+
+from lclstream.nng import fanout_pusher, apusher, apuller, pusher, \
+                          fanin, port_range
+
+def receive(pull, out):
+    try:
+        while True:
+            out.append(pull.recv())
+    except Timeout:
+        pass
+
+def late_receive(addr, out, delay):
+    time.sleep(delay) # (not yet listening when dialed)
+    with Pull0(listen=addr, recv_timeout=4000) as pull:
+        receive(pull, out)
+
+def test_fanout(tmp_path):
+    addrs = ["inproc://fanout-0", f"ipc://{tmp_path}/late.ipc"]
+    dead = f"ipc://{tmp_path}/nobody.ipc"
+    pull = Pull0(listen=addrs[0], recv_timeout=4000)
+    got = [[], []]
+    threads = [threading.Thread(target=receive, args=(pull, got[0])),
+               threading.Thread(target=late_receive,
+                                args=(addrs[1], got[1], 0.2))]
+    for t in threads:
+        t.start()
+
+    sent = []
+    msgs = [b"%d" % i for i in range(40)]
+    sizes = list(msgs >> fanout_pusher(addrs + [dead],
+                                       lambda sz, dt: sent.append(sz),
+                                       # (longer than nng's 1s redial)
+                                       depth=2, send_timeout=2500,
+                                       prefix=[b"mask"]))
+    assert sizes == [len(m) for m in msgs]
+    assert len(sent) == len(msgs) + 2 # (a prefix per live receiver)
+
+    for t in threads:
+        t.join()
+    pull.close()
+    # every receiver got the prefix first
+    assert got[0][0] == b"mask" and got[1][0] == b"mask"
+    got = [g[1:] for g in got]
+    # every message reached one of the live receivers
+    assert sorted(got[0] + got[1]) == sorted(msgs)
+    assert len(got[0]) > 0 and len(got[1]) > 0
+
+def test_async():
+    addr = "inproc://async"
+    msgs = [b"%d" % i for i in range(50)]
+
+    async def run():
+        got_all = asyncio.Event()
+        async def source():
+            for m in msgs:
+                yield m
+            # nng drops queued messages when a socket closes
+            await got_all.wait()
+        async def pull():
+            out = []
+            async for m in apuller(addr, inflight=3):
+                out.append(m)
+                if len(out) == len(msgs):
+                    got_all.set()
+            return out
+
+        recv = asyncio.create_task(pull())
+        await asyncio.sleep(0.1)
+        sent = []
+        sizes = [sz async for sz in apusher(source(), addr, inflight=5,
+                                 observe=lambda sz, dt: sent.append(sz))]
+        assert sizes == [len(m) for m in msgs]
+        assert len(sent) == len(msgs)
+        return await recv
+
+    assert asyncio.run(run()) == msgs
+
+def test_port_range():
+    assert port_range("tcp://10.0.0.1:5000-5002,inproc://x") == [
+            "tcp://10.0.0.1:5000", "tcp://10.0.0.1:5001",
+            "tcp://10.0.0.1:5002", "inproc://x"]
+
+def test_fanin():
+    addrs = port_range("tcp://127.0.0.1:5750-5752")
+    ready = threading.Event()
+    returned = []
+    def push(i):
+        ready.wait(10)
+        msgs = [b"%d-%d" % (i, j) for j in range(20+10*i)]
+        for size in iter(msgs) >> pusher(addrs[i], 1, eos=f"sender-{i}"):
+            pass
+        returned.append(i)
+
+    threads = [threading.Thread(target=push, args=(i,)) for i in range(3)]
+    for t in threads:
+        t.start()
+    got = list(fanin(addrs, senders=3, depth=4, ready=ready.set))
+    for t in threads:
+        t.join(5)
+    # every sender got its stream closed (rather than timing out)
+    assert sorted(returned) == [0, 1, 2]
+    assert len(got) == 20 + 30 + 40
+    assert b"2-39" in got
@@ -0,0 +1,24 @@
+import pytest
+
+from lclstream.pool import pool_map, readahead
+
+def square(x):
+    return x*x
+
+def test_pool_map():
+    ans = [square(x) for x in range(20)]
+    assert list(range(20) >> pool_map(square, 0)) == ans
+    assert list(range(20) >> pool_map(square, 3)) == ans
+    assert list(range(20) >> pool_map(square, 2, threads=True)) == ans
+
+    out = list(range(20) >> pool_map(square, 3, ordered=False, depth=4))
+    assert sorted(out) == ans
+
+def test_readahead():
+    assert list(readahead(range(100), 3)) == list(range(100))
+
+    def fail():
+        yield 1
+        raise KeyError("fail")
+    with pytest.raises(KeyError):
+        list(readahead(fail(), 2))
@@ -1,10 +1,14 @@
 import os
+import tempfile
 os.environ["RAND_PSANA"] = "1"
+os.environ["LCLSTREAM_CACHE"] = tempfile.mkdtemp()
 
 import pytest
+import numpy as np
 
-from lclstream.psana_img_src import PsanaImgSrc
-from lclstream.models import AccessMode, ImageRetrievalMode
+from lclstream.psana_img_src import PsanaImgSrc, shard
+from lclstream.reduce import apply_mask
+from lclstream.models import AccessMode, ImageRetrievalMode, Partition, parse_events
 
 def test_img_src():
     ps = PsanaImgSrc('xpptut15', 630, AccessMode.idx, 'jungfrau1M')
@@ -12,5 +16,74 @@ def test_img_src():
     for img in ps(ImageRetrievalMode.image):
         assert len(img.shape) == 2
 
-    with pytest.raises(NotImplementedError):
-        ps.create_bad_pixel_mask()
+    mask = ps.create_bad_pixel_mask()
+    assert mask.dtype == np.uint16
+    assert mask.shape == img.shape
+
+def test_mask(tmp_path, monkeypatch):
+    monkeypatch.setenv("LCLSTREAM_CACHE", str(tmp_path))
+    ps = PsanaImgSrc('xpptut15', 631, AccessMode.idx, 'jungfrau1M')
+    mask = ps.bad_pixel_mask()
+    assert len(list(tmp_path.glob("xpptut15-r0631-jungfrau1M-mask.npy"))) == 1
+
+    imgs = list(ps(ImageRetrievalMode.mask, events=slice(0, 3)))
+    batch = apply_mask(mask, imgs)
+    assert batch.shape == (3,) + mask.shape
+    assert np.all(batch[:, mask == 0] == 0)
+    assert np.array_equal(batch[:, mask == 1], np.stack(imgs)[:, mask == 1])
+
+def test_shard():
+    for partition in Partition:
+        for n in [0, 5, 17]:
+            idx = [i for rank in range(4)
+                     for i in shard(n, rank, 4, partition)]
+            assert sorted(idx) == list(range(n))
+    assert list(shard(10, 1, 3)) == [3, 4, 5]
+    assert list(shard(10, 1, 3, Partition.stride)) == [1, 4, 7]
+
+def test_select():
+    ps = PsanaImgSrc('xpptut15', 630, AccessMode.idx, 'jungfrau1M')
+    n = len(ps)
+    assert list(ps.select(slice(2, 10, 3))) == [2, 5, 8]
+    assert list(ps.select([0, -1])) == [0, n-1]
+    with pytest.raises(IndexError):
+        ps.select([n])
+    assert len(ps.event(slice(0, 4))) == 4
+    assert len(ps.event((0, [1, 3]))) == 2
+
+    imgs = list(ps(ImageRetrievalMode.raw, events=slice(0, 8),
+                   rank=1, procs=2))
+    assert len(imgs) == 4
+
+def test_parse_events():
+    assert parse_events("10:20") == slice(10, 20)
+    assert parse_events("::2") == slice(None, None, 2)
+    assert parse_events("1,5,7") == [1, 5, 7]
+
+def test_prefetch():
+    ps = PsanaImgSrc('xpptut15', 630, AccessMode.idx, 'jungfrau1M')
+    sel = slice(0, 6)
+    for kws in [dict(prefetch=2, readers=2),
+                dict(prefetch=2, readers=2, processes=True)]:
+        imgs = list(ps(ImageRetrievalMode.calib, events=sel, **kws))
+        assert len(imgs) == 6
+
+def test_start():
+    ps = PsanaImgSrc('xpptut15', 630, AccessMode.idx, 'jungfrau1M')
+    sel = slice(0, 8)
+    imgs = list(ps(ImageRetrievalMode.calib, events=sel))
+    rest = list(ps(ImageRetrievalMode.calib, events=sel, start=5))
+    assert len(rest) == 3
+    for a, b in zip(imgs[5:], rest):
+        assert np.array_equal(a, b)
+
+def test_index_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("LCLSTREAM_CACHE", str(tmp_path))
+    ps = PsanaImgSrc('xpptut15', 631, AccessMode.idx, 'jungfrau1M')
+    n = len(ps)
+    assert len(list(tmp_path.glob("xpptut15-r0631-idx-0.npy"))) == 1
+
+    ps2 = PsanaImgSrc('xpptut15', 631, AccessMode.idx, 'jungfrau1M')
+    ps2._runs = [] # fail if the run is re-enumerated
+    assert len(ps2) == n
+    assert isinstance(ps2.times(0), np.memmap)
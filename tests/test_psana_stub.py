@@ -0,0 +1,43 @@
+import time
+
+import numpy as np
+
+from lclstream.psana_stub import StubDataSource, StubDetector, StubEvent, \
+                                 Throttle, layouts
+
+def test_event():
+    for m in [32, 35]:
+        for n in [32, 127]:
+            e = StubEvent(m, n)
+            img = e.read()
+            assert img.shape == (m, n)
+
+def test_layouts(monkeypatch):
+    monkeypatch.setenv("LCLSTREAM_STUB_POOL", "2")
+    ds = StubDataSource("exp=xpptut15:run=1:idx")
+    run = next(ds.runs())
+    evts = [run.event(t) for t in run.times()[:3]]
+
+    det = StubDetector('epix10k2M')
+    raw = det.raw(evts[0])
+    assert raw.shape == (16, 352, 384)
+    assert raw.dtype == np.uint16
+    calib = [det.calib(e) for e in evts]
+    assert calib[0].shape == (16, 352, 384)
+    assert calib[0].dtype == np.float32
+    # events differ, even when they share a pool frame
+    assert not np.array_equal(calib[0], calib[2])
+    img = det.image(evts[0])
+    assert img.shape == (4*352+3*8, 4*384+3*8)
+    assert det.mask(run, edges=True).shape == layouts['epix10k2M'].shape
+
+    det = StubDetector('other')
+    assert det.calib(evts[0]).shape == (1024, 1024)
+    assert det.image(evts[0]).shape == (1024, 1024)
+
+def test_throttle():
+    th = Throttle(200.0)
+    t0 = time.perf_counter()
+    for i in range(11):
+        th.wait()
+    assert time.perf_counter() - t0 >= 0.045
@@ -0,0 +1,87 @@
+import pickle
+from functools import partial
+
+import numpy as np
+import pytest
+from pydantic import ValidationError
+
+from lclstream.models import Reduction, Quantize, Codec, DataRequest, parse_roi
+from lclstream.reduce import crop_bin, quantize, dequantize, \
+                             reduce_batch, reduce_mask, Reduced
+from lclstream.messages import Hdf5FileWriter, read_message
+
+def test_parse_roi():
+    assert parse_roi("0:4,2:8:2") == (slice(0, 4), slice(2, 8, 2))
+    with pytest.raises(ValueError):
+        parse_roi("0:4,3")
+
+def test_crop_bin():
+    batch = np.arange(2*3*6*8, dtype=np.float32).reshape(2, 3, 6, 8)
+    out = crop_bin(batch, parse_roi("1:5,0:7"), 2)
+    # 4x7 region -> 2x3 bins, the last column is dropped
+    assert out.shape == (2, 3, 2, 3)
+    assert out[1,2,0,0] == batch[1,2,1:3,0:2].sum()
+    assert np.array_equal(crop_bin(list(batch)), batch)
+
+    # raw data is summed in 32 bits, so binning shrinks it
+    raw = np.full((2, 8, 8), 65535, dtype=np.uint16)
+    out = crop_bin(raw, n=4)
+    assert out.dtype == np.uint32 and out[0,0,0] == 16*65535
+    assert out.nbytes == raw.nbytes // 8 # (1/16 the pixels, twice the size)
+    assert crop_bin(batch, n=2).dtype == np.float32
+
+def test_quantize():
+    rng = np.random.default_rng(3)
+    x = rng.normal(10.0, 2.0, size=(4, 16, 16)).astype(np.float32)
+    q, scale, offset = quantize(x, np.dtype(np.uint16))
+    assert q.dtype == np.uint16
+    assert q.min() == 0 and q.max() == 65535
+    y = dequantize(q, {'scale': scale, 'offset': offset})
+    assert np.abs(y - x).max() <= 0.51*scale # (float32 rounding)
+
+    # fixed scale, clipped to the type's range
+    q, scale, offset = quantize(x, np.dtype(np.uint8), 0.1, 5.0)
+    assert (scale, offset) == (0.1, 5.0)
+    assert q[x < 5.0].max(initial=0) == 0
+    assert q[x > 30.5].min(initial=255) == 255
+
+def test_reduced_writer():
+    rng = np.random.default_rng(4)
+    batch = [rng.random((2, 8, 8), dtype=np.float32) for i in range(3)]
+    red = Reduction(roi="0:4,0:8", bin=2, quantize=Quantize.uint8)
+    assert red.active and not Reduction().active
+    out, attrs = reduce_batch(batch, red)
+    assert out.shape == (3, 2, 2, 4)
+    assert out.dtype == np.uint8
+    assert set(attrs) == {'roi', 'bin', 'scale', 'offset'}
+
+    writer = Reduced(partial(Hdf5FileWriter), red, {'detector': 'x'})
+    writer = pickle.loads(pickle.dumps(writer))
+    data, attrs = read_message(writer(batch))
+    assert attrs['detector'] == 'x'
+    assert attrs['bin'] == 2
+    expect = crop_bin(batch, parse_roi(red.roi), 2)
+    assert np.allclose(dequantize(data, attrs), expect, atol=attrs['scale'])
+
+    mask = np.ones((2, 8, 8), dtype=np.uint8)
+    mask[1, 3, 5] = 0
+    m = reduce_mask(mask, red)
+    assert m.shape == (2, 2, 4)
+    assert m.sum() == 2*2*4 - 1 and m[1, 1, 2] == 0
+
+def test_quantized_codec():
+    # quantized images must reach the wire as integers
+    batch = np.arange(2*4*4, dtype=np.float32).reshape(2, 4, 4)
+    red = Reduction(quantize=Quantize.uint8)
+    writer = Reduced(partial(Hdf5FileWriter, codec=Codec.blosc_lz4), red)
+    data, attrs = read_message(writer(batch))
+    assert data.dtype == np.uint8
+
+    with pytest.raises(ValidationError):
+        Reduction(roi="0:4,3")
+    req = dict(exp="xpptut15", run=1, access_mode="idx",
+               detector_name="jungfrau", mode="calib",
+               addr="tcp://localhost:5000", reduce=red)
+    with pytest.raises(ValidationError):
+        DataRequest(**req, codec=Codec.zfp)
+    DataRequest(**req, codec=Codec.blosc_lz4)
@@ -0,0 +1,85 @@
+import asyncio
+
+from lclstream.models import DataRequest, ImageRetrievalMode, AccessMode
+from lclstream.transfer import Transfer
+from lclstream.scheduler import Scheduler
+
+class FakeTransfer(Transfer):
+    # completes when its event is set
+    def __init__(self, request):
+        super().__init__(request)
+        self.done = asyncio.Event()
+
+    async def run(self):
+        self.state = "active"
+        await self.done.wait()
+        self.state = "completed"
+
+def request(addr, priority=0):
+    return DataRequest(exp = "grail",
+                       run = 42,
+                       access_mode = AccessMode.idx,
+                       detector_name = "excalibur",
+                       mode = ImageRetrievalMode.image,
+                       addr = addr,
+                       priority = priority)
+
+def test_scheduler():
+    async def run():
+        sched = Scheduler(max_active=2, max_per_dest=1)
+        a1 = FakeTransfer(request("tcp://a:1"))
+        a2 = FakeTransfer(request("tcp://a:1", priority=1))
+        b1 = FakeTransfer(request("tcp://b:1"))
+        b2 = FakeTransfer(request("tcp://b:1", priority=5))
+        for trs in [a1, a2, b1]:
+            sched.submit(trs)
+        await asyncio.sleep(0)
+        # one per destination
+        assert a1.state == "active" and b1.state == "active"
+        assert a2.state == "queued"
+
+        sched.submit(b2)
+        assert sched.queued == 2
+        a1.done.set()
+        await asyncio.sleep(0.01)
+        assert a1.state == "completed"
+        assert a2.state == "active"
+
+        assert sched.cancel(b2)
+        assert b2.state == "canceled"
+        b1.done.set()
+        a2.done.set()
+        await asyncio.sleep(0.01)
+        assert len(sched.active) == 0 and sched.queued == 0
+
+    asyncio.run(run())
+
+def test_failed(monkeypatch):
+    async def fail(req, update):
+        raise FileNotFoundError("psana_push")
+    monkeypatch.setattr("lclstream.transfer.send_experiment", fail)
+
+    async def run():
+        sched = Scheduler(max_active=1, max_per_dest=1)
+        trs = Transfer(request("tcp://a:1"))
+        sched.submit(trs)
+        task = trs.coro
+        await asyncio.sleep(0.01)
+        assert trs.state == "failed"
+        assert task.exception() is None # (nothing left unretrieved)
+        assert len(sched.active) == 0
+
+    asyncio.run(run())
+
+def test_cancel_started():
+    async def run():
+        sched = Scheduler(max_active=1, max_per_dest=1)
+        trs = FakeTransfer(request("tcp://a:1"))
+        sched.submit(trs) # started, but its task has not run yet
+        assert sched.cancel(trs)
+        assert trs.state == "canceled"
+        await asyncio.sleep(0.01)
+        assert trs.state == "canceled"
+        assert len(sched.active) == 0
+
+    asyncio.run(run())
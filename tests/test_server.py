@@ -1,9 +1,10 @@
 import asyncio
 
 from typing import List
-import pytest
 import os
+import tempfile
 os.environ["RAND_PSANA"] = "1"
+os.environ["LCLSTREAM_CACHE"] = tempfile.mkdtemp()
 
 import pytest
 
@@ -12,27 +13,27 @@ from fastapi.testclient import TestClient
 from lclstream.server import app
 from lclstream.transfer import Transfer
 from lclstream.models import DataRequest, ImageRetrievalMode, AccessMode
-from lclstream.psana_pull import puller
-
-from pynng import Pull0, Timeout
+from lclstream.nng import apuller
 
 ADDR = "tcp://127.0.0.1:28451"
 
 client = TestClient(app)
 
-@pytest.fixture()
-def pull_server(event_loop):
-    async def run_pull(pull):
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+async def pull_server():
+    async def run_pull():
         nmsg = 0
-        async for data in pull:
+        async for data in apuller(ADDR):
             nmsg += 1
         print(f"pull_server: received {nmsg} messages")
 
-    P = puller(ADDR)
-    task = asyncio.ensure_future(run_pull(P), loop=event_loop)
-
+    task = asyncio.create_task(run_pull())
     # Sleeps to allow the server boot-up.
-    event_loop.run_until_complete(asyncio.sleep(0.1))
+    await asyncio.sleep(0.1)
 
     try:
         yield
@@ -45,7 +46,7 @@ def test_get_list():
     resp = response.json()
     assert isinstance(resp, list)
 
-@pytest.mark.asyncio
+@pytest.mark.anyio
 async def test_mk_transfer(pull_server):
     response = client.post("/transfers/new", json={"abc": 2})
     assert response.status_code == 422
@@ -56,6 +57,12 @@ async def test_mk_transfer(pull_server):
                       detector_name = "excalibur",
                       mode = ImageRetrievalMode.image,
                       addr = ADDR)
+    # bad requests are rejected up front
+    for bad in [dict(events="1:2:3:4"), dict(format="frame", codec="zfp")]:
+        response = client.post("/transfers/new",
+                               json=dict(trs.model_dump(), **bad))
+        assert response.status_code == 422
+
     response = client.post("/transfers/new", json=trs.model_dump())
     assert response.status_code == 200
     tid = response.json()
@@ -0,0 +1,59 @@
+import os
+import threading
+
+import numpy as np
+
+from lclstream.shm import shm_pusher, shm_puller, descriptor, read_descriptor, \
+                          SHM_DIR
+
+def test_descriptor():
+    msg = descriptor("/dev/shm/x", 3, 192, np.dtype(np.float32), (2, 5, 7))
+    assert read_descriptor(msg) == ("/dev/shm/x", 3, 192,
+                                    np.dtype(np.float32), (2, 5, 7))
+
+def test_shm(tmp_path):
+    addr = f"ipc://{tmp_path}/shm.ipc"
+    rng = np.random.default_rng(4)
+    batches = [rng.random((3, 4, 5), dtype=np.float32) for i in range(9)]
+    # the last batch is shorter, and given as a list of images
+    batches.append(list(rng.random((2, 4, 5), dtype=np.float32)))
+    rings = set(os.listdir(SHM_DIR))
+    sizes = []
+    def push():
+        for size in iter(batches) >> shm_pusher(addr, nslots=2):
+            sizes.append(size)
+
+    t = threading.Thread(target=push)
+    t.start()
+    got = []
+    for arr in shm_puller(addr):
+        assert not arr.flags.writeable
+        got.append(arr.copy())
+    t.join(5)
+    assert not t.is_alive()
+
+    assert len(got) == 10
+    for x, y in zip(got[:-1], batches):
+        assert np.array_equal(x, y)
+    assert np.array_equal(got[-1], np.stack(batches[-1]))
+    assert sizes == [x.nbytes for x in got]
+    # the ring is removed
+    assert set(os.listdir(SHM_DIR)) == rings
+
+def test_max_images(tmp_path):
+    # slots fit max_images images, even if the first batch is short
+    addr = f"ipc://{tmp_path}/shm.ipc"
+    batches = [np.full((n, 4, 5), n, dtype=np.uint16) for n in (1, 3, 2)]
+    def push():
+        for size in iter(batches) >> shm_pusher(addr, nslots=2,
+                                                max_images=3):
+            pass
+
+    t = threading.Thread(target=push)
+    t.start()
+    got = [arr.copy() for arr in shm_puller(addr)]
+    t.join(5)
+    assert not t.is_alive()
+    assert [x.shape[0] for x in got] == [1, 3, 2]
+    for x, y in zip(got, batches):
+        assert np.array_equal(x, y)
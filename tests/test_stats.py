@@ -0,0 +1,47 @@
+import json
+import time
+
+from lclstream.stats import LogHistogram, Stats, timed
+
+def test_log_histogram():
+    h = LogHistogram(1.0)
+    assert h.percentile(50) == 0.0
+    for x in range(1, 1001):
+        h.add(float(x))
+    assert h.count == 1000
+    assert h.total == 500500.0
+    assert h.max == 1000.0
+    # buckets are accurate to 2**(1/4)
+    assert 500 <= h.percentile(50) <= 500 * 2**0.25
+    assert 990 <= h.percentile(99) <= 1000
+    assert h.percentile(100) == 1000.0
+
+    s = h.summary()
+    assert s['count'] == 1000
+    assert s['mean'] == 500.5
+
+def test_timed(tmp_path):
+    stats = Stats(('read', 'send'))
+    def slow(n):
+        for i in range(n):
+            time.sleep(0.01)
+            yield i
+
+    for x in slow(5) >> timed(stats, 'read') >> timed(stats, 'send'):
+        stats.message(100)
+
+    assert stats.count == 5
+    assert stats.size == 500
+    assert stats.stages['read'].count == 5
+    assert stats.stages['read'].total >= 0.05
+    # the outer stage does not include time spent in 'read'
+    assert stats.stages['send'].total < stats.stages['read'].total
+    assert stats.mbps > 0
+    assert "5 messages" in stats.summary()
+
+    fname = tmp_path / "stats.json"
+    stats.dump(str(fname))
+    with open(fname) as f:
+        rep = json.load(f)
+    assert rep['count'] == 5
+    assert set(rep['stages']) == {'read', 'send'}
@@ -0,0 +1,70 @@
+import asyncio
+
+from lclstream.models import TransferStats, DataRequest, AccessMode, ImageRetrievalMode, \
+                             Reduction, Quantize
+from lclstream.transfer import Transfer, read_progress, push_command
+from lclstream.metrics import bucket_counts, observe, size_buckets
+from lclstream import metrics
+
+def test_read_progress():
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"Selected codec none\n")
+        reader.feed_data(TransferStats(messages=1, bytes=10).model_dump_json().encode() + b"\n")
+        reader.feed_data(b"{not json\n")
+        reader.feed_data(TransferStats(messages=2, bytes=20, final=True).model_dump_json().encode() + b"\n")
+        reader.feed_eof()
+
+        reports = []
+        await read_progress(reader, reports.append)
+        return reports
+
+    reports = asyncio.run(run())
+    assert [st.messages for st in reports] == [1, 2]
+    assert reports[-1].final
+
+def test_metrics():
+    req = DataRequest(exp = "grail",
+                      run = 42,
+                      access_mode = AccessMode.idx,
+                      detector_name = "excalibur",
+                      mode = ImageRetrievalMode.image,
+                      addr = "tcp://metrics:1")
+    trs = Transfer(req)
+    size_hist = bucket_counts(size_buckets)
+    observe(size_hist, size_buckets, 2000)
+    trs.update(TransferStats(messages=1, bytes=2000, size_hist=size_hist))
+    observe(size_hist, size_buckets, 3000)
+    trs.update(TransferStats(messages=2, bytes=5000, size_hist=size_hist))
+
+    text = metrics.registry.render()
+    assert 'lclstream_sent_bytes_total{dest="tcp://metrics:1"} 5000.0' in text
+    assert 'lclstream_message_size_bytes_count{dest="tcp://metrics:1"} 2' in text
+    assert 'lclstream_message_size_bytes_bucket{dest="tcp://metrics:1",le="4096.0"} 2' in text
+
+def test_push_command():
+    req = DataRequest(exp = "grail",
+                      run = 42,
+                      access_mode = AccessMode.idx,
+                      detector_name = "excalibur",
+                      mode = ImageRetrievalMode.image,
+                      addr = ["tcp://dtn1:5000", "tcp://dtn2:5000"])
+    cmd = push_command(req)
+    assert cmd[cmd.index("-a")+1] == "tcp://dtn1:5000,tcp://dtn2:5000"
+    assert Transfer(req).destination == "tcp://dtn1:5000,tcp://dtn2:5000"
+    assert "--target_mb" not in cmd
+
+    req.target_mb = 8.0
+    cmd = push_command(req)
+    assert cmd[cmd.index("--target_mb")+1] == "8.0"
+
+    req.reduce = Reduction(roi="0:256,0:256", bin=2, quantize=Quantize.uint16)
+    cmd = push_command(req)
+    assert cmd[cmd.index("--roi")+1] == "0:256,0:256"
+    assert cmd[cmd.index("--bin")+1] == "2"
+    assert cmd[cmd.index("--quantize")+1] == "uint16"
+    assert "--scale" not in cmd
+
+    req.threshold = 2.5
+    cmd = push_command(req)
+    assert cmd[cmd.index("--threshold")+1] == "2.5"